@@ -1,62 +1,165 @@
-import pandas as pd, time
+import os, csv, pandas as pd, numpy as np, time, suggestion
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from IPython.display import display, clear_output, HTML
 
-def alternation_check(df, alternation_set=[], alternation="alternating", labels={"y":"yes", "n":"no", "u":"unclear"}, window_leading=10, window_trailing=10):
+def alternation_check(df, alternation_set=[], alternation="alternating", labels={"y":"yes", "n":"no", "u":"unclear"}, window_leading=10, window_trailing=10, identical_context_window=3, journal=None, prefetch=5, feedback="non-blocking", suggest=False, accept_above=None):
     """Function helps users annotate alternation sets in a corpus, i.e., decide whether instances
     of the given variants are, in fact, alternating or not. It informs the user of the annotation scheme,
     provides them with one case at a time including a context of 10 tokens before and after the instance
     in question (window sizes can be modified in general or for single, inconclusive instances), and displays an input 
     field for submitting the annotation decision. Decisions can be confirmed or modified. It also searches for identical contexts 
-    by calling the respective function, prompting the user whether the given decision should be applied there as well. 
-    The function can be used to annotate in multiple sessions as already-annotated instances are skipped."""
+    by calling the respective function, prompting the user whether the given decision should be applied there as well
+    (contexts are identical if the words from identical_context_window tokens before to identical_context_window tokens after are).
+    The function can be used to annotate in multiple sessions as already-annotated instances are skipped.
+
+    If the path of a journal (csv file) is passed, every confirmed decision is appended to it immediately (see write_journal), such that
+    no decision is lost if the session ends unexpectedly, and decisions of previous sessions in the journal are applied to df first
+    (see replay). The journal is merged into the annotated corpus file only on demand (see compact).
+
+    The context windows of all instances (also the widened ones, see '+') are determined at once, and the contexts of the next
+    prefetch instances are rendered in the background while the user is deciding the current one (prefetch=0 for rendering each
+    context only when displayed). With feedback="non-blocking", feedback (e.g. that a decision has been saved) is shown above the next
+    context rather than during a pause of 2 seconds ("blocking"), such that the next context is displayed immediately.
+
+    If suggest is True, a model trained with the decisions made so far for the alternation set (including those of previous sessions)
+    and updated after each decision suggests a label with a confidence for each instance, which is accepted by pressing Enter
+    (see suggestion). Instances are then ordered by uncertainty, i.e., the one whose suggestion is least confident is displayed first.
+    Suggestions with a confidence of at least accept_above (if passed) are accepted automatically and recorded in the journal
+    as propagated from "suggestion".
+
+    Several alternation sets can be annotated in one session by passing a dictionary as alternation_set, mapping the column of each
+    (e.g. "SCHEDULE") to its variants (alternation is then ignored). Instances of all sets are displayed in the order of the corpus,
+    and the context of an instance of several sets is displayed once, the decisions for the sets being prompted one after another."""
 
     #copying df to avoid warning
     df = df.copy()
 
+    #resuming previous sessions by applying the decisions recorded in the journal
+    if journal:
+        df = replay(df, journal, labels)
+
     #saving user preference for window sizes to be able to reset to them after temporarily increasing context size
     user_set_window_trailing, user_set_window_leading = window_trailing, window_leading
 
-    #extracting indices from df containing rows with lemmata which are in alternation_set 
-    #AND which haven't been annotated yet (i.e., df[alternation] is still empty)
-    indices_to_check = df[(df.lemma.isin(alternation_set)) & (df[alternation].isna())].index
+    #annotating a single alternation set, given as list of variants, like several ones
+    alternation_sets = alternation_set if isinstance(alternation_set, dict) else {alternation: alternation_set}
 
-    #iterating over these indices
-    for i in indices_to_check:
+    #creating columns for saving annotation decisions, if they do not already exist
+    for alternation in alternation_sets:
+        if alternation not in df.columns:
+            df[alternation] = pd.Series(pd.NA, index=df.index, dtype=object)
 
-        #if, during the ongoing session, a context has already been annotated by way of identicality to another context, skipping it
-        if pd.notna(df.loc[i, alternation]):
+    #extracting, per alternation set, indices from df containing rows with lemmata which are in the alternation set
+    #AND which haven't been annotated yet (i.e., df[alternation] is still empty)
+    indices_by_alternation = {alternation: df[(df.lemma.isin(variants)) & (df[alternation].isna())].index for alternation, variants in alternation_sets.items()}
+
+    #queueing the pairs of index and alternation set in the order of the corpus (and of alternation sets for the same index),
+    #the indices of all alternation sets and the alternation sets of each index
+    pairs = sorted(((i, alternation) for alternation, indices in indices_by_alternation.items() for i in indices), key=lambda pair: pair[0])
+    indices_to_check = pd.Index(sorted({i for i, _ in pairs}), dtype=df.index.dtype)
+    alternations_of = defaultdict(list)
+    for i, alternation in pairs:
+        alternations_of[i].append(alternation)
+
+    #building the context strings of all these indices once and, per alternation set, an index of identical contexts (see context_index)
+    context_strings, identical_contexts = {}, {}
+    for alternation, indices in indices_by_alternation.items():
+        strings, identical_contexts[alternation] = context_index(df, indices, identical_context_window)
+        context_strings.update(strings)
+
+    #determining the context windows of all these indices at once, i.e., the default ones and those widened by '+' once
+    #(windows widened further are determined when needed), and the position of each index among them
+    windows = {0: context_windows(df, indices_to_check, window_leading, window_trailing), 1: context_windows(df, indices_to_check, window_leading + 10, window_trailing + 10)}
+    positions = {i: position for position, i in enumerate(indices_to_check)}
+
+    #contexts rendered in the background (see render_context), by index and number of times the context has been widened
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    rendered = {}
+
+    #feedback to be displayed above the next context (in non-blocking mode) and number of instances left (updated after each decision)
+    notice = ""
+    left = remaining(df, indices_by_alternation)
+
+    #in suggestion mode, training a model per alternation set with the decisions made so far for it and determining the features
+    #of all pairs to check once (see suggestion)
+    models, rows, automatic = None, None, set()
+    if suggest:
+        models = {}
+        for alternation, variants in alternation_sets.items():
+            annotated = df[df.lemma.isin(variants) & df[alternation].notna()].index
+            models[alternation] = suggestion.fit(suggestion.features(df, annotated), df.loc[annotated, alternation], list(labels.values()))
+        rows = suggestion.features(df, [i for i, _ in pairs])
+
+    #pairs of index and alternation set not yet annotated in the order they are displayed next (see candidates),
+    #and the index and context size currently displayed
+    order, shown = [], None
+
+    #iterating over these pairs (skipping those annotated by way of identicality to another context during the ongoing session)
+    for i, alternation, suggested, confidence in candidates(df, pairs, models, rows, order, automatic):
+
+        #accepting confident suggestions automatically
+        if accept_above is not None and suggested is not None and confidence >= accept_above:
+            df.loc[i, alternation] = suggested
+            write_journal(journal, [i], alternation, suggested, propagated_from="suggestion")
+            automatic.add((i, alternation))
+            left -= 1
             continue
 
         #annotating while there are instances left and the user wishes to continue
         while True:
 
-            #clearing previous user output
-            clear_output()
+            #number of times the context has been widened by '+' (see window sizes)
+            level = (window_leading - user_set_window_leading) // 10
 
-            #distplaying annotation scheme (default binary scheme can be overwritten using labels parameter)
-            display(HTML('<b>Annotationschema:</b> ' + '; '.join(f"'{key}': '{value}'" for key, value in labels.items()) + '<br>'))
-            
-            #displaying how many instances are left to tag
-            display(HTML(f"{len(df[(df.index.isin(indices_to_check)) & df[alternation].isna()])} left!"))
-            
-            #extracting context around current instance, drawing on window size variables and focusing on select columns
-            context = df.loc[i-window_leading:i+window_trailing, ["word", "speaker", "interaction_id", alternation]]
+            #if the context is already displayed (i.e., the decision for another alternation set of the same index has just been made),
+            #only prompting the decision for the next alternation set
+            if shown == (i, level):
+                display(HTML(f"<br>{notice}<br>Next alternation set: <b>{alternation}</b>"))
+                notice = ""
 
-            #saving context string to check later whether the same context has been annotated before
-            context_string = df.loc[i-3:i+3, "word"].str.cat(sep=" ")
+            else:
+                shown = (i, level)
 
-            #stylying context DataFrame, highlighting, among other things, the instance to be annotated
-            context = context.style.applymap(lambda val: f'background-color: darksalmon; font-weight: bold', subset=pd.IndexSlice[i,])
-            context = context.applymap(lambda val: f'color: red; font-weight: bold' if val == "S" else f'color: darkgreen; font-weight: bold', subset=pd.IndexSlice[:,"speaker"])
+                #looking up the context rendered in the background or rendering it now (see prefetched_context)
+                context = prefetched_context(df, i, list(alternation_sets), rendered, window(windows, df, indices_to_check, level, user_set_window_leading, user_set_window_trailing)[positions[i]], level)
 
-            #displaying the stylised context
-            display(context)
+                #clearing previous user output (only once the new output is displayed, avoiding flickering)
+                clear_output(wait=True)
+
+                #displaying feedback on the previous decision (in non-blocking mode)
+                if notice:
+                    display(HTML(notice))
+                    notice = ""
+
+                #distplaying annotation scheme (default binary scheme can be overwritten using labels parameter)
+                display(HTML('<b>Annotationschema:</b> ' + '; '.join(f"'{key}': '{value}'" for key, value in labels.items()) + '<br>'))
+                
+                #displaying how many instances are left to tag (and the alternation set, if several are annotated)
+                display(HTML(f"{left} left!" + (f" Alternation set: <b>{alternation}</b>" if len(alternation_sets) > 1 else "")))
+
+                #displaying the stylised context
+                display(HTML(context))
+
+                #rendering the next instances not yet annotated and the widened context of the current one in the background while the user is deciding
+                #(discarding contexts rendered for instances which have been annotated in the meantime, e.g. by way of identicality)
+                if executor is not None:
+                    for key in [key for key in rendered if df.loc[key[0], alternations_of[key[0]]].notna().all()]:
+                        rendered.pop(key)[1].cancel()
+                    upcoming = list(dict.fromkeys(j for j, alternation_j in order[:2 * prefetch * len(alternation_sets)] if j != i and pd.isna(df.loc[j, alternation_j])))[:prefetch]
+                    for j, level_j in [(i, level + 1)] + [(j, 0) for j in upcoming]:
+                        if (j, level_j) not in rendered:
+                            prefetch_context(executor, df, j, list(alternation_sets), rendered, window(windows, df, indices_to_check, level_j, user_set_window_leading, user_set_window_trailing)[positions[j]], level_j)
+
+            #looking up context string to check later whether the same context has been annotated before
+            context_string = context_strings[i]
 
             #prompting user for decision until they provide a valid one
             while True:
 
-                #displaying prompt and offering to increase context size
-                display(HTML("Classify according to annotation scheme. '+' for more context."))
+                #displaying prompt and offering to increase context size (and to accept the suggestion, if any)
+                display(HTML("Classify according to annotation scheme. '+' for more context."
+                             + (f"<br>Suggestion: <b>{suggested}</b> (confidence {confidence:.2f}), Enter to accept." if suggested is not None else "")))
 
                 #code if user decision is valid
                 try:
@@ -78,8 +181,8 @@ def alternation_check(df, alternation_set=[], alternation="alternating", labels=
                     #(re)setting variable for context size
                     more_context = False
 
-                    #normalising user input to annotation label...
-                    answer_formatted = labels[answer]
+                    #normalising user input to annotation label (accepting the suggestion if the input is empty)...
+                    answer_formatted = suggested if answer == "" and suggested is not None else labels[answer]
 
                     #...and breaking inner loop if no error is thrown
                     break
@@ -89,7 +192,7 @@ def alternation_check(df, alternation_set=[], alternation="alternating", labels=
 
                     #prompting user to input valid answer, before 
                     display(HTML("Please use option from annotation scheme."))
-                    time.sleep(2)
+                    pause(feedback)
 
             #if user wishes larger context, continuing (i.e., staying "inside" outer while loop and displaying the same instances again, now with more context)
             if more_context == True:
@@ -106,14 +209,19 @@ def alternation_check(df, alternation_set=[], alternation="alternating", labels=
             #if user wishes to quit the current session...
             if confirm.lower() == "quit":
                 
-                #...last annotation decision is saved in corresponding column in df
+                #...last annotation decision is saved in corresponding column in df (and in the journal)
                 df.loc[i, alternation] = answer_formatted
+                write_journal(journal, [i], alternation, answer_formatted)
 
                 #one last time, identical contexts are searched (see separate function)
-                df = annotate_identical_contexts(df, alternation, i, indices_to_check, context_string, answer_formatted)
+                df = annotate_identical_contexts(df, alternation, i, indices_to_check, context_string, answer_formatted, identical_contexts[alternation], journal, feedback)
 
                 #informing user of successful update
                 display(HTML("DataFrame has been updated. Goodbye! 👋🏻"))
+
+                #stopping background rendering
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
                 
                 #df is returned and function exited
                 return(df)
@@ -121,45 +229,188 @@ def alternation_check(df, alternation_set=[], alternation="alternating", labels=
             #if user confirms their decision...
             elif confirm.lower() != "no":
 
-                #...it is saved in the corresponding column in df
+                #...it is saved in the corresponding column in df (and in the journal)
                 df.loc[i, alternation] = answer_formatted
+                write_journal(journal, [i], alternation, answer_formatted)
 
                 #informing user of succesful saving
                 display(HTML("Your decision has been saved. Checking for identical contexts..."))
-                time.sleep(2)
+                pause(feedback)
 
                 #searching identical contexts (see separate function)
-                df = annotate_identical_contexts(df, alternation, i, indices_to_check, context_string, answer_formatted)
+                df = annotate_identical_contexts(df, alternation, i, indices_to_check, context_string, answer_formatted, identical_contexts[alternation], journal, feedback)
+
+                #updating the number of instances left and, in non-blocking mode, noting the feedback to be displayed above the next context
+                annotated = left - remaining(df, indices_by_alternation)
+                left -= annotated
+                if feedback != "blocking":
+                    notice = f"Previous decision (<b>{answer_formatted}</b>) saved" + (f" for {annotated} contexts (including identical ones)." if annotated > 1 else ".")
 
                 #breaking outer while loop, i.e., continuing with next index
                 break    
 
             #if user does not confirm, the outer while loop is not broken, i.e., the same instance is displayed again
+            shown = None
+
+    #stopping background rendering
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
 
     #returning df if no more instances are left
     return(df)
 
-def annotate_identical_contexts(df, alternation, i, indices_to_check, context_string, answer_formatted):
-    """Function checks whether identical contexts exist for a given instance including 3 words before and after,
-    and prompts the user whether their annotation decision should be applied there as well."""
+def remaining(df, indices_by_alternation):
+    """Function returns the number of instances not yet annotated, given the indices to check per alternation set."""
+
+    return sum(df.loc[indices, alternation].isna().sum() for alternation, indices in indices_by_alternation.items())
+
+def candidates(df, pairs, models=None, rows=None, order=None, automatic=set()):
+    """Generator yielding those of the given pairs of index and alternation set which are not yet annotated (checked before each one,
+    as instances may be annotated by way of identicality in the meantime), together with the suggested label and its confidence
+    (both None without models or decisions to learn from, see suggestion). Without models, pairs are yielded in the given order.
+    With models (one per alternation set, and the features of the indices of pairs as rows), the pair whose suggestion is least
+    confident is yielded first, the models being updated with the decisions made in the meantime (except suggestions accepted
+    automatically, i.e., the pairs in automatic) before each one. If a list is passed as order, it is filled with the remaining pairs
+    in the order they would be yielded next (e.g. for rendering them ahead of time)."""
+
+    order = [] if order is None else order
+
+    if models is None:
+        for position, (i, alternation) in enumerate(pairs):
+            if pd.isna(df.loc[i, alternation]):
+                order[:] = pairs[position + 1:]
+                yield i, alternation, None, None
+        return
+
+    indices = np.array([i for i, _ in pairs])
+    alternations = np.array([alternation for _, alternation in pairs], dtype=object)
+    left = np.ones(len(pairs), dtype=bool)
+
+    while True:
+
+        suggested, confidence = np.full(len(pairs), None, dtype=object), np.zeros(len(pairs))
+
+        for alternation, model in models.items():
+            selected = alternations == alternation
+
+            #updating the model with the decisions made for the alternation set since the last pair was yielded
+            annotated = left & selected
+            annotated[annotated] = df.loc[indices[annotated], alternation].notna().to_numpy()
+            learn = annotated.copy()
+            learn[learn] = [(i, alternation) not in automatic for i in indices[learn]]
+            if learn.any():
+                suggestion.update(model, suggestion.subset(rows, learn), df.loc[indices[learn], alternation])
+            left &= ~annotated
+
+            #suggesting labels for the remaining pairs of the alternation set (no suggestions without decisions to learn from)
+            selected &= left
+            if selected.any():
+                suggested_selected, confidence[selected] = suggestion.suggest(model, suggestion.subset(rows, selected))
+                if model["decisions"].sum() > 0:
+                    suggested[selected] = suggested_selected
+
+        if not left.any():
+            return
+
+        #ordering the remaining pairs by the confidence of their suggestions (in the given order if equally confident)
+        positions = np.flatnonzero(left)[np.argsort(confidence[left], kind="stable")]
+        order[:] = [pairs[position] for position in positions[1:]]
+
+        yield indices[positions[0]], alternations[positions[0]], suggested[positions[0]], (confidence[positions[0]] if suggested[positions[0]] is not None else None)
+
+def pause(feedback="non-blocking"):
+    """Function pauses for 2 seconds after feedback is displayed, such that the user can read it before the next output,
+    unless feedback is "non-blocking"."""
+
+    if feedback == "blocking":
+        time.sleep(2)
+
+def context_windows(df, indices, window_leading=10, window_trailing=10):
+    """Function returns the first and last (exclusive) position of the context window of each of the given indices
+    (from window_leading tokens before to window_trailing tokens after it by index, like df.loc[i-window_leading:i+window_trailing])
+    as array of pairs, determined for all indices at once."""
+
+    labels = df.index.to_numpy()
+    indices = np.asarray(indices)
+
+    return np.column_stack([np.searchsorted(labels, indices - window_leading, side="left"), np.searchsorted(labels, indices + window_trailing, side="right")])
+
+def window(windows, df, indices, level, window_leading, window_trailing):
+    """Function returns the context windows of indices widened level times by 10 tokens each side, determining them
+    if they are not yet in windows (a dictionary by level, see alternation_check)."""
+
+    if level not in windows:
+        windows[level] = context_windows(df, indices, window_leading + 10 * level, window_trailing + 10 * level)
+
+    return windows[level]
+
+def render_context(context, i):
+    """Function returns the HTML code of a context (a DataFrame with the columns word, speaker, interaction_id and the alternation),
+    highlighting the instance i and the speakers."""
+
+    #stylying context DataFrame, highlighting, among other things, the instance to be annotated
+    context = context.style.applymap(lambda val: f'background-color: darksalmon; font-weight: bold', subset=pd.IndexSlice[i,])
+    context = context.applymap(lambda val: f'color: red; font-weight: bold' if val == "S" else f'color: darkgreen; font-weight: bold', subset=pd.IndexSlice[:,"speaker"])
+
+    return context.to_html()
+
+def prefetch_context(executor, df, i, alternation, rendered, window, level=0):
+    """Function starts rendering the context of instance i within window (first and last position) in the background,
+    storing the future in rendered by index and level (see prefetched_context). The context is copied beforehand,
+    such that df can be modified in the meantime. alternation can also be a list of alternation sets, whose columns are all displayed."""
+
+    alternations = [alternation] if isinstance(alternation, str) else list(alternation)
+    context = df.iloc[window[0]:window[1]][["word", "speaker", "interaction_id"] + alternations].copy()
+    rendered[(i, level)] = (context, executor.submit(render_context, context, i))
+
+def prefetched_context(df, i, alternation, rendered, window, level=0):
+    """Function returns the HTML code of the context of instance i within window (first and last position), taking it from
+    the contexts rendered in the background if it has been and if no instance in it has been annotated since (else rendering it now).
+    alternation can also be a list of alternation sets, whose columns are all displayed."""
+
+    alternations = [alternation] if isinstance(alternation, str) else list(alternation)
+    context = df.iloc[window[0]:window[1]][["word", "speaker", "interaction_id"] + alternations]
+    snapshot, future = rendered.pop((i, level), (None, None))
+
+    if future is not None and snapshot[alternations].equals(context[alternations]):
+        return future.result()
+
+    if future is not None:
+        future.cancel()
+
+    return render_context(context, i)
 
-    #constraining to indices above current index (thus skipping already annotated instances)
-    indices_to_check_identical_contexts = [j for j in indices_to_check if j > i]
+def context_index(df, indices, k=3):
+    """Function returns the context string of each of the given indices, i.e., the words from k tokens before to k tokens after it
+    (by index, like df.loc[i-k:i+k]), as well as an index mapping each context string to the (ascending) indices sharing it.
+    Built once, identical contexts can be looked up for each decision instead of comparing the contexts of all remaining indices."""
 
-    #creating empty list to append identical context in loop below
-    indices_identical_contexts = []
+    words = df["word"].to_numpy(dtype=object)
 
-    #looping through all contexts to check whether they are identical to the current one
-    for j in indices_to_check_identical_contexts:
-        
-        #extracting context of three words before and after current index and creating string of it
-        context_j = df.loc[j-3:j+3, "word"].str.cat(sep=" ")
-        
-        #if the string context of the two instances are identical...
-        if context_string == context_j:
+    #determining the first and last position of each context window at once (see context_windows)
+    windows = context_windows(df, indices, k, k)
 
-            #...appending index to list of identical contexts
-            indices_identical_contexts.append(j)
+    context_strings, identical_contexts = {}, defaultdict(list)
+
+    for i, (start, end) in zip(np.asarray(indices), windows):
+        #joining words like str.cat, i.e., skipping missing values
+        context_strings[i] = " ".join(str(word) for word in words[start:end] if not pd.isna(word))
+        identical_contexts[context_strings[i]].append(i)
+
+    return context_strings, identical_contexts
+
+def annotate_identical_contexts(df, alternation, i, indices_to_check, context_string, answer_formatted, identical_contexts=None, journal=None, feedback="blocking"):
+    """Function checks whether identical contexts exist for a given instance including 3 words before and after
+    (or as many as in the context strings of identical_contexts, see context_index), and prompts the user whether
+    their annotation decision should be applied there as well (recording it in the journal, if passed, as propagated from i).
+    With feedback="non-blocking", the function does not pause after its feedback (see pause)."""
+
+    #building the index of identical contexts if it was not passed (i.e., when called outside alternation_check)
+    if identical_contexts is None:
+        identical_contexts = context_index(df, indices_to_check)[1]
+
+    #looking up indices with the identical context, constrained to those not yet annotated (in corpus order, these are above the current index)
+    indices_identical_contexts = [j for j in identical_contexts.get(context_string, []) if j != i and pd.isna(df.loc[j, alternation])]
     
     #if there is at least one identical context
     if len(indices_identical_contexts) > 1:
@@ -173,40 +424,115 @@ def annotate_identical_contexts(df, alternation, i, indices_to_check, context_st
 
             display(HTML("<br>Your decision will only be saved for the given context."))
 
-            time.sleep(2)
+            pause(feedback)
 
             return df
 
         #else the df is modified such that the annotation decision is saved for all identical contexts in the corresponding column
         df.loc[indices_identical_contexts, alternation] = answer_formatted 
+        write_journal(journal, indices_identical_contexts, alternation, answer_formatted, propagated_from=i)
 
         display(HTML("Your decision has been saved. Next context!"))
 
-        time.sleep(2)
+        pause(feedback)
     
     #returning df
     return df
 
+#default annotation scheme (binary, plus unclear instances)
+LABELS = {"y":"yes", "n":"no", "u":"unclear"}
+
+#columns of the annotation journal, one row per decision (propagated_from being the index a decision has been propagated from by way of
+#identicality, "suggestion" for suggestions accepted automatically, or empty)
+JOURNAL_COLUMNS = ["index", "alternation", "decision", "timestamp", "propagated_from"]
+
+def write_journal(journal, indices, alternation, decision, propagated_from=None):
+    """Function appends a decision for the given indices to the journal (a csv file, created with a header if it does not exist)
+    and flushes it to disk, i.e., saving a decision only costs writing one line per index rather than the whole corpus.
+    Nothing is written if journal is None."""
 
+    if not journal:
+        return
 
+    new = not os.path.exists(journal)
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
 
+    #a session ending while writing may leave the last line unterminated, which is closed first so that the new decisions are not
+    #appended to it (the torn line itself is discarded by read_journal)
+    torn = False
+    if not new and os.path.getsize(journal) > 0:
+        with open(journal, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
 
+    with open(journal, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(JOURNAL_COLUMNS)
+        elif torn:
+            f.write("\n")
+        writer.writerows([index, alternation, decision, timestamp, "" if propagated_from is None else propagated_from] for index in indices)
+        f.flush()
+        os.fsync(f.fileno())
 
+def read_journal(journal, labels=LABELS):
+    """Function reads the journal as DataFrame (empty if it does not exist), one row per decision in the order they were made.
+    Only complete decisions are kept, i.e., rows with a timestamp and a decision in labels (the annotation scheme as passed
+    to alternation_check or its values)."""
 
+    if not journal or not os.path.exists(journal):
+        return pd.DataFrame(columns=JOURNAL_COLUMNS)
 
+    entries = pd.read_csv(journal, sep=",", keep_default_na=False, dtype=str, on_bad_lines="skip")
 
+    #lines of a session ending while writing may be incomplete (e.g. "7,SCHEDULE,ye") and are skipped, as is any line merged
+    #with such a line (having too many fields)
+    labels = list(labels.values()) if isinstance(labels, dict) else list(labels)
+    complete = (entries["index"] != "") & (entries["timestamp"] != "") & entries["decision"].isin(labels)
 
+    return entries[complete].reset_index(drop=True)
 
+def replay(df, journal, labels=LABELS):
+    """Function applies the decisions recorded in the journal to df (in the order they were made, such that later decisions
+    override earlier ones for the same index) and returns it, e.g. to resume a session. Decisions not in labels are skipped
+    (see read_journal)."""
 
+    entries = read_journal(journal, labels)
 
+    if len(entries) == 0:
+        return df
 
+    df = df.copy()
 
+    #casting the indices of the journal to the type of the index of df
+    entries["index"] = entries["index"].astype(df.index.dtype)
 
+    #keeping only the last decision per index and alternation set
+    entries = entries.drop_duplicates(subset=["index", "alternation"], keep="last")
 
+    for alternation, decisions in entries.groupby("alternation", sort=False):
+        #decisions are strings, hence the column is cast to object (it is float if nothing has been annotated yet)
+        df[alternation] = df[alternation].astype(object) if alternation in df.columns else pd.NA
+        df.loc[decisions["index"].to_numpy(), alternation] = decisions["decision"].to_numpy()
 
+    return df
 
+def compact(journal, corpus_file, df=None, labels=LABELS):
+    """Function merges the journal into the annotated corpus file (csv) and empties the journal. The decisions are applied to df
+    (e.g. the DataFrame returned by alternation_check) or, if None, to the corpus read from corpus_file. The corpus file is replaced
+    atomically before the journal is emptied, hence an interrupted compaction can simply be repeated. Decisions not in labels are
+    skipped (see read_journal). Returns the annotated corpus."""
 
+    if df is None:
+        df = pd.read_csv(corpus_file, sep=",", index_col=0)
 
-    
-    
-    
\ No newline at end of file
+    df = replay(df, journal, labels)
+
+    #writing the corpus to a temporary file first, which then replaces the corpus file
+    df.to_csv(f"{corpus_file}.tmp")
+    os.replace(f"{corpus_file}.tmp", corpus_file)
+
+    if os.path.exists(journal):
+        os.remove(journal)
+
+    return df
@@ -0,0 +1,183 @@
+"""Opt-in instrumentation of the pipeline stages: if enabled, wall time, CPU time, peak RSS (resident memory) and the number of rows processed
+are recorded per stage (tagger, combiner, remap, visualisation.lemma, pipeline stages) and per interaction. Records can be saved as json or csv
+report (e.g. for tracking regressions across corpus versions) and hooks (e.g. a profiler, see cprofile_hook) can be attached to stages.
+
+Usage from a notebook: instrumentation.enable(), running the stages, then instrumentation.records() or instrumentation.report("report.json")
+Usage from the command line: setting the environment variable PERSISTENCE_INSTRUMENTATION=1 or running python pipeline.py VACC --report report.json"""
+
+import os, sys, json, time, platform, cProfile, pandas as pd
+from pathlib import Path
+from contextlib import contextmanager
+
+#resource is not available on Windows, where peak RSS is not recorded
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#instrumentation is disabled unless enabled explicitly or via the environment (which is inherited by worker processes)
+ENABLED = os.environ.get("PERSISTENCE_INSTRUMENTATION", "") not in ["", "0"]
+
+#columns of a record
+COLUMNS = ["stage", "interaction", "parent", "rows", "wall_seconds", "cpu_seconds", "peak_rss_mb", "pid"]
+
+#records of finished measurements, functions called at the start and end of each measurement, and the names of the currently measured stages
+RECORDS = []
+HOOKS = []
+_STAGES = []
+
+def enable():
+    """Function enables instrumentation."""
+
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    """Function disables instrumentation (records are kept until reset)."""
+
+    global ENABLED
+    ENABLED = False
+
+def reset():
+    """Function discards all records."""
+
+    RECORDS.clear()
+
+def add_hook(hook):
+    """Function attaches a hook, i.e., a function called with ("start", record) before and with ("end", record) after every measurement.
+    At the start, records only contain stage, interaction, parent and rows."""
+
+    HOOKS.append(hook)
+
+def remove_hook(hook):
+    """Function removes a hook attached by add_hook."""
+
+    HOOKS.remove(hook)
+
+def peak_rss():
+    """Function returns the peak RSS of the current process in MB (None if it cannot be determined)."""
+
+    if resource is None:
+        return None
+
+    #ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def start(stage, interaction=None, rows=None):
+    """Function starts measuring a stage (or a single interaction within a stage, if interaction is passed) and returns the measurement,
+    which is finished by stop. If instrumentation is disabled, None is returned (and stop does nothing)."""
+
+    if not ENABLED:
+        return None
+
+    record = {"stage": stage, "interaction": interaction, "parent": _STAGES[-1] if _STAGES else None, "rows": rows}
+
+    #measurements of whole stages are nested (e.g. the tagger within a pipeline stage), those of interactions are not
+    if interaction is None:
+        _STAGES.append(stage)
+
+    for hook in HOOKS:
+        hook("start", record)
+
+    record["_started"] = (time.perf_counter(), time.process_time())
+
+    return record
+
+def stop(record, rows=None):
+    """Function finishes a measurement started by start, optionally setting the number of rows processed (if unknown at the start)."""
+
+    if record is None:
+        return
+
+    wall, cpu = record.pop("_started")
+
+    record["wall_seconds"] = time.perf_counter() - wall
+    record["cpu_seconds"] = time.process_time() - cpu
+    record["peak_rss_mb"] = peak_rss()
+    record["pid"] = os.getpid()
+
+    if rows is not None:
+        record["rows"] = rows
+
+    if record["interaction"] is None and _STAGES and _STAGES[-1] == record["stage"]:
+        _STAGES.pop()
+
+    RECORDS.append(record)
+
+    for hook in HOOKS:
+        hook("end", record)
+
+@contextmanager
+def measure(stage, interaction=None, rows=None):
+    """Context manager measuring the enclosed code as stage (or interaction of a stage), see start. The record is yielded
+    (None if instrumentation is disabled), such that rows can be set once known."""
+
+    record = start(stage, interaction, rows)
+
+    try:
+        yield record
+    finally:
+        stop(record)
+
+def records():
+    """Function returns all records as DataFrame (one row per stage and interaction measured, in the order they finished)."""
+
+    records_df = pd.DataFrame(RECORDS, columns=COLUMNS).astype({"rows": "Int64"})
+
+    #keeping interaction ids as they are (numbers would otherwise become floats due to missing ids of whole stages)
+    records_df["interaction"] = pd.Series([record["interaction"] for record in RECORDS], dtype=object)
+
+    return records_df
+
+def summary():
+    """Function returns the records of whole stages only, i.e., without those of single interactions."""
+
+    stages = records()
+
+    return stages[stages["interaction"].isna()].reset_index(drop=True)
+
+def report(path, metadata={}):
+    """Function saves all records as json or csv file (depending on the suffix of path), together with metadata
+    (e.g. the corpus and its version), the date, the Python version and the platform."""
+
+    metadata = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(), "platform": platform.platform(), **metadata}
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    report_df = records()
+
+    if Path(path).suffix.lower() == ".csv":
+        #metadata are added as columns, such that reports of several runs can simply be concatenated
+        for key, value in metadata.items():
+            report_df.insert(0, key, value)
+        report_df.to_csv(path, index=False)
+
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"metadata": metadata, "records": json.loads(report_df.to_json(orient="records"))}, f, indent=1, default=str)
+
+def cprofile_hook(directory, stages=None):
+    """Function returns a hook (see add_hook) profiling stages with cProfile and saving the statistics as {directory}/{stage}.prof
+    (to be inspected e.g. with pstats or snakeviz). Only outermost stages are profiled, or those listed in stages."""
+
+    profiles = {}
+
+    def hook(event, record):
+
+        #skipping interactions as well as nested stages or stages not listed
+        selected = record["parent"] is None if stages is None else record["stage"] in stages
+        if record["interaction"] is not None or not selected:
+            return
+
+        if event == "start" and not profiles:
+            profiles[record["stage"]] = cProfile.Profile()
+            profiles[record["stage"]].enable()
+
+        elif event == "end" and record["stage"] in profiles:
+            profile = profiles.pop(record["stage"])
+            profile.disable()
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            profile.dump_stats(f"{directory}/{record['stage']}.prof")
+
+    return hook
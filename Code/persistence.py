@@ -1,7 +1,8 @@
-import pandas as pd
+import pandas as pd, numpy as np
 from tqdm import tqdm
+import storage, vocabulary, instrumentation
 
-def tagger(corpus, which_corpus, levels, output_destination, instructions=[], stopwords=[], speaker_A="A", speaker_B="S"):
+def tagger(corpus, which_corpus, levels, output_destination, instructions=[], stopwords=[], speaker_A="A", speaker_B="S", shared_vocabulary=None, window=150):
     """Function tags all tokens/ngrams within an interaction which are used by speaker A (by default, the voice assistant, but it can also be the
     human speaker if instances of quasi-persistence are to be tagged) and are subsequently re-used by speaker B (by default, the human speaker)
     within a range of 150 words (Szmrecsanyi, 2006), iff the given tokens/ngrams had not been introduced by speaker B in the preceding 150 words,
@@ -10,15 +11,23 @@ def tagger(corpus, which_corpus, levels, output_destination, instructions=[], st
 
     Both the "priming" tokens/ngrams used by speaker A ("first pair parts"/FPP) and the persistent tokens/ngrams uttered by speaker B 
     ("second pair parts"/SPP) are tagged; the distance measure is calculated for every combination of FPPs and SPPs, i.e., there can 
-    be one or multiple priming FPPs for one or multiple persistent SPPs within this range; finally outputting a new csv file.""" 
+    be one or multiple priming FPPs for one or multiple persistent SPPs within this range; finally outputting a new corpus file
+    (parquet, feather or csv, depending on the suffix of output_destination).""" 
 
     """Note: The algorithm iterates over tokens uttered by speaker A, looking back ensuring it was not previously introduced within dynamic 
     150-token threshold by speaker B AND looking forward checking whether it is re-used within a 150-token threshold by speaker B.
     One could also do it the other way around (starting with tokens uttered by speaker B, looking back checking whether they were introduced 
-    by speaker A within dynamic 150-token threshold)."""
+    by speaker A within dynamic 150-token threshold).
+    
+    Tokens/ngrams are compared as integer codes, derived from shared_vocabulary (see vocabulary.build) if passed, else from the corpus itself.
+    The window of 150 tokens can be modified using the parameter window."""
 
-    #creating a list of different interactions
-    interactions = list(set(corpus["interaction_id"]))
+    #measuring the stage, if instrumentation is enabled (see instrumentation)
+    measurement = instrumentation.start("tagger", rows=len(corpus))
+
+    #creating a list of different interactions as well as the positions of their rows in the corpus (computed once, see storage.partition)
+    interaction_positions = storage.partition(corpus)
+    interactions = list(interaction_positions)
 
     #creating empty list of instructions which, depending on the corpus, will be filled with relevant tokens to exclude from persistence-tagging 
     instructions_to_exclude = []
@@ -45,11 +54,30 @@ def tagger(corpus, which_corpus, levels, output_destination, instructions=[], st
     #iterating over the levels to tag persistences on
     for level in levels:
 
+        #encoding the tokens/ngrams of the given level as integers (using the shared vocabulary, if passed), 
+        #such that all comparisons below are integer comparisons rather than string comparisons
+        codes, strings = vocabulary.codes(corpus[level], shared_vocabulary)
+
+        #marking codes of stopwords and tokens tagged as non-identifiable, which are never tagged as persistent
+        skip_codes = np.array([token in stopwords or "non_identifiable_lemma" in token for token in strings], dtype=bool)
+
+        #codes of instructions are marked once per set of instructions (see below), as the same instructions are used for many interactions
+        instruction_codes = {}
+
+        #tags are collected in an array and written to the corpus once all interactions have been processed
+        #(an already existing column is kept, such that tags are only added)
+        if f"persistence_{level}" in corpus.columns:
+            tags = corpus[f"persistence_{level}"].to_numpy(dtype=object, copy=True)
+        else:
+            tags = np.full(len(corpus), np.nan, dtype=object)
+
         #iterating over interactions...
         for interaction in tqdm(sorted(interactions)):
 
             #..and creating a separate interaction DataFrame for each interaction
-            interaction_df = corpus[corpus["interaction_id"].astype(str) == str(interaction)]
+            positions = interaction_positions[interaction]
+            interaction_df = corpus.iloc[positions]
+            interaction_measurement = instrumentation.start("tagger", interaction, len(positions))
 
             #for RBC only, creating a DataFrame with the corresonding instructions for the given interaction
             if which_corpus == "RBC":
@@ -61,7 +89,7 @@ def tagger(corpus, which_corpus, levels, output_destination, instructions=[], st
                     instruction_last += 3
 
                 #creating a DataFrame with the corresponding instructions for a given interaction
-                instructions_df = corpus[corpus["interaction_id"] == f"Instructions {instruction_first} - {instruction_last}"]
+                instructions_df = corpus.iloc[interaction_positions.get(f"Instructions {instruction_first} - {instruction_last}", [])]
 
                 #creating a list with only unique tokens/ngrams
                 instructions_to_exclude = instructions_df.drop_duplicates(subset=[level], keep="last")[level].to_list()
@@ -84,78 +112,92 @@ def tagger(corpus, which_corpus, levels, output_destination, instructions=[], st
                     else: 
                         instructions_to_exclude = instructions[0]
 
-            #iterating over each row (i.e., each token) of the given interaction
-            for i, row in interaction_df.iterrows():
-
-                #If the token was produced by speaker_A, it is eligible for checking whether it has been re-used in the following by speaker_B
-                if row.speaker == speaker_A:
-            
-                    #determining the current index, needed for slicing 150-tokens-windows
-                    current_index = row.name
-
-                    #determining the current token
-                    token = row[level]
-
-                    #skipping if current token is in stopwords or was tagged as non-identifiable
-                    if token in stopwords or "non_identifiable_lemma" in token:
-                        continue
-
-                    #skipping relevant tokens from the instructions 
-                    if token in instructions_to_exclude:
+            #marking codes of the relevant tokens from the instructions (only strings can match, nested lists of ngrams never do),
+            #keyed by the tokens themselves, as the lists for RBC are built anew for every interaction
+            instruction_set = frozenset(token for token in instructions_to_exclude if isinstance(token, str))
+            if instruction_set not in instruction_codes:
+                instruction_codes[instruction_set] = np.array([token in instruction_set for token in strings], dtype=bool)
+            excluded_codes = skip_codes | instruction_codes[instruction_set]
+
+            #extracting the codes of the interaction, its indices (for slicing 150-tokens-windows) and speakers as arrays
+            interaction_codes = codes[positions]
+            indices = interaction_df.index.to_numpy()
+            speakers = interaction_df["speaker"].to_numpy(dtype=object)
+
+            #grouping the positions within the interaction by code, such that all instances of a token can be looked up at once
+            order = np.argsort(interaction_codes, kind="stable")
+            distinct_codes, starts = np.unique(interaction_codes[order], return_index=True)
+            instances = dict(zip(distinct_codes, np.split(order, starts[1:])))
+
+            #iterating over each token of the given interaction which was produced by speaker_A and is thus eligible 
+            #for checking whether it has been re-used in the following by speaker_B
+            for i in np.flatnonzero(speakers == speaker_A):
+
+                #determining the current code
+                code = interaction_codes[i]
+
+                #skipping if current token is in stopwords, was tagged as non-identifiable or is a relevant token from the instructions
+                if excluded_codes[code]:
+                    continue
+
+                #all instances of the current token in the interaction and the position of the current one among them
+                token_instances = instances[code]
+                current_instance = np.searchsorted(token_instances, i)
+
+                #determining the first instance of the current token in the 150-tokens-window preceding the current token
+                #(windows are based on indices like the former DataFrame slices and handle interaction boundaries)
+                window_start = np.searchsorted(indices, indices[i] - window)
+                first_instance = np.searchsorted(token_instances, window_start)
+
+                #...and if previous instances exist, ensuring the current token was introduced by speaker_A 
+                if first_instance < current_instance:
+
+                    #Dynamic backward condition:
+                    #Considering not just the immediate preceding_window, but also longer chains of reuse of the current token
+                    #by implementing a dynamic window expansion which iteratively moves back another 150 tokens
+                    #as long as instances of the current token exist. Iteration breaks when no more instances
+                    #of the current token are found within 150 tokens back, saving who produced it for the very first time.
+                    while True:
+
+                        #checking who introduced the current token in the preceding window
+                        introducer_preceding_window = speakers[token_instances[first_instance]]
+
+                        #moving the window to the 150 tokens before the currently first instance...
+                        window_start = np.searchsorted(indices, indices[token_instances[first_instance]] - window)
+                        #...and looking for previous instances of the current token in it
+                        previous_instance = np.searchsorted(token_instances, window_start)
+
+                        #...if they do not exist, breaking
+                        if previous_instance == first_instance: 
+                            break #yielding introducer_preceding_window from the first/previous preceding window
+
+                        #...else if they exist, continuing with the next iteration to check if the chain of reuse of current token stretches even further back
+                        first_instance = previous_instance
+
+                    #finally who introduced the current token for the very first time in the chain of reuse with never more than 150 tokens between each instance
+                    #ensuring the current token WAS introduced by speaker A (and not by speaker B or the confederate, if applicable)
+                    if introducer_preceding_window != speaker_A:
                         continue
 
-                    #creating 150-tokens-window preceding and following the current token
-                    #pandas handles DataFrame boundaries
-                    preceding_window = interaction_df.loc[current_index - 150:current_index - 1]
-                    following_window = interaction_df.loc[current_index + 1:current_index + 150]
-
-                    #filtering preceding_window for previous instances of the current token...
-                    same_token_preceding_window = preceding_window[preceding_window[level] == token]
-
-                    #...and if they exist, ensuring the current token was introduced by speaker_A 
-                    if len(same_token_preceding_window) > 0:
+                #determining the instances of the current token used by speaker B in the following 150-tokens-window
+                window_end = np.searchsorted(indices, indices[i] + window, side="right")
+                following_instances = token_instances[current_instance + 1:np.searchsorted(token_instances, window_end)]
+                following_B_instances = following_instances[speakers[following_instances] == speaker_B]
 
-                        #Dynamic backward condition:
-                        #Considering not just the immediate preceding_window, but also longer chains of reuse of the current token
-                        #by implementing a dynamic window expansion which iteratively moves back another 150 tokens
-                        #as long as instances of the current token exist. Iteration breaks when no more instances
-                        #of the current token are found within 150 tokens back, saving who produced it for the very first time.
-                        while True:
+                #If current token is re-used by speaker B...
+                if len(following_B_instances) > 0:
 
-                            #checking who introduced the current token in the preceding window
-                            introducer_preceding_window = same_token_preceding_window.speaker.iloc[0]
+                    #...tagging both the FPP...
+                    tags[positions[i]] = f"PER_FPP: {strings[code]}"
 
-                            #saving the index of the currently first instance...
-                            index_of_first_instance = same_token_preceding_window.iloc[0].name
+                    #...and SPP(s)
+                    tags[positions[following_B_instances]] = f"PER_SPP: {strings[code]}"
 
-                            #...and overwriting preceding_window from that index to 150 tokens before...
-                            preceding_window = interaction_df.loc[index_of_first_instance - 150:index_of_first_instance-1]
-                            #...filtering preceding_window again for previous instances of the current token...
-                            same_token_preceding_window = preceding_window[preceding_window[level] == token]
+            instrumentation.stop(interaction_measurement)
 
-                            #...if they do not exist, breaking
-                            if len(same_token_preceding_window) == 0: 
-                                break #yielding introducer_preceding_window from the first/previous preceding window
-
-                            #...else if they exist, continuing with the next iteration to check if the chain of reuse of current token stretches even further back
-
-                        #finally who introduced the current token for the very first time in the chain of reuse with never more than 150 tokens between each instance
-                        #ensuring the current token WAS introduced by speaker A (and not by speaker B or the confederate, if applicable)
-                        if introducer_preceding_window != speaker_A:
-                            continue
-
-                    #creating list of tokens used by speaker B in following_window
-                    following_B_tokens = following_window[following_window.speaker == speaker_B][level].to_list()
-
-                    #If current token is re-used by speaker B...
-                    if token in following_B_tokens:                 
-
-                        #...tagging both the FPP...
-                        corpus.loc[i, f"persistence_{level}"] = f"PER_FPP: {token}"
-                        
-                        #...and SPP(s)
-                        corpus.loc[following_window[(following_window.speaker == speaker_B) & 
-                                                (following_window[level] == token)].index, f"persistence_{level}"] = f"PER_SPP: {token}"
+        #writing tags to the corpus, if any
+        if not pd.isna(tags).all():
+            corpus[f"persistence_{level}"] = tags
 
         #in case no cases of persistence have been tagged, the corresponding column still needs to be created as downstream processing relies on such a column, even if empty
         if not f"persistence_{level}" in corpus.columns:
@@ -164,17 +206,30 @@ def tagger(corpus, which_corpus, levels, output_destination, instructions=[], st
         #outputting number of tagged cases of persistence
         print(f"Persistent SPP's on {level} level:", len(corpus[corpus[f"persistence_{level}"].fillna("").str.startswith("PER_SPP")]))
 
-    #saving DataFrame as csv file
-    corpus.to_csv(output_destination, index=False)
+    #saving DataFrame as corpus file
+    storage.write_corpus(corpus, output_destination, index=False)
+
+    instrumentation.stop(measurement)
 
-def combiner(path_to_input, destination, which_corpus):
-    """Function reads separately constructed files with tagged uni-, bi-, tri- and quadrigrams and unites all information into one file."""
+def combiner(path_to_input, destination, which_corpus, file_format="parquet", prefix="Persistence", shared_vocabulary=None):
+    """Function reads separately constructed files (of the given format) with tagged uni-, bi-, tri- and quadrigrams and unites all information 
+    into one file (parquet, feather or csv, depending on the suffix of destination). The prefix of the input files' names can be changed
+    (e.g. to "Quasi_persistence") to combine files tagged for quasi-persistence. Lemmata are compared as ids of the shared vocabulary
+    (see vocabulary.read), if passed, else as codes of the lemmata of the files."""
+
+    #measuring the stage, if instrumentation is enabled (see instrumentation)
+    measurement = instrumentation.start("combiner")
 
     #opening and reading the files separately
-    uni = pd.read_csv(f"{path_to_input}/Persistence_{which_corpus}_unigrams.csv", sep=",", na_filter=False, low_memory=False)
-    bi = pd.read_csv(f"{path_to_input}/Persistence_{which_corpus}_bigrams.csv", sep=",", na_filter=False, low_memory=False)
-    tri = pd.read_csv(f"{path_to_input}/Persistence_{which_corpus}_trigrams.csv", sep=",", na_filter=False, low_memory=False)
-    quadri = pd.read_csv(f"{path_to_input}/Persistence_{which_corpus}_quadrigrams.csv", sep=",", na_filter=False, low_memory=False)
+    uni = storage.read_corpus(storage.corpus_path(path_to_input, f"{prefix}_{which_corpus}_unigrams", file_format))
+    bi = storage.read_corpus(storage.corpus_path(path_to_input, f"{prefix}_{which_corpus}_bigrams", file_format))
+    tri = storage.read_corpus(storage.corpus_path(path_to_input, f"{prefix}_{which_corpus}_trigrams", file_format))
+    quadri = storage.read_corpus(storage.corpus_path(path_to_input, f"{prefix}_{which_corpus}_quadrigrams", file_format))
+
+    #encoding the lemmata of the unigrams and the first lemma of each ngram once, such that the alignment of the ngram-based DataFrames
+    #with the unified one (see below) is checked by comparing integers
+    first_lemmata = [df["lemma"].astype(str).str.split(" ", n=1).str[0] for df in [bi, tri, quadri]]
+    (uni["lemma_id"], bi["first_lemma_id"], tri["first_lemma_id"], quadri["first_lemma_id"]), _ = vocabulary.joint_codes(uni["lemma"], *first_lemmata, vocabulary=shared_vocabulary)
 
     #uniting the data happens in the DataFrame "uni" in four new columns
     #the columns are initialised as strings, because in case of overlapping tags, the second (and third, ...) tag
@@ -187,6 +242,9 @@ def combiner(path_to_input, destination, which_corpus):
     #creating a set of interaction ids...
     interaction_ids = uni["interaction_id"].unique()
 
+    #...and the positions of each interaction's rows in the four DataFrames (computed once, see storage.partition)
+    uni_positions, bi_positions, tri_positions, quadri_positions = [storage.partition(df) for df in [uni, bi, tri, quadri]]
+
     #in case of RBC, instructions are also part of the corpus, but these are disregarded as they were not tagged for persistence
     if which_corpus == "RBC":
         interaction_ids = [id_ for id_ in interaction_ids if not id_.startswith("Instructions")]
@@ -194,23 +252,28 @@ def combiner(path_to_input, destination, which_corpus):
     #...to iterate over
     for interaction_id in tqdm(interaction_ids):
 
-        #creating DataFrames containing only one interaction
-        interaction_df_uni = uni[uni["interaction_id"] == interaction_id]
-        interaction_df_bi = bi[bi["interaction_id"] == interaction_id]
-        interaction_df_tri = tri[tri["interaction_id"] == interaction_id]
-        interaction_df_quadri = quadri[quadri["interaction_id"] == interaction_id]
+        #creating DataFrames containing only one interaction (ngram-based DataFrames may lack interactions with very short turns only)
+        interaction_df_uni = uni.iloc[uni_positions[interaction_id]]
+        interaction_df_bi = bi.iloc[bi_positions.get(interaction_id, [])]
+        interaction_df_tri = tri.iloc[tri_positions.get(interaction_id, [])]
+        interaction_df_quadri = quadri.iloc[quadri_positions.get(interaction_id, [])]
+        interaction_measurement = instrumentation.start("combiner", interaction_id, len(interaction_df_uni))
 
         #creating a set of turn ids...
         turn_ids = interaction_df_uni["turn_id"].unique()
+
+        #...and the positions of each turn's rows within the interaction DataFrames
+        turn_positions_uni, turn_positions_bi, turn_positions_tri, turn_positions_quadri = [storage.partition(df, "turn_id") for df in 
+                                                                                           [interaction_df_uni, interaction_df_bi, interaction_df_tri, interaction_df_quadri]]
         
         #...to iterate over
         for turn_id in turn_ids:
 
             #creating DataFrames containing only one turn
-            turn_df_uni = interaction_df_uni[interaction_df_uni["turn_id"] == turn_id]
-            turn_df_bi = interaction_df_bi[interaction_df_bi["turn_id"] == turn_id]
-            turn_df_tri = interaction_df_tri[interaction_df_tri["turn_id"] == turn_id]
-            turn_df_quadri = interaction_df_quadri[interaction_df_quadri["turn_id"] == turn_id] 
+            turn_df_uni = interaction_df_uni.iloc[turn_positions_uni[turn_id]]
+            turn_df_bi = interaction_df_bi.iloc[turn_positions_bi.get(turn_id, [])]
+            turn_df_tri = interaction_df_tri.iloc[turn_positions_tri.get(turn_id, [])]
+            turn_df_quadri = interaction_df_quadri.iloc[turn_positions_quadri.get(turn_id, [])]
             
             #if any value in the column "persistence_lemma" in the unigrams DataFrame is of type string (empty values are NaN/float),
             #then there are persistence tags to add to the unified DataFrame
@@ -243,8 +306,8 @@ def combiner(path_to_input, destination, which_corpus):
                         #the tokens between this DataFrame and the unified one may not be aligned
                         #due to turns consisting of fewer tokens than the ngram of the respective DataFrame 
                         #in which case these DataFrames contain fewer rows and hence the alignment is disturbed
-                        #therefore checking whether the first word of the current ngram is the same as the word at the same index in the unified DataFrame
-                        if token.split()[0]!= uni.loc[index, "lemma"]:
+                        #therefore checking whether the first word of the current ngram is the same as the word at the same index in the unified DataFrame (by id)
+                        if turn_df_bi.iloc[i]["first_lemma_id"] != uni.loc[index, "lemma_id"]:
                             print(turn_df_uni.iloc[i], turn_df_bi.iloc[i])
                             raise Exception("Something's off!")
                         #depending on whether it is an FPP/SPP, writing this information  
@@ -271,8 +334,8 @@ def combiner(path_to_input, destination, which_corpus):
                         #the tokens between this DataFrame and the unified one may not be aligned
                         #due to turns consisting of fewer tokens than the ngram of the respective DataFrame 
                         #in which case these DataFrames contain fewer rows and hence the alignment is disturbed
-                        #therefore checking whether the first word of the current ngram is the same as the word at the same index in the unified DataFrame
-                        if token.split()[0]!= uni.loc[index, "lemma"]:
+                        #therefore checking whether the first word of the current ngram is the same as the word at the same index in the unified DataFrame (by id)
+                        if turn_df_tri.iloc[i]["first_lemma_id"] != uni.loc[index, "lemma_id"]:
                             print(turn_df_uni.iloc[i], turn_df_tri.iloc[i])
                             raise Exception("Something's off!")
                         #depending on whether it is an FPP/SPP, we write this information  
@@ -301,8 +364,8 @@ def combiner(path_to_input, destination, which_corpus):
                         #the tokens between this DataFrame and the unified one may not be aligned
                         #due to turns consisting of fewer tokens than the ngram of the respective DataFrame 
                         #in which case these DataFrames contain fewer rows and hence the alignment is disturbed
-                        #therefore checking whether the first word of the current ngram is the same as the word at the same index in the unified DataFrame
-                        if token.split()[0]!= uni.loc[index, "lemma"]:
+                        #therefore checking whether the first word of the current ngram is the same as the word at the same index in the unified DataFrame (by id)
+                        if turn_df_quadri.iloc[i]["first_lemma_id"] != uni.loc[index, "lemma_id"]:
                             print(turn_df_uni.iloc[i], turn_df_quadri.iloc[i])
                             raise Exception("Something's off!")
                         #depending on whether it is an FPP/SPP, we write this information  
@@ -320,14 +383,19 @@ def combiner(path_to_input, destination, which_corpus):
                             uni.loc[index+2, "persistence_quadrigrams_lemma"] += f"SPP_inside_{token}; " 
                             uni.loc[index+3, "persistence_quadrigrams_lemma"] += f"SPP_end_{token}; " 
 
+        instrumentation.stop(interaction_measurement)
+
     #stripping final semicola where no (further) overlapping tag was concatenated
     uni["persistence_bigrams_lemma"] = uni["persistence_bigrams_lemma"].str.rstrip("; ")
     uni["persistence_trigrams_lemma"] = uni["persistence_trigrams_lemma"].str.rstrip("; ")
     uni["persistence_quadrigrams_lemma"] = uni["persistence_quadrigrams_lemma"].str.rstrip("; ")
 
     #dropping the "persistence_lemma" column as this information is now preserved in the "persistence_unigrams_lemma" column
-    uni.drop(columns=["persistence_lemma"], inplace=True)
+    #(and the ids of lemmata, which were only needed for the alignment check)
+    uni.drop(columns=["persistence_lemma", "lemma_id"], inplace=True)
+
+    #and saving the DataFrame as a corpus file
+    storage.write_corpus(uni, destination)
 
-    #and saving the DataFrame as a csv file
-    uni.to_csv(destination)
+    instrumentation.stop(measurement, rows=len(uni))
 
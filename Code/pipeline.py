@@ -0,0 +1,343 @@
+"""A pipeline is a list of stages (see stage) which are run in the directory of a corpus (e.g. "VACC"). Before running a stage, a content hash
+of its code, its arguments (stopwords, instructions, speakers, window etc.) and its input files is calculated. Stages whose hash and outputs
+are unchanged since their last run are skipped; all other stages are run as soon as the stages producing their inputs are finished,
+independent stages (e.g. the taggers for different ngram sizes) concurrently in separate processes. Hashes are recorded in a manifest file
+in the corpus directory.
+
+Usage from a notebook (inside the corpus directory): pipeline.run(pipeline.corpus_pipeline("VACC"))
+Usage from the command line (inside the Code directory): python pipeline.py VACC --root ../VACC
+
+Stages can be instrumented (see instrumentation), e.g. pipeline.run(stages, instrument=True) followed by instrumentation.report("report.json"),
+or python pipeline.py VACC --root ../VACC --report report.json"""
+
+import os, sys, json, time, hashlib, inspect, argparse, subprocess, pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import preprocessing, persistence, visualisation, storage, vocabulary, instrumentation
+
+#name of the manifest file in which hashes of all stages are recorded
+MANIFEST = ".pipeline_manifest.json"
+
+#mapping ngram sizes to their names used in file names
+NGRAMS = {1: "unigrams", 2: "bigrams", 3: "trigrams", 4: "quadrigrams"}
+
+STOPLEMMAS = ['an', 'der', 'ein', 'es', 'für', 'haben', 'ich', 'in', 'mit',
+              'nicht', 'oder', 'sein', 'um', 'und', 'von', 'werden', 'zu']
+
+def stage(name, function, arguments, inputs=[], outputs=[], modules=None):
+    """Function declares a stage of a pipeline: function is called with arguments (a dictionary) and reads the files (or directories)
+    listed in inputs and writes those listed in outputs. Stages depend on the stages producing their inputs. modules are the modules
+    whose code function runs (by default the module it is defined in), e.g. [preprocessing] for the wrappers defined here."""
+
+    #modules are recorded by name, such that stages can be passed to worker processes
+    modules = [function.__module__] if modules is None else [module.__name__ for module in modules]
+
+    return {"name": name, "function": function, "arguments": arguments, "inputs": list(inputs), "outputs": list(outputs), "modules": modules}
+
+def tokenise(file, txt_file_for_tagger, tokens_file):
+    """Function wraps preprocessing.tokenise, saving the tokens for remapping (including turn boundary markers) as json file."""
+
+    tokens_for_remapping = preprocessing.tokenise(file, txt_file_for_tagger)
+
+    with open(tokens_file, "w", encoding="utf-8") as f:
+        json.dump(tokens_for_remapping, f, ensure_ascii=False)
+
+def rnn_tagger(command, txt_file_for_tagger, tagger_output):
+    """Function runs RNNTagger (or any other external command), which receives the paths of the tokens and of the tagger output as arguments."""
+
+    subprocess.run(f"{command} {txt_file_for_tagger} > {tagger_output}", shell=True, check=True)
+
+def remap(file, tagger_output, tokens_file, output_destination, which_corpus):
+    """Function wraps preprocessing.remap, reading the tokens for remapping from the json file written by tokenise."""
+
+    with open(tokens_file, encoding="utf-8") as f:
+        tokens_for_remapping = json.load(f)
+
+    preprocessing.remap(file, tagger_output, tokens_for_remapping, output_destination, which_corpus)
+
+def read_instructions(which_corpus, instruction_files):
+    """Function reads the instructions to be excluded from persistence tagging as done in the corpus notebooks."""
+
+    #for VACC, three files (instructions without and with confederate, visual schedule) are split into lemmata
+    if which_corpus == "VACC":
+        instructions = []
+        for instruction_file in instruction_files:
+            with open(instruction_file) as f:
+                instructions.append(f.read().split())
+        return instructions
+
+    #for VACW, there is one file with one lemma per line
+    if which_corpus == "VACW" and instruction_files:
+        with open(instruction_files[0]) as f:
+            return [line.strip("\n,'' ") for line in f.readlines()]
+
+    #for RBC, instructions are part of the corpus itself
+    return []
+
+def tag(file, output_destination, which_corpus, levels, instruction_files=[], stopwords=[], speaker_A="A", speaker_B="S", vocabulary_file=None, window=150):
+    """Function wraps persistence.tagger, reading the corpus, the instructions and the shared vocabulary from files."""
+
+    corpus = storage.read_corpus(file, index_col=0)
+    instructions = read_instructions(which_corpus, instruction_files)
+    shared_vocabulary = vocabulary.read(vocabulary_file) if vocabulary_file else None
+
+    persistence.tagger(corpus, which_corpus, levels, output_destination, instructions, stopwords, speaker_A, speaker_B, shared_vocabulary, window)
+
+def combine(path_to_input, destination, which_corpus, file_format="parquet", prefix="Persistence", vocabulary_file=None):
+    """Function wraps persistence.combiner, reading the shared vocabulary from its file."""
+
+    shared_vocabulary = vocabulary.read(vocabulary_file) if vocabulary_file else None
+
+    persistence.combiner(path_to_input, destination, which_corpus, file_format, prefix, shared_vocabulary)
+
+def corpus_pipeline(which_corpus, file_format="parquet", levels=["lemma"], stopwords=STOPLEMMAS, window=150, quasi_persistence=None, rnn_tagger_command=None, browser=False):
+    """Function declares the pipeline of the corpus notebooks for VACC, VACW or RBC (paths are relative to the corpus directory):
+    corpus creation, turn merging (VACC, RBC), tokenisation, RNNTagger (only if a command is passed, else its output has to exist),
+    remapping, ngram creation, persistence tagging for all ngram sizes, combining and visualisation, and, by default for VACC only,
+    quasi-persistence tagging and combining. If browser is True, the single-page browser (see visualisation.browser) is created as well."""
+
+    corpus_file = lambda name: storage.corpus_path("1_Corpus", name, file_format)
+    ngram_file = lambda n: storage.corpus_path("2_Preprocessed", f"RNN_{which_corpus}_{NGRAMS[n]}", file_format)
+    tagged_file = lambda prefix, n: storage.corpus_path("3_Persistence_tagged/single_ngrams", f"{prefix}_{which_corpus}_{NGRAMS[n]}", file_format)
+    combined_file = lambda prefix: storage.corpus_path("3_Persistence_tagged", f"{prefix}_{which_corpus}_all", file_format)
+    txt_file_for_tagger, tagger_output, tokens_file = "2_Preprocessed/Files/txt_file_for_tagger.txt", "2_Preprocessed/Files/RNN_tagged.txt", "2_Preprocessed/Files/tokens_for_remapping.json"
+
+    if quasi_persistence is None:
+        quasi_persistence = which_corpus == "VACC"
+
+    stages = []
+
+    #creating the corpus from the original files and, except for VACW, merging consecutive turns by the same speaker
+    if which_corpus == "VACC":
+        sources = ["1_Corpus/Original_files/Fertige_Transkripte/", "1_Corpus/Original_files/Fertige_Utterances/"]
+        stages.append(stage("file_creator", preprocessing.file_creator_vacc, {"root_transcripts": sources[0], "root_speakers": sources[1], "output_destination": corpus_file(f"Corpus_{which_corpus}")}, sources, [corpus_file(f"Corpus_{which_corpus}")]))
+    elif which_corpus == "RBC":
+        sources = ["1_Corpus/Original_files/Transkripte/", "1_Corpus/Original_files/Utterances/"]
+        stages.append(stage("file_creator", preprocessing.file_creator_rbc, {"root_transcripts": sources[0], "root_speakers": sources[1], "output_destination": corpus_file(f"Corpus_{which_corpus}")}, sources, [corpus_file(f"Corpus_{which_corpus}")]))
+    elif which_corpus == "VACW":
+        sources = [f"1_Corpus/Original_files/{which_corpus}.xlsx"]
+        stages.append(stage("file_creator", preprocessing.file_creator_vacw, {"excel_file": sources[0], "output_destination": corpus_file(f"Corpus_{which_corpus}")}, sources, [corpus_file(f"Corpus_{which_corpus}")]))
+    else:
+        raise ValueError(f"Unknown corpus '{which_corpus}', use VACC, VACW or RBC")
+
+    if which_corpus == "VACW":
+        tokenised_file = corpus_file(f"Corpus_{which_corpus}")
+    else:
+        tokenised_file = corpus_file(f"Corpus_merged_turns_{which_corpus}")
+        stages.append(stage("turn_merger", preprocessing.turn_merger, {"file": corpus_file(f"Corpus_{which_corpus}"), "output_destination": tokenised_file}, [corpus_file(f"Corpus_{which_corpus}")], [tokenised_file]))
+
+    #tokenising, (optionally) running RNNTagger and remapping its output to the corpus
+    stages.append(stage("tokenise", tokenise, {"file": tokenised_file, "txt_file_for_tagger": txt_file_for_tagger, "tokens_file": tokens_file}, [tokenised_file], [txt_file_for_tagger, tokens_file], [preprocessing]))
+
+    if rnn_tagger_command:
+        stages.append(stage("rnn_tagger", rnn_tagger, {"command": rnn_tagger_command, "txt_file_for_tagger": txt_file_for_tagger, "tagger_output": tagger_output}, [txt_file_for_tagger], [tagger_output], []))
+
+    stages.append(stage("remap", remap, {"file": tokenised_file, "tagger_output": tagger_output, "tokens_file": tokens_file, "output_destination": ngram_file(1), "which_corpus": which_corpus},
+                        [tokenised_file, tagger_output, tokens_file], [ngram_file(1), vocabulary.path_for(ngram_file(1))], [preprocessing]))
+
+    stages.append(stage("ngrammer", preprocessing.ngrammer, {"file": ngram_file(1), "which_corpus": which_corpus, "file_format": file_format}, [ngram_file(1)], [ngram_file(n) for n in range(2, 5)]))
+
+    #defining instructions as in the corpus notebooks (for VACW, only unigrams are filtered)
+    instruction_files = {"VACC": ["Instructions/Lemmata_in_instructions_without_confederate.txt", "Instructions/Lemmata_in_instructions_with_confederate.txt", "Instructions/Lemmata_in_visual_schedule.txt"],
+                         "VACW": ["Instructions/lemmatised_quiz_questions.txt"], "RBC": []}[which_corpus]
+
+    #tagging persistence (and quasi-persistence, switching direction from voice assistant to human speaker) for all ngram sizes
+    directions = [("Persistence", "A", "S")] + ([("Quasi_persistence", "S", "A")] if quasi_persistence else [])
+
+    for prefix, speaker_A, speaker_B in directions:
+        for n in NGRAMS:
+            instructions = instruction_files if n == 1 or which_corpus == "VACC" else []
+            arguments = {"file": ngram_file(n), "output_destination": tagged_file(prefix, n), "which_corpus": which_corpus, "levels": levels,
+                         "instruction_files": instructions, "stopwords": stopwords if n == 1 else [], "speaker_A": speaker_A, "speaker_B": speaker_B,
+                         "vocabulary_file": vocabulary.path_for(ngram_file(1)), "window": window}
+            stages.append(stage(f"tagger_{prefix.lower()}_{NGRAMS[n]}", tag, arguments, [ngram_file(n), vocabulary.path_for(ngram_file(1))] + instructions, [tagged_file(prefix, n)], [persistence, vocabulary, storage]))
+
+        stages.append(stage(f"combiner_{prefix.lower()}", combine,
+                            {"path_to_input": "3_Persistence_tagged/single_ngrams", "destination": combined_file(prefix), "which_corpus": which_corpus, "file_format": file_format, "prefix": prefix,
+                             "vocabulary_file": vocabulary.path_for(ngram_file(1))},
+                            [tagged_file(prefix, n) for n in NGRAMS] + [vocabulary.path_for(ngram_file(1))], [combined_file(prefix)], [persistence, vocabulary, storage]))
+
+    #visualising persistence
+    stages.append(stage("visualisation", visualisation.lemma, {"which_corpus": which_corpus, "path_to_input": "3_Persistence_tagged", "destination": "3_Persistence_tagged/visualisation", "file_format": file_format},
+                        [combined_file("Persistence")], ["3_Persistence_tagged/visualisation"]))
+
+    if browser:
+        stages.append(stage("browser", visualisation.browser, {"which_corpus": which_corpus, "path_to_input": "3_Persistence_tagged", "destination": "3_Persistence_tagged/browser", "file_format": file_format},
+                            [combined_file("Persistence")], ["3_Persistence_tagged/browser"]))
+
+    return stages
+
+def file_hash(path):
+    """Function returns the sha256 hash of the contents of a file or, recursively, of a directory (including file names)."""
+
+    hash_ = hashlib.sha256()
+    path = Path(path)
+
+    files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+
+    for file in files:
+        hash_.update(str(file.relative_to(path) if path.is_dir() else "").encode())
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hash_.update(chunk)
+
+    return hash_.hexdigest()
+
+def module_dependencies(modules):
+    """Function returns the given modules (names) and, recursively, the modules of this repository they import (i.e., those in the
+    directory of this module, e.g. storage for persistence), sorted by name."""
+
+    directory = Path(__file__).resolve().parent
+    found, pending = {}, [sys.modules[module] for module in modules]
+
+    while pending:
+        module = pending.pop()
+        if module.__name__ in found:
+            continue
+        found[module.__name__] = module
+        pending.extend(value for value in vars(module).values()
+                       if inspect.ismodule(value) and getattr(value, "__file__", None) and Path(value.__file__).resolve().parent == directory)
+
+    return [found[name] for name in sorted(found)]
+
+def stage_hash(stage):
+    """Function returns the content hash of a stage, i.e., of the source code of its function, of the module it is defined in and
+    of the modules it runs (see stage) including their dependencies in this repository, its arguments and the contents of its input files."""
+
+    hash_ = hashlib.sha256()
+
+    #changes to the code of the function, the module it is defined in or the modules it runs (e.g. persistence for the tagger
+    #stages, whose function is a wrapper defined here) invalidate the stage
+    hash_.update(inspect.getsource(sys.modules[stage["function"].__module__]).encode())
+    hash_.update(stage["function"].__qualname__.encode())
+
+    for module in module_dependencies(stage.get("modules", [])):
+        hash_.update(module.__name__.encode())
+        hash_.update(inspect.getsource(module).encode())
+
+    #arguments are hashed as sorted json, such that their order is irrelevant
+    hash_.update(json.dumps(stage["arguments"], sort_keys=True, default=str).encode())
+
+    for path in stage["inputs"]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Input '{path}' of stage '{stage['name']}' does not exist (e.g. RNNTagger output has to be created first)")
+        hash_.update(path.encode())
+        hash_.update(file_hash(path).encode())
+
+    return hash_.hexdigest()
+
+def _run_stage(stage, instrument=False):
+    """Function runs a single stage (in a worker process) and returns its duration in seconds as well as,
+    if instrument is True, the records of the stage and its interactions (see instrumentation)."""
+
+    if instrument:
+        instrumentation.enable()
+        instrumentation.reset()
+
+    start = time.perf_counter()
+    with instrumentation.measure(stage["name"]):
+        stage["function"](**stage["arguments"])
+
+    return time.perf_counter() - start, list(instrumentation.RECORDS) if instrument else []
+
+def run(stages, root=".", processes=None, force=[], dry_run=False, instrument=False):
+    """Function runs a pipeline inside the directory root, skipping stages whose content hash and outputs are unchanged since their
+    last run (unless their names are listed in force) and running independent stages concurrently in up to processes worker processes.
+    If dry_run is True, only the stages which would be run are determined. Returns a DataFrame with the status and duration of each stage.
+
+    If instrument is True, the stages which are run are instrumented and their records are added to those of instrumentation in this process
+    (see instrumentation.records and instrumentation.report). Each stage is then run in a new worker process, such that peak RSS is per stage."""
+
+    previous_directory = os.getcwd()
+    os.chdir(root)
+
+    try:
+        #reading the manifest of previous runs, if any
+        manifest = {}
+        if os.path.exists(MANIFEST):
+            with open(MANIFEST, encoding="utf-8") as f:
+                manifest = json.load(f)
+
+        #determining for each stage the stages producing its inputs
+        producers = {output: stage["name"] for stage in stages for output in stage["outputs"]}
+        dependencies = {stage["name"]: set(producers[path] for path in stage["inputs"] if path in producers) for stage in stages}
+
+        pending, running, finished, report = list(stages), {}, set(), []
+
+        with ProcessPoolExecutor(max_workers=processes, max_tasks_per_child=1 if instrument else None) as executor:
+
+            while pending or running:
+
+                #submitting (or skipping) all stages whose dependencies are finished
+                for stage in [stage for stage in pending if dependencies[stage["name"]] <= finished]:
+
+                    pending.remove(stage)
+                    record = manifest.get(stage["name"], {})
+
+                    #in a dry run, stages depending on stages which would be run are assumed to be run as well
+                    if dry_run and any(entry["name"] in dependencies[stage["name"]] and entry["status"] == "run" for entry in report):
+                        report.append({"name": stage["name"], "status": "run", "seconds": 0.0})
+                        finished.add(stage["name"])
+                        continue
+
+                    hash_ = stage_hash(stage)
+
+                    #skipping the stage if neither its code, its arguments nor its inputs changed and its outputs are still as written
+                    outputs_valid = all(os.path.exists(output) and record.get("outputs", {}).get(output) == file_hash(output) for output in stage["outputs"])
+                    if record.get("hash") == hash_ and outputs_valid and stage["name"] not in force:
+                        report.append({"name": stage["name"], "status": "skipped", "seconds": 0.0})
+                        finished.add(stage["name"])
+                        continue
+
+                    if dry_run:
+                        report.append({"name": stage["name"], "status": "run", "seconds": 0.0})
+                        finished.add(stage["name"])
+                        continue
+
+                    running[executor.submit(_run_stage, stage, instrument)] = (stage, hash_)
+
+                if not running:
+                    continue
+
+                #waiting for at least one running stage to finish and recording its hash and outputs in the manifest
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    stage, hash_ = running.pop(future)
+                    seconds, records = future.result()
+                    instrumentation.RECORDS.extend(records)
+
+                    manifest[stage["name"]] = {"hash": hash_, "outputs": {output: file_hash(output) for output in stage["outputs"]}}
+                    with open(MANIFEST, "w", encoding="utf-8") as f:
+                        json.dump(manifest, f, indent=1)
+
+                    report.append({"name": stage["name"], "status": "run", "seconds": round(seconds, 2)})
+                    finished.add(stage["name"])
+
+    finally:
+        os.chdir(previous_directory)
+
+    return pd.DataFrame(report, columns=["name", "status", "seconds"])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Runs the preprocessing and persistence tagging pipeline of a corpus, skipping unchanged stages.")
+    parser.add_argument("which_corpus", choices=["VACC", "VACW", "RBC"])
+    parser.add_argument("--root", default=".", help="directory of the corpus (e.g. ../VACC)")
+    parser.add_argument("--file-format", default="parquet", choices=["parquet", "feather", "partitioned", "csv"])
+    parser.add_argument("--window", type=int, default=150, help="window in tokens for persistence tagging")
+    parser.add_argument("--processes", type=int, default=None, help="maximum number of stages running concurrently")
+    parser.add_argument("--rnn-tagger", default=None, help="command running RNNTagger (else its output has to exist)")
+    parser.add_argument("--force", nargs="*", default=[], help="names of stages to run even if unchanged")
+    parser.add_argument("--dry-run", action="store_true", help="only list which stages would be run")
+    parser.add_argument("--browser", action="store_true", help="also create the single-page browser of all interactions")
+    parser.add_argument("--report", default=None, help="json or csv file to save timing and memory records of all stages run to (see instrumentation)")
+    args = parser.parse_args()
+
+    stages = corpus_pipeline(args.which_corpus, file_format=args.file_format, window=args.window, rnn_tagger_command=args.rnn_tagger, browser=args.browser)
+
+    print(run(stages, args.root, args.processes, args.force, args.dry_run, instrument=args.report is not None).to_string(index=False))
+
+    if args.report:
+        instrumentation.report(args.report, {"corpus": args.which_corpus, "file_format": args.file_format, "window": args.window})
+        print(instrumentation.summary().to_string(index=False))
@@ -1,10 +1,12 @@
 import os, pandas as pd, csv, sys, re, time, numpy, json
 from pathlib import Path
 from tqdm import tqdm
+import storage, vocabulary, instrumentation
 
 def file_creator_vacc(root_transcripts, root_speakers, output_destination):
-    """Function takes paths to two directories and creates a csv file containing contents from the directories and its
-    subdirectories, namely the transcripts of interactions with the voice assistant, where each turn becomes one row"""
+    """Function takes paths to two directories and creates a corpus file (parquet, feather or csv, depending on the suffix of
+    output_destination) containing contents from the directories and its subdirectories, namely the transcripts of interactions
+    with the voice assistant, where each turn becomes one row"""
     
     #creating empty DataFrame with relevant columns
     vacc = pd.DataFrame({}, columns=["id", "participant_id", "setting", "interaction_id", "turn_id", "speaker", "start", "end", "turn"])
@@ -96,12 +98,12 @@ def file_creator_vacc(root_transcripts, root_speakers, output_destination):
     #setting index
     vacc.set_index("id", inplace=True)
 
-    #outputting DataFrame as csv file
-    vacc.to_csv(output_destination)
+    #outputting DataFrame as corpus file
+    storage.write_corpus(vacc, output_destination)
 
 def file_creator_vacw(excel_file, output_destination):
-    """Function takes path to xlsx file and creates csv file where each row contains one turn by
-    the human speaker or the voice assistant."""
+    """Function takes path to xlsx file and creates a corpus file (parquet, feather or csv, depending on the suffix of 
+    output_destination) where each row contains one turn by the human speaker or the voice assistant."""
 
     #reading in xlsx file as DataFrame
     vacw = pd.read_excel(excel_file, parse_dates=["Zeitstempel"])
@@ -177,12 +179,13 @@ def file_creator_vacw(excel_file, output_destination):
     #resetting index
     vacw_output.set_index("id", inplace=True) 
 
-    #outputting as csv file
-    vacw_output.to_csv(output_destination)
+    #outputting as corpus file
+    storage.write_corpus(vacw_output, output_destination)
 
 def file_creator_rbc(root_transcripts, root_speakers, output_destination):
-    """Function takes paths to two directories and creates a csv file containing contents from the directories and its
-    subdirectories, namely the transcripts of interactions, where each turn becomes one row"""
+    """Function takes paths to two directories and creates a corpus file (parquet, feather or csv, depending on the suffix of
+    output_destination) containing contents from the directories and its subdirectories, namely the transcripts of interactions, 
+    where each turn becomes one row"""
     
     #creating empty DataFrame with relevant columns
     rbc = pd.DataFrame({}, columns=["id", "participant_id", "setting", "interaction_id", "turn_id", "speaker", "start", "end", "turn"])
@@ -322,16 +325,15 @@ def file_creator_rbc(root_transcripts, root_speakers, output_destination):
     #setting index
     rbc.set_index("id", inplace=True)
 
-    #outputting DataFrame as csv file
-    rbc.to_csv(output_destination)
+    #outputting DataFrame as corpus file
+    storage.write_corpus(rbc, output_destination)
                    
 def turn_merger(file, output_destination):
     """Function takes corpus with turns from interactions with the voice assistant and merges consecutive turns made by the same speaker
-    into one turn, adjusting times and ids and outputting a new csv file"""
+    into one turn, adjusting times and ids and outputting a new corpus file"""
 
     #reading input file
-    with open(file) as f:
-        corpus = pd.read_csv(f, index_col=0)
+    corpus = storage.read_corpus(file, index_col=0)
     
     #creating empty DataFrame
     turns_merged = pd.DataFrame({}, columns=["id", "participant_id", "setting", "interaction_id", "turn_id", "speaker", "start", "end", "turn", "merged"])
@@ -487,8 +489,8 @@ def turn_merger(file, output_destination):
     #resetting index 
     turns_merged.set_index("id", inplace=True)
 
-    #outputting DataFrame as csv file
-    turns_merged.to_csv(output_destination)
+    #outputting DataFrame as corpus file
+    storage.write_corpus(turns_merged, output_destination)
 
 def tokenise(file, txt_file_for_tagger):
     """Function tokenises file in a streamlined way and outputs the tokens including a turn boundary
@@ -498,7 +500,7 @@ def tokenise(file, txt_file_for_tagger):
     with open(txt_file_for_tagger, "w", encoding="utf-8") as g:
         
         #reading in the corpus as DataFrame
-        corpus = pd.read_csv(file, index_col=0)
+        corpus = storage.read_corpus(file, index_col=0)
         
         #initialising a list to which all tokens will be appended
         all_tokens = []
@@ -534,10 +536,14 @@ def tokenise(file, txt_file_for_tagger):
 
 def remap(file, tagger_output, tokens_for_remapping, output_destination, which_corpus):
     """Function remaps tagged tokens to their respective turn (i.e., it unites the tokens
-    with the rest of the corpus), outputting a csv file that is now enriched with lemmata"""
+    with the rest of the corpus), outputting a corpus file that is now enriched with lemmata
+    as well as the shared vocabulary of the corpus (see vocabulary.build)"""
+
+    #measuring the stage, if instrumentation is enabled (see instrumentation)
+    measurement = instrumentation.start("remap")
 
     #reading in the corpus
-    corpus = pd.read_csv(file, index_col=0)
+    corpus = storage.read_corpus(file, index_col=0)
 
     #reuniting tagged tokens with rest of corpus
     with open(tagger_output) as g:
@@ -657,11 +663,17 @@ def remap(file, tagger_output, tokens_for_remapping, output_destination, which_c
     #resetting index to "id" column
     corpus_per_token.set_index("id", inplace=True)
 
-    #outputting DataFrame as csv file
-    corpus_per_token.to_csv(output_destination)
+    #outputting DataFrame as corpus file
+    storage.write_corpus(corpus_per_token, output_destination)
+
+    #building the shared vocabulary of words and lemmata (also used for all ngram-based corpora) and saving it alongside the corpus file
+    vocabulary.write(vocabulary.build(corpus_per_token), vocabulary.path_for(output_destination))
 
-def ngrammer(file, which_corpus):
-    """Function creates bi-, tri-, and quadrigram-based corpora and saves them in separate files"""
+    #counting the remapped tokens as rows processed (tokens_for_remapping also contains the "NEW TURN!!" markers)
+    instrumentation.stop(measurement, rows=len(corpus_per_token))
+
+def ngrammer(file, which_corpus, file_format="parquet"):
+    """Function creates bi-, tri-, and quadrigram-based corpora and saves them in separate files of the given format"""
     
     number_name = {2: "bigrams", 3: "trigrams", 4: "quadrigrams"} #dictionary for mapping numbers to respective names
 
@@ -670,10 +682,8 @@ def ngrammer(file, which_corpus):
 
         print(number_name[n])
         
-        #reading in corpus
-        corpus = pd.read_csv(file, sep=",", na_filter=False)
-
-        corpus[["word", "lemma"]] = corpus[["word", "lemma"]].astype(str) #ensuring column types
+        #reading in corpus (column types of "word" and "lemma" are ensured by the storage schema)
+        corpus = storage.read_corpus(file)
         
         assert corpus.lemma.isna().sum() + corpus.word.isna().sum() == 0 #ensuring non-empty columns
 
@@ -709,7 +719,7 @@ def ngrammer(file, which_corpus):
 
         #overwriting supercorpus with supercorpus_ngram with dropped NaN values
         #(which came into being at turn_id boundaries where the length of the ngram < n)
-        corpus = corpus.dropna()
+        corpus = corpus.dropna(subset=["word", "lemma"])
 
-        #outputting as csv file
-        corpus.to_csv(f"2_Preprocessed/RNN_{which_corpus}_{number_name[n]}.csv", index=False)
\ No newline at end of file
+        #outputting as corpus file
+        storage.write_corpus(corpus, storage.corpus_path("2_Preprocessed", f"RNN_{which_corpus}_{number_name[n]}", file_format), index=False)
\ No newline at end of file
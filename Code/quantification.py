@@ -1,10 +1,22 @@
-import pandas as pd, numpy as np, warnings, matplotlib.pyplot as plt, plotly.graph_objects as go
+import os, json, time, hashlib, pandas as pd, numpy as np, warnings, storage, vocabulary
 warnings.filterwarnings('ignore') 
-from IPython.display import display
+from concurrent.futures import ProcessPoolExecutor
 
-def prepare_data_for_modeling(df, alternating, extract_lemma_from="lemma", include_quasi_p=False, restrict=None, beta_variants=None, drop_conf=True):
+#hash of this module, such that changes of the computation of variation samples invalidate cached ones (see cached_variation_sample)
+MODULE_HASH = hashlib.sha256(open(__file__, "rb").read()).hexdigest()
+
+#name of the manifest file of the cache of variation samples, recording the parameters and interaction hashes of each entry
+CACHE_MANIFEST = ".manifest.json"
+
+#columns of variation samples which are exported as factors (categorical columns), see export_variation_sample
+FACTORS = ["CURRENT", "PREVIOUS", "PREVIOUS_SPEAKER", "HUMAN_ID", "INTERACTION_ID", "CORPUS"]
+
+def prepare_data_for_modeling(df, alternating, extract_lemma_from="lemma", include_quasi_p=False, restrict=None, beta_variants=None, drop_conf=True, window=25, save_to=None):
     """Function extracts or calculates all relevant variables (e.g., which variant was used in the previous slot? by who?) for each annotated choice context,
-    outputting a so-called variation sample that can be used for modelling as well as descriptive statistics."""
+    outputting a so-called variation sample that can be used for modelling as well as descriptive statistics. Beta persistence and quasi-persistence
+    are determined within the window of the last 25 tokens by default; if a list of window sizes is passed, they are determined for each of them
+    (columns being suffixed by the window size, e.g. QUASI_PERSISTENCE_10). If save_to is passed, the variation sample is also exported
+    to this path (see export_variation_sample)."""
 
     #creating a separate column with id's for each token out of the index (needed below)
     df["id"] = df.index
@@ -24,93 +36,46 @@ def prepare_data_for_modeling(df, alternating, extract_lemma_from="lemma", inclu
     indices_CURRENT = variation_sample.id #extracting indices from column "id" for each CURRENT
     indices_CURRENT.reset_index(drop=True, inplace=True) #resetting index to allow for iteration over it below
 
-    """depending on arguments, initialising empty lists to save values for potentially influencing predictor variables:
+    """depending on arguments, determining values for potentially influencing predictor variables:
     previous_variant represents the variant, if any, that was used at the previous opportunity ("NONE" if there was no previous use within the same interaction),
     previous_speaker represents who uttered previous_variant (if it exists), i.e., the human speaker or the voice assistant (or the confederate),
     previous_distance respresent the distance in tokens between CURRENT and previous_variant (if it exists),
-    (optional) quasi-persistence represents whether the voice assistant produced at least one instance of quasi-persistence (of any kind, not just variants of the alternation set) in the preceding 25 tokens
-    (optional) previous_beta_true_or_false_{variant} represents whether the given variant was uttered in the 25 words prior to CURRENT"""
-
-    #initialising empty lists to which the relevant values will be appended
-    previous_variant, previous_speaker, previous_distance = [], [], []
-    
-    #if quasi-persistence should be included, an empty list is initialised for that as well
-    if include_quasi_p:
-        quasi_persistence = []
+    (optional) quasi-persistence represents whether the voice assistant produced at least one instance of quasi-persistence (of any kind, not just variants of the alternation set) in the preceding 25 tokens (or window)
+    (optional) previous_beta_{variant} represents whether the given variant was uttered (as non-alternating) in the 25 words (or window) prior to CURRENT"""
 
-    #if beta persistence variants are passed, creating an empty dictionary with entries for each variant 
-    if not beta_variants == None:
-        previous_beta_true_or_false = {}
-        for variant in beta_variants:
-            previous_beta_true_or_false[f'previous_beta_{variant}'] = []
-
-    #iterating over the extracted indices in variation_sample (see above)
-    for i in range(len(indices_CURRENT)):
-        
-        #extracting current interaction id and first index in that current interaction,
-        #in order to set a lower index boundary for where to look for PREVIOUS, see below
-        current_interaction_id = df[df.id==indices_CURRENT[i]].interaction_id.values[0]
-        first_index_in_current_interaction = df[df.interaction_id==current_interaction_id].id.head(1).values[0]
-        
-        #creating a range from first index in current interaction to (but excluding) index of current CURRENT
-        last_tokens_range = range(first_index_in_current_interaction, indices_CURRENT[i]) 
-        #creating a sub-DataFrame containing only tokens within that range 
-        last_tokens = df[df.id.isin(last_tokens_range)]           
-
-        #filtering last_tokens to only include alternating tokens and extracting the most recent one, i.e., the last row (tail(1))
-        previous = last_tokens[~(last_tokens[alternating]=="no")].tail(1)  
-
-        #if there is no previous variant, "NONE"/0 is appended to the relevant lists 
-        if len(previous) == 0: 
-            previous_variant.append("NONE") 
-            previous_speaker.append("NONE") 
-            previous_distance.append(0)
-
-        #else the given previous variant, its speaker and the distance are appended to the relevant lists
-        else: 
-            previous_variant.append(previous[extract_lemma_from].values[0])
-            previous_speaker.append(previous.speaker.values[0])
-            previous_distance.append(indices_CURRENT[i]-previous.id.values[0]) #subtracting index of the previous variant from the index of CURRENT to calculate distance in tokens
-        
-        #for beta persistence and quasi-persistence, creating a DataFrame containing only the last 25 tokens (or fewer if this window crosses interaction boundaries)
-        if indices_CURRENT[i]-25 < first_index_in_current_interaction:
-            twentyfive_last_tokens_range = range(first_index_in_current_interaction, indices_CURRENT[i])
-            twentyfive_last_tokens = df[df.id.isin(twentyfive_last_tokens_range)] 
-        else:
-            twentyfive_last_tokens_range = range(indices_CURRENT[i]-25, indices_CURRENT[i])
-            twentyfive_last_tokens = df[df.id.isin(twentyfive_last_tokens_range)]  
-
-        #checking for each non-alternating beta variant if it appears in the last 25 tokens...
-        if not beta_variants == None:
-            previous_beta = {}
-            for variant in beta_variants:
-                #filtering twentyfive_last_tokens to only include words that can alternate but do not do that in the given instance and extracting the last row
-                previous_beta[f"previous_beta_{variant}"] = twentyfive_last_tokens[(twentyfive_last_tokens.lemma == variant)&(twentyfive_last_tokens[alternating]=="no")].tail(1)
-
-        #...and appending True or False for each beta variant, depending on whether it was present in the last 25 tokens
-        if not beta_variants == None:
-            for variant in beta_variants:
-                if len(previous_beta[f"previous_beta_{variant}"]) == 0: 
-                    previous_beta_true_or_false[f'previous_beta_{variant}'].append(False)
-                else:
-                    previous_beta_true_or_false[f'previous_beta_{variant}'].append(True)
-
-        #if quasi-persistence should be included, True is appended to the relevant list if any of the values in twentyfive_last_tokens["quasi_persistence"] is True
-        if include_quasi_p:
-            quasi_persistence.append((twentyfive_last_tokens["quasi_persistence"] == True).any())
+    #determining previous variant, speaker and distance for all choice contexts at once (see previous_variants)
+    previous_variant, previous_speaker, previous_distance = previous_variants(df, indices_CURRENT, alternating, extract_lemma_from)
 
     #creating new columns in variation_sample with streamlined naming
     variation_sample["PREVIOUS"] = previous_variant
     variation_sample["PREVIOUS_SPEAKER"] = previous_speaker
     variation_sample["PREVIOUS_DISTANCE"] = previous_distance
 
-    #also creating columns for quasi-persistence and beta persistence, if these should be included
-    if include_quasi_p:
-        variation_sample["QUASI_PERSISTENCE"] = quasi_persistence
+    #window sizes for beta persistence and quasi-persistence (columns are only suffixed by the window size if several may be passed, i.e., a list)
+    windows = window if isinstance(window, list) else [window]
+    suffixes = {k: f"_{k}" if isinstance(window, list) else "" for k in windows}
 
+    #for beta persistence, counting for each non-alternating beta variant how often it appears within the window before CURRENT
+    #(within the same interaction, see window_counts), all windows at once, and creating a column with True or False for each variant
+    #(lemmata are encoded once, such that each variant is matched by comparing integer codes, see vocabulary.codes)
+    beta_columns = []
     if not beta_variants == None:
+        lemma_codes, strings = vocabulary.codes(df.lemma)
+        non_alternating = (df[alternating] == "no").to_numpy()
         for variant in beta_variants:
-            variation_sample[f"PREVIOUS_BETA_{variant.upper()}"] = previous_beta_true_or_false[f'previous_beta_{variant}']
+            code = strings.index(variant) if variant in strings else -1
+            counts = window_counts(df, indices_CURRENT, (lemma_codes == code) & non_alternating, windows)
+            for k in windows:
+                variation_sample[f"PREVIOUS_BETA_{variant.upper()}{suffixes[k]}"] = counts[k] > 0
+        beta_columns = [f"PREVIOUS_BETA_{variant.upper()}{suffixes[k]}" for k in windows for variant in beta_variants]
+
+    #for quasi-persistence, creating a column with True if the voice assistant produced any instance of quasi-persistence within the window
+    quasi_columns = []
+    if include_quasi_p:
+        counts = window_counts(df, indices_CURRENT, (df["quasi_persistence"] == True).to_numpy(), windows)
+        for k in windows:
+            variation_sample[f"QUASI_PERSISTENCE{suffixes[k]}"] = counts[k] > 0
+        quasi_columns = [f"QUASI_PERSISTENCE{suffixes[k]}" for k in windows]
 
     #dropping rows where there is no PREVIOUS
     variation_sample = variation_sample.loc[variation_sample["PREVIOUS"] != "NONE"]
@@ -123,121 +88,377 @@ def prepare_data_for_modeling(df, alternating, extract_lemma_from="lemma", inclu
     variation_sample["PREVIOUS_DISTANCE_LOG"] = np.where(variation_sample.PREVIOUS_DISTANCE > 0, np.log(variation_sample.PREVIOUS_DISTANCE), 0)    
 
     #dropping irrelevant columns and specifying order for the relevant ones
-    if not beta_variants == None:
-        if include_quasi_p:
-            columns_to_keep = ["CURRENT", "PREVIOUS", "PREVIOUS_SPEAKER", "PREVIOUS_DISTANCE", "PREVIOUS_DISTANCE_LOG"] + [col.upper() for col in list(previous_beta_true_or_false.keys())] + \
-                            ["QUASI_PERSISTENCE", "HUMAN_ID", "INTERACTION_ID"] 
-        else:
-            columns_to_keep = ["CURRENT", "PREVIOUS", "PREVIOUS_SPEAKER", "PREVIOUS_DISTANCE", "PREVIOUS_DISTANCE_LOG"] + [col.upper() for col in list(previous_beta_true_or_false.keys())] + \
-                            ["HUMAN_ID", "INTERACTION_ID"]
-    else:
-        if include_quasi_p:
-            columns_to_keep = ["CURRENT", "PREVIOUS", "PREVIOUS_SPEAKER", "PREVIOUS_DISTANCE", "PREVIOUS_DISTANCE_LOG"] + \
-                            ["QUASI_PERSISTENCE", "HUMAN_ID", "INTERACTION_ID"] 
-        else: 
-            columns_to_keep = ["CURRENT", "PREVIOUS", "PREVIOUS_SPEAKER", "PREVIOUS_DISTANCE", "PREVIOUS_DISTANCE_LOG"] + \
-                            ["HUMAN_ID", "INTERACTION_ID"] 
+    columns_to_keep = ["CURRENT", "PREVIOUS", "PREVIOUS_SPEAKER", "PREVIOUS_DISTANCE", "PREVIOUS_DISTANCE_LOG"] + beta_columns + quasi_columns + ["HUMAN_ID", "INTERACTION_ID"]
 
     #reordering columns according to the list created above
     variation_sample = variation_sample.reindex(columns_to_keep, axis=1)
 
-    #for the DEZEMBER alternation only: modifying Umlaute, as R has trouble handling them
-    variation_sample.replace({"ö": "oe", "Ö": "OE"}, regex=True).to_csv("dezember_zwoelf_for_analysis.csv") 
+    #saving externally, if a destination was provided
+    if save_to:
+        export_variation_sample(variation_sample, save_to)
 
     #returning final variation_sample
     return variation_sample
 
-def plot_switch_rate_over_variant_proportions(df, variation_sample, alternation_set, alternating, labels= None, save_to=None, DEZEMBER=False):
-    """Function calculates 1) switch rates from one specific variant in the first slot of two successive slots (variant_B)
-    to variant A (as opposed to persistence where the variant in the second slot would be the same as in the first), 
-    2) proportions of variant A of both variants (i.e., variant B + variant A), assessing whether the switch rate from variant B
-    is proportional to the share of the switched-to variant A (null hypothesis), or if, alternatively, for the given variant B a switch is more
-    likely than could be expected from the variant proportions or less likely (the latter indicating persistence)."""
-    
-    #defining different symbols for each variant in the scatterplot
-    scatter_symbols, i = ["o", "D", "v", "^", "<", ">", "*"], 0 
+def export_variation_sample(variation_sample, destination, levels={}, recode={}, index=True):
+    """Function exports a variation sample for modelling in a typed format determined by the suffix of destination (see storage.write_corpus):
+    Feather (.feather or .arrow), which R reads directly with arrow::read_feather, parquet or csv. Columns in FACTORS are stored as categorical
+    columns, i.e., as factors in R, whose levels are sorted unless levels maps a column to its levels (e.g. to make a level the reference level);
+    Boolean and numeric columns keep their types and strings remain UTF-8, such that Umlaute are preserved.
+
+    recode maps values of factor columns to other values (e.g. {"zwölf": "zwoelf"}, which the modelling notebook of the DEZEMBER alternation
+    expects), renaming levels rather than every value. Returns the typed variation sample."""
+
+    variation_sample = variation_sample.copy()
+
+    for column in [column for column in FACTORS if column in variation_sample.columns]:
+        factor = variation_sample[column].astype("category")
+        factor = factor.cat.rename_categories({value: recode[value] for value in factor.cat.categories if value in recode})
+        variation_sample[column] = factor.cat.reorder_categories(levels[column] if column in levels else sorted(factor.cat.categories))
+
+    storage.write_corpus(variation_sample, destination, index=index)
+
+    return variation_sample
+
+def cached_variation_sample(df, alternating, cache_dir=".variation_samples", max_bytes=2 ** 28, save_to=None, **arguments):
+    """Function returns the variation sample of df (see prepare_data_for_modeling, to which arguments are passed), reading it from the cache
+    in cache_dir if neither the annotation (column alternating) nor the corpus rows it depends on nor the parameters changed since it was computed.
+
+    Entries of the cache are keyed by the parameters and the content hash of each interaction (see interaction_hashes). As all variables of
+    a choice context are determined within its interaction, only interactions whose hash changed (e.g. after a few annotation decisions)
+    are recomputed if an entry with the same parameters exists, the rows of all others being taken from the entry sharing most interactions.
+    Entries are stored as Feather files and the least recently used ones are evicted once the cache exceeds max_bytes. If save_to is passed,
+    the whole variation sample is exported to this path (see export_variation_sample), whether it was read from the cache or not."""
+
+    parameters = {"alternating": alternating, "module": MODULE_HASH, **{key: arguments[key] for key in sorted(arguments)}}
+    parameters_hash = hashlib.sha256(json.dumps(parameters, sort_keys=True, default=str).encode()).hexdigest()
+    hashes = interaction_hashes(df, alternating, **arguments)
+    key = hashlib.sha256((parameters_hash + json.dumps(hashes, sort_keys=True)).encode()).hexdigest()[:32]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = read_cache_manifest(cache_dir)
+
+    #returning the cached variation sample if the state of the annotation is known
+    if key in manifest and os.path.exists(f"{cache_dir}/{key}.feather"):
+        manifest[key]["used"] = time.time()
+        write_cache_manifest(cache_dir, manifest)
+        variation_sample = read_cached_sample(f"{cache_dir}/{key}.feather", df.index.name)
+        if save_to:
+            export_variation_sample(variation_sample, save_to)
+        return variation_sample
+
+    #finding the entry with the same parameters sharing most interactions, whose rows of unchanged interactions are reused
+    candidates = [entry for entry, record in manifest.items() if record["parameters"] == parameters_hash and os.path.exists(f"{cache_dir}/{entry}.feather")]
+    base = max(candidates, key=lambda entry: sum(manifest[entry]["interactions"].get(i) == h for i, h in hashes.items()), default=None)
+    unchanged = {i for i, h in hashes.items() if manifest[base]["interactions"].get(i) == h} if base else set()
+
+    changed = [i for i in hashes if i not in unchanged]
+    interaction_ids = df["interaction_id"].astype(str)
+
+    parts = []
+    if unchanged:
+        cached = read_cached_sample(f"{cache_dir}/{base}.feather", df.index.name)
+        parts.append(cached[cached["INTERACTION_ID"].astype(str).isin(unchanged)])
+    if changed or not parts:
+        computed = prepare_data_for_modeling(df[interaction_ids.isin(changed)].copy() if unchanged else df, alternating, **arguments)
+        parts.append(computed)
+
+    #restoring the order of the corpus
+    variation_sample = pd.concat(parts) if len(parts) > 1 else parts[0]
+    if len(parts) > 1:
+        variation_sample = variation_sample.iloc[np.argsort(df.index.get_indexer(variation_sample.index), kind="stable")]
+        #restoring the types of the columns, taken from the cached rows if the recomputed interactions have no choice contexts left
+        #(an empty variation sample has object columns only)
+        reference = computed if len(computed) else parts[0]
+        variation_sample = variation_sample.astype({column: dtype for column, dtype in reference.dtypes.items() if variation_sample[column].dtype != dtype})
+
+    #recording the new entry and evicting the least recently used ones
+    variation_sample.reset_index(names="__index__").to_feather(f"{cache_dir}/{key}.feather")
+    manifest[key] = {"parameters": parameters_hash, "interactions": hashes, "used": time.time()}
+    evict(cache_dir, manifest, max_bytes, keep=key)
+    write_cache_manifest(cache_dir, manifest)
+
+    #exporting the assembled variation sample (rather than passing save_to on, which would only export the recomputed interactions)
+    if save_to:
+        export_variation_sample(variation_sample, save_to)
+
+    return variation_sample
+
+def interaction_hashes(df, alternating, extract_lemma_from="lemma", include_quasi_p=False, beta_variants=None, **arguments):
+    """Function returns the content hash of each interaction of df (by interaction id, as string) over what its variation sample depends on:
+    the index (the ids of tokens) and quasi-persistence (if included) of all tokens, and the annotation (column alternating), variants, speakers,
+    settings and participants of the tokens which are relevant, i.e., alternating tokens (not annotated as "no") and, if beta persistence is
+    determined, tokens of beta variants. As the latter are rare, hashing strings only for them keeps hashing large corpora fast.
+    Rows are hashed at once, interactions by combining the hashes of their rows."""
+
+    columns = [alternating, extract_lemma_from, "lemma", "speaker", "setting", "interaction_id", "participant_id"]
+    relevant = (df[alternating] != "no").to_numpy() | (df["lemma"].isin(beta_variants).to_numpy() if beta_variants else False)
+
+    #hashes of all rows (index, quasi-persistence) and of relevant rows (including their index, such that it is known which rows are relevant)
+    all_hashes = pd.util.hash_pandas_object(df[["quasi_persistence"]] if include_quasi_p else df.index, index=True).to_numpy()
+    relevant_hashes = pd.util.hash_pandas_object(df.loc[relevant, [column for column in dict.fromkeys(columns) if column in df.columns]], index=True).to_numpy()
+
+    interaction_ids = df["interaction_id"].to_numpy()
+    positions = pd.Series(np.arange(len(df))).groupby(interaction_ids, sort=False).indices
+    relevant_positions = pd.Series(np.arange(relevant.sum())).groupby(interaction_ids[relevant], sort=False).indices
+
+    return {str(interaction_id): hashlib.sha256(all_hashes[rows].tobytes() + relevant_hashes[relevant_positions.get(interaction_id, [])].tobytes()).hexdigest()
+            for interaction_id, rows in positions.items()}
+
+def read_cached_sample(path, index_name=None):
+    """Function reads a cached variation sample (see cached_variation_sample), restoring its index (the ids of tokens)."""
+
+    return pd.read_feather(path).set_index("__index__").rename_axis(index_name)
+
+def read_cache_manifest(cache_dir):
+    """Function reads the manifest of the cache of variation samples (empty if there is none or it is unreadable)."""
+
+    try:
+        with open(f"{cache_dir}/{CACHE_MANIFEST}", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_cache_manifest(cache_dir, manifest):
+    """Function writes the manifest of the cache of variation samples atomically."""
+
+    temporary_path = f"{cache_dir}/{CACHE_MANIFEST}.tmp"
+
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+    os.replace(temporary_path, f"{cache_dir}/{CACHE_MANIFEST}")
+
+def evict(cache_dir, manifest, max_bytes, keep=None):
+    """Function deletes the least recently used entries of the cache of variation samples (and removes them from the manifest, in place)
+    until the entries take up at most max_bytes, never deleting the entry keep."""
+
+    sizes = {entry: os.path.getsize(f"{cache_dir}/{entry}.feather") if os.path.exists(f"{cache_dir}/{entry}.feather") else 0 for entry in manifest}
+    total = sum(sizes.values())
+
+    for entry in sorted(manifest, key=lambda entry: manifest[entry]["used"]):
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        if os.path.exists(f"{cache_dir}/{entry}.feather"):
+            os.remove(f"{cache_dir}/{entry}.feather")
+        total -= sizes[entry]
+        del manifest[entry]
+
+def variation_samples(corpora, alternations, processes=None):
+    """Function builds the variation samples (see prepare_data_for_modeling) of several alternation sets for several annotated corpora,
+    reading each corpus once and building all of its variation samples in one go, corpora being processed in up to processes worker
+    processes in parallel (processes=1 processes them in the current process).
+
+    corpora maps the name of each corpus (e.g. "VACC") to the annotated corpus, either as DataFrame or as path of a corpus file
+    (csv, parquet or feather, see storage.read_corpus). alternations maps each alternation column (e.g. "SCHEDULE") to the keyword
+    arguments of prepare_data_for_modeling for it (e.g. {"restrict": "yes", "beta_variants": ["man", "werden"]}); if a list of
+    alternation columns is passed, the default arguments are used. Alternation columns a corpus does not contain are skipped for it,
+    but a ValueError is raised for alternation columns no corpus contains.
+
+    Returns a dictionary mapping each alternation column to one variation sample for all corpora, with a column CORPUS and the
+    interaction ids suffixed by the name of the corpus (e.g. "4_VACC"), such that they are unique across corpora."""
+
+    if isinstance(alternations, list):
+        alternations = {alternation: {} for alternation in alternations}
+
+    processes = processes or os.cpu_count()
+
+    #building the variation samples of each corpus, in worker processes if there are several corpora
+    if processes == 1 or len(corpora) < 2:
+        samples = {name: corpus_variation_samples(corpus, alternations) for name, corpus in corpora.items()}
+
+    else:
+        with ProcessPoolExecutor(max_workers=min(processes, len(corpora))) as executor:
+            futures = {name: executor.submit(corpus_variation_samples, corpus, alternations) for name, corpus in corpora.items()}
+            samples = {name: future.result() for name, future in futures.items()}
+
+    #combining the variation samples of all corpora per alternation set, keying interactions by corpus
+    combined = {}
+    for alternation in alternations:
+        per_corpus = []
+        for name, corpus_samples in samples.items():
+            if alternation in corpus_samples:
+                variation_sample = corpus_samples[alternation].copy()
+                variation_sample["INTERACTION_ID"] = variation_sample["INTERACTION_ID"].astype(str) + "_" + name
+                variation_sample["CORPUS"] = name
+                per_corpus.append(variation_sample)
+        #an alternation column none of the corpora contains is most likely misspelt (e.g. differing in case from the annotated column)
+        if not per_corpus:
+            raise ValueError(f"Alternation column '{alternation}' is missing from all corpora ({', '.join(corpora)})")
+        combined[alternation] = pd.concat(per_corpus)
+
+    return combined
+
+def corpus_variation_samples(corpus, alternations):
+    """Function builds the variation samples of the given alternation sets (a dictionary mapping each alternation column to the
+    keyword arguments of prepare_data_for_modeling) for one annotated corpus (DataFrame or path of a corpus file), see variation_samples."""
+
+    if not isinstance(corpus, pd.DataFrame):
+        corpus = storage.read_corpus(corpus, index_col=0)
+        corpus.index.name = None
+
+    samples = {alternation: prepare_data_for_modeling(corpus, alternation, **arguments) for alternation, arguments in alternations.items() if alternation in corpus.columns}
+
+    #storing ids (categorical in corpus files, see storage.SCHEMA) as plain values, like in variation samples built from csv files
+    for variation_sample in samples.values():
+        for column in variation_sample.select_dtypes("category").columns:
+            variation_sample[column] = variation_sample[column].astype(variation_sample[column].cat.categories.dtype)
+
+    return samples
+
+def first_indices(df):
+    """Function returns the index of the first token of the interaction of each token in df (as array)."""
+
+    return df.index.to_series().groupby(df["interaction_id"].to_numpy(), sort=False).transform("first").to_numpy()
+
+def window_counts(df, indices, occurrences, windows=[25]):
+    """Function counts, for each of the given indices of df, how many of the tokens flagged in occurrences (boolean array, one value per token
+    in df) are within the window of k tokens before it (by index, i.e., from index - k to index - 1, but not before the first token
+    of the interaction), for each window size k in windows. Returns a dictionary of arrays by window size. Based on the cumulative count
+    of occurrences, the count within a window is the difference between two cumulative counts, hence any number of window sizes can
+    be determined at once. Assumes that the index of df is ascending (i.e., in the order of the corpus)."""
+
+    ids = df.index.to_numpy()
+    positions = df.index.get_indexer(indices)
+    first_ids = first_indices(df)[positions]
+
+    #number of occurrences before each position
+    cumulative = np.concatenate([[0], np.cumsum(occurrences, dtype=np.int64)])
+
+    counts = {}
+    for k in windows:
+        #position of the first token within the window
+        starts = np.searchsorted(ids, np.maximum(ids[positions] - k, first_ids), side="left")
+        counts[k] = cumulative[positions] - cumulative[starts]
+
+    return counts
+
+def previous_variants(df, indices, alternating, extract_lemma_from="lemma"):
+    """Function returns, for each of the given indices of df (choice contexts), the previous variant, i.e., the last alternating token
+    (any token not annotated as "no" in column alternating) before it within the same interaction, its speaker and its distance in tokens
+    (index of the choice context minus index of the previous variant), or "NONE", "NONE" and 0 if there is none. All three are computed
+    for all indices at once: the position of the last alternating token is carried forward over the corpus and shifted by one
+    (excluding the token itself), and only kept if it is not before the first token of the interaction. Assumes that the index of df
+    is ascending (i.e., in the order of the corpus)."""
+
+    ids = df.index.to_numpy()
+    positions = df.index.get_indexer(indices)
+
+    #index of the first token of the interaction of each token
+    first_ids = first_indices(df)
+
+    #position of the last alternating token before each token (-1 if there is none)
+    alternating_positions = np.where((df[alternating] != "no").to_numpy(), np.arange(len(df)), -1)
+    last = np.concatenate([[-1], np.maximum.accumulate(alternating_positions)[:-1]])[positions]
+
+    #keeping only previous variants within the interaction of the choice context
+    found = (last >= 0) & (ids[np.maximum(last, 0)] >= first_ids[positions])
+
+    previous_variant = np.where(found, df[extract_lemma_from].to_numpy(dtype=object)[last], "NONE")
+    previous_speaker = np.where(found, df["speaker"].to_numpy(dtype=object)[last], "NONE")
+    previous_distance = np.where(found, ids[positions] - ids[last], 0)
+
+    return list(previous_variant), list(previous_speaker), list(previous_distance)
+
+def switch_rates(df, variation_sample, alternation_set, alternating, DEZEMBER=False):
+    """Function calculates for each variant of alternation_set in the first slot of two successive slots (variant B, column PREVIOUS) and each
+    interaction 1) the switch rate from variant B to the other variants (variants A), i.e., the per-interaction frequency of switches from
+    variant B to variants A (SWITCHES) divided by the frequency of variants A used by the given speaker (OTHER_VARIANTS), and 2) the proportion
+    of variants A of all variants used in the interaction by all interlocutors (VARIANT_PROPORTIONS, see plot_switch_rate_over_variant_proportions).
+    Switches are only counted in interactions where variant B appears in PREVIOUS (NaN otherwise), since 0 would else also mean that no switch
+    could have taken place. Returns a DataFrame with one row per variant B and interaction (pure, i.e., without plotting)."""
+
+    """Switch rates"""
+
+    #counting pairs of PREVIOUS and CURRENT per interaction once, from which both switches from and frequencies of all variants B follow
+    pairs = variation_sample.groupby(["INTERACTION_ID", "PREVIOUS", "CURRENT"], observed=True).size().unstack("CURRENT", fill_value=0)
+
+    #per-interaction frequency of each variant used by the given speaker
+    current = pairs.groupby(level="INTERACTION_ID").sum().reindex(columns=alternation_set, fill_value=0)
+
+    """Variant proportions (considering all alternating variants, irrespective of whether uttered by the human speaker, the voice assistant, 
+    or the confederate, if applicable, thus drawing on df, the whole corpus, rather than just variation_sample)"""
+
+    #if dealing with the DEZEMBER alternation, filtering df with regard to setting is necessary, 
+    #as variants were also annotated in Quiz interactions, but variation_sample has also been filtered like this
+    if DEZEMBER:
+        variants_all_speakers = df[(df[alternating]=="yes")&(df.setting=="Calendar")] 
+    else:
+        variants_all_speakers = df[df[alternating]=="yes"] 
+
+    #per-interaction frequency of each variant, considering this time not just the given speaker, but all interlocutors
+    all_speakers = variants_all_speakers.groupby(["interaction_id", "lemma"], observed=True).size().unstack(fill_value=0).reindex(columns=alternation_set, fill_value=0)
+    all_speakers.index.name = "INTERACTION_ID"
+
+    tables = []
 
-    #iterating over variants for visualising them in the same plot
     for variant_B in alternation_set:
 
-        #creating a list of variants exluding variant_B (note that while this line and the following code are theoretically able to
-        #handle alternation sets consisting of more than two variants, switch rate plot are only suitable for alternation sets with two variants)
+        #creating a list of variants exluding variant_B (switch rate plots are only suitable for alternation sets with two variants, though)
         variants_A = [variant for variant in alternation_set if variant != variant_B]
-                
-        """Switch rates"""
 
-        """step 1: creating a column with Boolean values where True means that 1) variant_B is used in PREVIOUS (may have been used by any interlocutor), 
-        but not used in CURRENT by the given speaker (this works because there only ever is one human speaker per interaction whose switching behaviour 
-        is investigated), i.e., True means that the given speaker switched from the given variant_B to variant_A.
+        #switches from variant_B: pairs with variant_B in PREVIOUS, but another variant in CURRENT, in interactions where variant_B appears in PREVIOUS
+        if variant_B in pairs.index.get_level_values("PREVIOUS"):
+            previous_B = pairs.xs(variant_B, level="PREVIOUS")
+            switches = previous_B.sum(axis=1) - (previous_B[variant_B] if variant_B in previous_B.columns else 0)
+        else:
+            switches = pd.Series(dtype=float)
 
-        However, first, filtering for interactions where the given variant_B appears in PREVIOUS, because otherwise 0 could both mean that no
-        switches from variant_B took place as the human speaker always re-used that variant, but ALSO that variant_B never even appeared in PREVIOUS
-        in the first place (in that case no switch could have taken place, ergo 0 would also result"""
-        interaction_ids_with_variant_B_in_PREVIOUS = variation_sample[variation_sample.PREVIOUS == variant_B].INTERACTION_ID.unique() #identifying relevant interaction ids
-        variation_sample_filtered = variation_sample[variation_sample.INTERACTION_ID.isin(interaction_ids_with_variant_B_in_PREVIOUS)] #filtering variation_sample accordingly
+        table = pd.DataFrame({"PREVIOUS": variant_B, "SWITCHES": switches.reindex(current.index), "OTHER_VARIANTS": current[variants_A].sum(axis=1)})
+        table["SWITCH_RATE"] = table["SWITCHES"] / table["OTHER_VARIANTS"]
 
-        #creating Boolean column where True means that the given speaker switched from variant_B to variant_A
-        variation_sample_filtered[f"SWITCH_from_{variant_B}"] = (variation_sample_filtered.PREVIOUS == variant_B) & (variation_sample_filtered.CURRENT != variant_B)
+        #calculating share of variants_A of all variants per interaction and combining it with the switch rates for each interaction
+        share = (all_speakers[variants_A].sum(axis=1) / all_speakers.sum(axis=1)).rename("VARIANT_PROPORTIONS")
+        tables.append(table.reset_index().merge(share.reset_index(), on="INTERACTION_ID"))
 
-        """step 2a: calculating per-interaction absolute frequency of switches from variant_B to variant_A by grouping variation_sample_filtered by interaction and
-        adding up the column SWITCH_from_{variant_B} (which works because True equals 1)"""
-        switches_from_variant_B_per_interaction = variation_sample_filtered.groupby("INTERACTION_ID")[f"SWITCH_from_{variant_B}"].sum()
+    return pd.concat(tables, ignore_index=True)[["PREVIOUS", "INTERACTION_ID", "SWITCHES", "OTHER_VARIANTS", "SWITCH_RATE", "VARIANT_PROPORTIONS"]]
 
-        #step 2b: calculating per-interaction absolute frequency of variant_A used by the given speaker
-        frequency_of_variant_A_per_interaction = variation_sample.groupby("INTERACTION_ID").CURRENT.apply(lambda x: x.isin(variants_A).sum())
+def plot_switch_rate_over_variant_proportions(df, variation_sample, alternation_set, alternating, labels= None, save_to=None, DEZEMBER=False, table=None, test=None):
+    """Function plots 1) switch rates from one specific variant in the first slot of two successive slots (variant_B)
+    to variant A (as opposed to persistence where the variant in the second slot would be the same as in the first) over 
+    2) proportions of variant A of both variants (i.e., variant B + variant A), assessing whether the switch rate from variant B
+    is proportional to the share of the switched-to variant A (null hypothesis), or if, alternatively, for the given variant B a switch is more
+    likely than could be expected from the variant proportions or less likely (the latter indicating persistence). Both are calculated
+    by switch_rates, unless its table is passed. If the result of switch_rate_test is passed as test, the deviation of each variant
+    from the null hypothesis and its p-value are added to the legend."""
 
-        #step 3: dividing per-interaction frequency of switches by frequency of variant_A in the given interaction
-        switch_rate_per_interaction = pd.DataFrame(switches_from_variant_B_per_interaction / frequency_of_variant_A_per_interaction).reset_index()
-        switch_rate_per_interaction.columns = ["INTERACTION_ID", "SWITCH_RATE"] #renaming columns for merging later
+    if table is None:
+        table = switch_rates(df, variation_sample, alternation_set, alternating, DEZEMBER)
 
-        """Variant proportions (considering all alternating variants, irrespective of whether uttered by the human speaker, the voice assistant, 
-        or the confederate, if applicable, thus drawing on df, the whole corpus, rather than just variation_sample)"""
+    #matplotlib is only needed for plotting, not for calculating switch rates (e.g. in headless runs)
+    import matplotlib.pyplot as plt
 
-        #if dealing with the DEZEMBER alternation, filtering df with regard to setting is necessary, 
-        #as variants were also annotated in Quiz interactions, but variation_sample has also been filtered like this
-        if DEZEMBER:
-            variants_all_speakers = df[(df[alternating]=="yes")&(df.setting=="Calendar")] 
-        else:
-            variants_all_speakers = df[df[alternating]=="yes"] 
-        
-        #step 1a: calculating absolute frequency of variant_A per interaction, considering this time not just the given speaker, but all interlocutors
-        frequency_of_variant_A_per_interaction = variants_all_speakers.groupby("interaction_id").lemma.apply(lambda x: x.isin(variants_A).sum())
-
-        #step 1b: calculating frequency of variant_B per interaction, again considering all interlocutors
-        frequency_of_variant_B_per_interaction = variants_all_speakers.groupby("interaction_id").lemma.apply(lambda x: (x == variant_B).sum())
-
-        #step 2: calculating share of variant_A of both variants per interaction
-        share_of_variant_A_per_interaction = pd.DataFrame(frequency_of_variant_A_per_interaction / (frequency_of_variant_B_per_interaction + frequency_of_variant_A_per_interaction)).reset_index()
-        share_of_variant_A_per_interaction.columns = ["INTERACTION_ID", "VARIANT_PROPORTIONS"] #renaming columns for merging later
-        
-        #creating combined DataFrame with both values for each interaction
-        switch_rates_df = switch_rate_per_interaction.merge(share_of_variant_A_per_interaction, on="INTERACTION_ID")
-        
-        """Plotting"""
-        
-        #creating plot, configuring spines, ax limits and labels
-        plt.rcParams['figure.dpi'] = 300
-        plt.rc('text', usetex=True)
-        ax = plt.subplot(111).spines[['right', 'top']].set_visible(False) #configuring spines
-        plt.axis([0, 100, 0, 100]) #setting axis limits
-        plt.ylabel(f'Switch rate from previous variant to other variant{"" if len(alternation_set) == 2 else "s"} in \%') #labelling y-axis
-        plt.xlabel(f'Share of switched-to variant{"" if len(alternation_set) == 2 else "s"} in \%') #labellinh x-axis
-
-        #if custom legend labels were passed
-        if not labels: 
-            #creating scatter plot for current variant_B
-            plt.scatter(x=switch_rates_df["VARIANT_PROPORTIONS"]*100, 
-                        y=switch_rates_df["SWITCH_RATE"]*100, 
-                        linewidth=1, label=f"\\textit{{{variant_B}}} as previous variant", alpha=0.6, clip_on=False, marker = scatter_symbols[i])
-        #if no custom legend labels were passed
-        else: 
-            #creating scatter plot for current variant_B
-            plt.scatter(x=switch_rates_df["VARIANT_PROPORTIONS"]*100, 
-                        y=switch_rates_df["SWITCH_RATE"]*100, 
-                        linewidth=1, label=f"{labels[i]} as previous variant", alpha=0.6, clip_on=False, marker = scatter_symbols[i])
-
-        #increasing counter to get different scatter symbol next time
-        i+=1 
+    #defining different symbols for each variant in the scatterplot
+    scatter_symbols = ["o", "D", "v", "^", "<", ">", "*"]
+
+    #creating plot, configuring spines, ax limits and labels
+    plt.rcParams['figure.dpi'] = 300
+    plt.rc('text', usetex=True)
+    ax = plt.subplot(111).spines[['right', 'top']].set_visible(False) #configuring spines
+    plt.axis([0, 100, 0, 100]) #setting axis limits
+    plt.ylabel(f'Switch rate from previous variant to other variant{"" if len(alternation_set) == 2 else "s"} in \\%') #labelling y-axis
+    plt.xlabel(f'Share of switched-to variant{"" if len(alternation_set) == 2 else "s"} in \\%') #labellinh x-axis
+
+    #iterating over variants for visualising them in the same plot
+    for i, variant_B in enumerate(alternation_set):
+
+        switch_rates_df = table[table["PREVIOUS"] == variant_B]
+
+        #labelling variant_B in italics, unless custom legend labels were passed
+        label = f"\\textit{{{variant_B}}}" if not labels else labels[i]
+        label += " as previous variant"
+
+        #adding the quantified deviation from the null hypothesis, if tested
+        if test is not None:
+            tested = test[test["PREVIOUS"] == variant_B].iloc[0]
+            label += f" (deviation {tested['DEVIATION']*100:+.1f}, $p$ = {tested['P_VALUE']:.3g})"
+
+        #creating scatter plot for current variant_B
+        plt.scatter(x=switch_rates_df["VARIANT_PROPORTIONS"]*100, 
+                    y=switch_rates_df["SWITCH_RATE"]*100, 
+                    linewidth=1, label=label, alpha=0.6, clip_on=False, marker = scatter_symbols[i])
 
     #plotting null hypothesis 
     x = np.linspace(0, 100, 100)
@@ -248,12 +469,311 @@ def plot_switch_rate_over_variant_proportions(df, variation_sample, alternation_
     if save_to:
         plt.savefig(save_to)
 
+def switch_rate_test(df, variation_sample, alternation_set, alternating, DEZEMBER=False, resamples=10000, confidence=0.95, seed=0, batch=1000, processes=1, table=None):
+    """Function quantifies the deviation of switch rates from the null hypothesis of plot_switch_rate_over_variant_proportions (switch rate
+    proportional to the share of the switched-to variants) for each variant B of alternation_set, the deviation being the mean difference
+    of switch rate and variant proportion over the interactions with a (finite) switch rate (see switch_rates, whose table may be passed).
+
+    1) A cluster bootstrap resamples interactions (with replacement) resamples times, yielding a confidence interval of the deviation
+    (as well as of the mean switch rate) at the given confidence level. 2) A permutation test shuffles CURRENT within each interaction
+    resamples times, which keeps the frequency of each variant per interaction, but breaks the link between PREVIOUS and CURRENT. The number
+    of pairs where variant B is kept is then hypergeometrically distributed per interaction, such that permutations are drawn at once
+    rather than shuffled. The p-value (two-sided) is the share of permutations deviating at least as far as the observed deviation from
+    the mean permuted deviation (i.e., from what could be expected without persistence); a positive deviation indicates more switches,
+    a negative one fewer switches (persistence) than expected.
+
+    Resamples are drawn in batches of batch resamples (in up to processes worker processes), each batch with its own random state derived
+    from seed, such that results are reproducible regardless of the number of processes. Returns a DataFrame with one row per variant B."""
+
+    if table is None:
+        table = switch_rates(df, variation_sample, alternation_set, alternating, DEZEMBER)
+
+    #per-interaction numbers of pairs, from which permuted switches follow
+    rows = variation_sample.groupby("INTERACTION_ID", observed=True).size()
+
+    #deriving a random state for each batch of resamples, the same for both tests and independent of the number of processes
+    batches = [min(batch, resamples - start) for start in range(0, resamples, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(2 * len(alternation_set) * len(batches))
+
+    #encoding PREVIOUS and CURRENT once, such that pairs are matched to variants by comparing integer codes
+    (previous_codes, current_codes), strings = vocabulary.joint_codes(variation_sample["PREVIOUS"].astype(str), variation_sample["CURRENT"].astype(str))
+
+    tasks, results = [], []
+
+    for v, variant_B in enumerate(alternation_set):
+
+        #considering interactions where both the switch rate and the variant proportion are defined
+        variant_table = table[table["PREVIOUS"] == variant_B]
+        variant_table = variant_table[np.isfinite(variant_table["SWITCH_RATE"]) & variant_table["VARIANT_PROPORTIONS"].notna()]
+        ids = variant_table["INTERACTION_ID"]
+
+        #numbers of pairs, pairs with variant_B in PREVIOUS and pairs with variant_B in CURRENT per interaction
+        code = strings.index(variant_B) if variant_B in strings else -1
+        previous = variation_sample[previous_codes == code].groupby("INTERACTION_ID", observed=True).size()
+        current = variation_sample[current_codes == code].groupby("INTERACTION_ID", observed=True).size()
+        arrays = {"deviations": (variant_table["SWITCH_RATE"] - variant_table["VARIANT_PROPORTIONS"]).to_numpy(float),
+                  "switch_rates": variant_table["SWITCH_RATE"].to_numpy(float),
+                  "rows": rows.reindex(ids, fill_value=0).to_numpy(), "previous": previous.reindex(ids, fill_value=0).to_numpy(),
+                  "current": current.reindex(ids, fill_value=0).to_numpy(), "other": variant_table["OTHER_VARIANTS"].to_numpy(float),
+                  "proportions": variant_table["VARIANT_PROPORTIONS"].to_numpy(float)}
+        results.append(arrays)
+
+        for b, size in enumerate(batches):
+            for k, test in enumerate(["bootstrap", "permutation"]):
+                tasks.append((v, test, seeds[(v * len(batches) + b) * 2 + k], size, arrays))
+
+    #drawing the resamples batch by batch, in worker processes if requested
+    if processes == 1:
+        resampled = [resample_switch_rates(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            resampled = list(executor.map(resample_switch_rates, tasks))
+
+    alpha = (1 - confidence) / 2
+    rows_out = []
+
+    for v, variant_B in enumerate(alternation_set):
+
+        arrays = results[v]
+        bootstrap = np.concatenate([r for task, r in zip(tasks, resampled) if task[0] == v and task[1] == "bootstrap"] or [np.zeros((0, 2))])
+        permutation = np.concatenate([r for task, r in zip(tasks, resampled) if task[0] == v and task[1] == "permutation"] or [np.zeros(0)])
+
+        observed = arrays["deviations"].mean() if len(arrays["deviations"]) else np.nan
+        expected = permutation.mean() if len(permutation) and len(arrays["deviations"]) else np.nan
+
+        #share of permutations at least as far from the expected deviation as the observed one (counting the observed one itself)
+        p_value = (1 + np.sum(np.abs(permutation - expected) >= np.abs(observed - expected) - 1e-12)) / (1 + len(permutation)) if not np.isnan(expected) else np.nan
+
+        lower, upper = np.quantile(bootstrap, [alpha, 1 - alpha], axis=0) if len(bootstrap) and len(arrays["deviations"]) else np.full((2, 2), np.nan)
+
+        rows_out.append({"PREVIOUS": variant_B, "INTERACTIONS": len(arrays["deviations"]),
+                         "SWITCH_RATE": arrays["switch_rates"].mean() if len(arrays["switch_rates"]) else np.nan,
+                         "SWITCH_RATE_LOWER": lower[1], "SWITCH_RATE_UPPER": upper[1],
+                         "VARIANT_PROPORTIONS": arrays["proportions"].mean() if len(arrays["proportions"]) else np.nan,
+                         "DEVIATION": observed, "DEVIATION_LOWER": lower[0], "DEVIATION_UPPER": upper[0],
+                         "EXPECTED_DEVIATION": expected, "P_VALUE": p_value, "RESAMPLES": resamples})
+
+    return pd.DataFrame(rows_out)
+
+def resample_switch_rates(task):
+    """Function draws one batch of resamples for switch_rate_test (worker function, top-level for process pools): for the cluster bootstrap,
+    the mean deviation and mean switch rate of resampled interactions (array with two columns), for the permutation test, the mean deviation
+    after shuffling CURRENT within interactions."""
+
+    _, test, seed, size, arrays = task
+    rng = np.random.default_rng(seed)
+    n = len(arrays["deviations"])
+
+    if n == 0:
+        return np.zeros((size, 2)) if test == "bootstrap" else np.zeros(size)
+
+    if test == "bootstrap":
+        #resampling interactions with replacement, one row of interaction positions per resample
+        resampled = rng.integers(0, n, size=(size, n))
+        return np.column_stack([arrays["deviations"][resampled].mean(axis=1), arrays["switch_rates"][resampled].mean(axis=1)])
+
+    #number of pairs keeping variant_B when drawing as many pairs as have variant_B in PREVIOUS out of all pairs of the interaction
+    kept = rng.hypergeometric(arrays["current"], arrays["rows"] - arrays["current"], arrays["previous"], size=(size, n))
+
+    return ((arrays["previous"] - kept) / arrays["other"] - arrays["proportions"]).mean(axis=1)
+
+def transitions(variation_sample, alternation_set=None, by=None):
+    """Function counts the transitions from the variant in PREVIOUS to the variant in CURRENT of variation_sample (see transition_matrix).
+    Returns the observed (non-zero) transitions as DataFrame with columns by (if passed), PREVIOUS, CURRENT and COUNT, ordered by
+    stratum, PREVIOUS and CURRENT, the variants (rows and columns of the matrix) and the strata (None if by is not passed)."""
+
+    by = [by] if isinstance(by, str) else list(by or [])
+
+    #variants are those of alternation_set, in the given order, or all variants in PREVIOUS and CURRENT, sorted
+    if alternation_set is None:
+        variants = sorted(set(variation_sample["PREVIOUS"].dropna().astype(str)) | set(variation_sample["CURRENT"].dropna().astype(str)))
+    else:
+        variants = [str(variant) for variant in alternation_set]
+
+    #encoding variants and strata as integers, pairs with variants not in variants (or missing) being dropped
+    previous = pd.Categorical(variation_sample["PREVIOUS"].astype(str), categories=variants).codes.astype(np.int64)
+    current = pd.Categorical(variation_sample["CURRENT"].astype(str), categories=variants).codes.astype(np.int64)
+    if by:
+        stratum, strata = pd.factorize(pd.MultiIndex.from_frame(variation_sample[by]) if len(by) > 1 else variation_sample[by[0]], sort=True)
+    else:
+        stratum, strata = np.zeros(len(variation_sample), dtype=np.int64), None
+
+    keep = (previous >= 0) & (current >= 0) & (stratum >= 0)
+
+    #counting each combination of stratum, PREVIOUS and CURRENT as a single integer, such that only observed transitions are stored
+    k = len(variants)
+    observed, counts = np.unique((stratum[keep].astype(np.int64) * k + previous[keep]) * k + current[keep], return_counts=True)
+
+    table = pd.DataFrame({"PREVIOUS": np.array(variants, dtype=object)[observed // k % k], "CURRENT": np.array(variants, dtype=object)[observed % k], "COUNT": counts})
+    if by:
+        keys = strata[observed // (k * k)]
+        for position, column in enumerate(by):
+            table.insert(position, column, keys.get_level_values(position) if len(by) > 1 else keys)
+
+    return table, variants, strata
+
+def transition_matrix(variation_sample, alternation_set=None, by=None, probabilities=False, sparse=False):
+    """Function returns the matrix of transitions from the variant in PREVIOUS (rows) to the variant in CURRENT (columns) of variation_sample,
+    i.e., the pairwise variant flow of create_sankey_diagram, whose diagonal are cases of persistence. Variants are those of alternation_set
+    (pairs with other variants are dropped) or, if not passed, all variants in PREVIOUS and CURRENT (including NONE).
+
+    If by is passed (a column or list of columns, e.g. "PREVIOUS_SPEAKER" or "CORPUS" for combined variation samples, see variation_samples),
+    one matrix is returned per stratum, stacked with the strata as outer row index levels (e.g. matrix.loc["VACC"]). If probabilities is True,
+    rows are normalised to transition probabilities (NaN for variants which never occur in PREVIOUS).
+
+    Dense matrices are returned as DataFrame. If sparse is True, only observed transitions are returned, as DataFrame with columns by (if passed),
+    PREVIOUS, CURRENT and COUNT (or PROBABILITY), which does not grow with the square of the number of variants."""
+
+    table, variants, strata = transitions(variation_sample, alternation_set, by)
+    by = [by] if isinstance(by, str) else list(by or [])
+
+    if sparse:
+        if probabilities:
+            table["PROBABILITY"] = table["COUNT"] / table.groupby(by + ["PREVIOUS"], sort=False)["COUNT"].transform("sum")
+            table = table.drop(columns="COUNT")
+        return table
+
+    #filling the observed transitions into a dense array of all strata
+    k, n_strata = len(variants), len(strata) if by else 1
+    codes = {variant: code for code, variant in enumerate(variants)}
+    stratum = pd.Index(strata).get_indexer(pd.MultiIndex.from_frame(table[by]) if len(by) > 1 else table[by[0]]) if by else np.zeros(len(table), dtype=int)
+    matrix = np.zeros((n_strata, k, k), dtype=np.int64)
+    matrix[stratum, table["PREVIOUS"].map(codes).to_numpy(int), table["CURRENT"].map(codes).to_numpy(int)] = table["COUNT"].to_numpy()
+
+    if probabilities:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            matrix = matrix / matrix.sum(axis=2, keepdims=True)
+
+    if by:
+        rows = pd.MultiIndex.from_tuples([(*(key if len(by) > 1 else (key,)), variant) for key in strata for variant in variants], names=by + ["PREVIOUS"])
+    else:
+        rows = pd.Index(variants, name="PREVIOUS")
+
+    return pd.DataFrame(matrix.reshape(n_strata * k, k), index=rows, columns=pd.Index(variants, name="CURRENT"))
+
+def stay_probabilities(variation_sample, alternation_set=None, by=None):
+    """Function returns the persistence diagonal of the transition matrix (see transition_matrix) as tidy DataFrame: for each variant in PREVIOUS
+    (and stratum, if by is passed), the number of pairs (PAIRS), the number of pairs where the same variant was used in CURRENT (STAYS) and
+    the probability of staying with the variant (STAY_PROBABILITY)."""
+
+    table, _, _ = transitions(variation_sample, alternation_set, by)
+    by = [by] if isinstance(by, str) else list(by or [])
+
+    table["STAYS"] = table["COUNT"].where(table["PREVIOUS"] == table["CURRENT"], 0)
+    stays = table.groupby(by + ["PREVIOUS"], sort=False)[["COUNT", "STAYS"]].sum().reset_index().rename(columns={"COUNT": "PAIRS"})
+    stays["STAY_PROBABILITY"] = stays["STAYS"] / stays["PAIRS"]
+
+    return stays
+
+def distance_decay(variation_samples, bins=[1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000, np.inf], by=["CORPUS", "PREVIOUS_SPEAKER"], bandwidth=0.5,
+                   resamples=1000, confidence=0.95, seed=0, batch=200, save_to=None):
+    """Function calculates how the probability of persistence (CURRENT == PREVIOUS) decays with the distance to the previous variant
+    (PREVIOUS_DISTANCE, in tokens), per group of by (e.g. per corpus and per speaker of the previous variant, i.e., voice assistant or human;
+    columns a variation sample does not contain are ignored). variation_samples is a variation sample (see prepare_data_for_modeling) or a
+    dictionary mapping alternation columns to variation samples (see variation_samples), such that all alternation sets are covered at once.
+
+    Pairs are binned by distance (bins are the edges of bins including the lower, excluding the upper edge), the probability of persistence
+    per bin (PERSISTENCE) being smoothed by a Gaussian kernel over the log distance of all pairs (SMOOTHED, with bandwidth in log tokens),
+    evaluated at the (geometric) mean distance of the bin (DISTANCE). Confidence bands of both come from a cluster bootstrap resampling
+    interactions resamples times (in batches of batch resamples, seeded). Returns a tidy DataFrame with one row per alternation set,
+    group and bin containing pairs, which is saved to save_to (csv), if passed."""
+
+    if isinstance(variation_samples, pd.DataFrame):
+        variation_samples = {None: variation_samples}
+
+    edges = np.asarray(bins, dtype=float)
+    rng = np.random.default_rng(seed)
+    tables = []
+
+    for alternation, variation_sample in variation_samples.items():
+
+        groups = [column for column in by if column in variation_sample.columns]
+
+        #binning pairs by distance, pairs outside of the bins being dropped
+        distances = variation_sample["PREVIOUS_DISTANCE"].to_numpy(dtype=float)
+        binned = np.searchsorted(edges, distances, side="right") - 1
+        keep = (binned >= 0) & (binned < len(edges) - 1) & (distances > 0)
+        data, binned = variation_sample[keep], binned[keep]
+
+        log_distances = np.log(data["PREVIOUS_DISTANCE"].to_numpy(dtype=float))
+        (current, previous), _ = vocabulary.joint_codes(data["CURRENT"].astype(str), data["PREVIOUS"].astype(str))
+        stays = (current == previous).astype(float)
+        interactions = data["INTERACTION_ID"].to_numpy()
+
+        #iterating over groups in sorted order, such that bootstrap results are reproducible
+        positions = data.groupby(groups, observed=True, sort=True).indices if groups else {None: np.arange(len(data))}
+
+        for key, group in positions.items():
+            table = decay_curve(interactions[group], binned[group], log_distances[group], stays[group], edges, bandwidth, resamples, confidence, rng, batch)
+            key = key if isinstance(key, tuple) else (key,)
+            for position, column in enumerate(groups):
+                table.insert(position, column, key[position])
+            if alternation is not None:
+                table.insert(0, "ALTERNATION", alternation)
+            tables.append(table)
+
+    table = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+    if save_to:
+        table.to_csv(save_to, index=False)
+
+    return table
+
+def decay_curve(interactions, binned, log_distances, stays, edges, bandwidth, resamples, confidence, rng, batch):
+    """Function calculates the binned and smoothed probability of persistence over distance of one group of pairs with bootstrap bands,
+    see distance_decay. Bootstrap resamples are weights of interactions (how often each is drawn), such that resampled curves follow from
+    matrix products with per-interaction sums rather than from resampling pairs."""
+
+    interaction_codes, interaction_ids = pd.factorize(interactions)
+    n_interactions, n_bins = len(interaction_ids), len(edges) - 1
+
+    #per-interaction numbers of pairs and of persistent pairs per bin
+    pairs = np.bincount(interaction_codes * n_bins + binned, minlength=n_interactions * n_bins).reshape(n_interactions, n_bins).astype(float)
+    persistent = np.bincount(interaction_codes * n_bins + binned, weights=stays, minlength=n_interactions * n_bins).reshape(n_interactions, n_bins)
+
+    #evaluating the smoothed curve at the geometric mean distance of the pairs of each (non-empty) bin
+    observed = np.flatnonzero(pairs.sum(axis=0))
+    points = (np.bincount(binned, weights=log_distances, minlength=n_bins) / np.maximum(np.bincount(binned, minlength=n_bins), 1))[observed]
+
+    #per-interaction kernel-weighted numbers of pairs and of persistent pairs at each point
+    kernel = np.exp(-0.5 * ((points[None, :] - log_distances[:, None]) / bandwidth) ** 2)
+    kernel_pairs, kernel_persistent = np.zeros((n_interactions, len(observed))), np.zeros((n_interactions, len(observed)))
+    np.add.at(kernel_pairs, interaction_codes, kernel)
+    np.add.at(kernel_persistent, interaction_codes, kernel * stays[:, None])
+
+    pairs, persistent = pairs[:, observed], persistent[:, observed]
+
+    #drawing bootstrap weights of interactions batch by batch
+    binned_curves, smoothed_curves = [], []
+    for start in range(0, resamples, batch):
+        weights = rng.multinomial(n_interactions, np.full(n_interactions, 1 / n_interactions), size=min(batch, resamples - start)).astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            binned_curves.append((weights @ persistent) / (weights @ pairs))
+            smoothed_curves.append((weights @ kernel_persistent) / (weights @ kernel_pairs))
+
+    alpha = (1 - confidence) / 2
+    if resamples:
+        binned_lower, binned_upper = np.nanquantile(np.vstack(binned_curves), [alpha, 1 - alpha], axis=0)
+        smoothed_lower, smoothed_upper = np.nanquantile(np.vstack(smoothed_curves), [alpha, 1 - alpha], axis=0)
+    else:
+        binned_lower = binned_upper = smoothed_lower = smoothed_upper = np.full(len(observed), np.nan)
+
+    return pd.DataFrame({"BIN": [f"[{edges[b]:g}, {edges[b + 1]:g})" for b in observed], "DISTANCE_FROM": edges[observed], "DISTANCE_TO": edges[observed + 1],
+                         "DISTANCE": np.exp(points), "INTERACTIONS": (pairs > 0).sum(axis=0), "PAIRS": pairs.sum(axis=0).astype(int),
+                         "STAYS": persistent.sum(axis=0).astype(int), "PERSISTENCE": persistent.sum(axis=0) / pairs.sum(axis=0),
+                         "PERSISTENCE_LOWER": binned_lower, "PERSISTENCE_UPPER": binned_upper,
+                         "SMOOTHED": kernel_persistent.sum(axis=0) / kernel_pairs.sum(axis=0),
+                         "SMOOTHED_LOWER": smoothed_lower, "SMOOTHED_UPPER": smoothed_upper})
+
 def create_sankey_diagram(variation_sample):
     """Function creates a Sankey diagram visualising pairwise variant flow, i.e., given some variant in PREVIOUS 
     whether that same variant was also used in CURRENT or if not, which of the other variants was used in CURRENT."""
 
+    #plotly is only needed for plotting
+    import plotly.graph_objects as go
+
     #aggregating counts for variant use in PREVIOUS and CURRENT
-    flows = variation_sample.groupby(["PREVIOUS", "CURRENT"]).size().reset_index(name="count")
+    flows = transition_matrix(variation_sample, sparse=True).rename(columns={"COUNT": "count"})
 
     #creating a stylised unique label list with each verb appearing twice (left and right side)
     unique_verbs = sorted(set(flows["PREVIOUS"]).union(set(flows["CURRENT"])))
@@ -314,4 +834,107 @@ def create_sankey_diagram(variation_sample):
     )
 
     #displaying plot
-    fig.show()
\ No newline at end of file
+    fig.show()
+
+#directions of persistence (prefix of the combined files, see persistence.combiner) and their speakers A (priming) and B (persisting)
+DIRECTIONS = {"Persistence": ("A", "S"), "Quasi_persistence": ("S", "A")}
+
+#ngram sizes of the columns of persistence tags in the combined files (e.g. "persistence_bigrams_lemma")
+NGRAM_SIZES = {"unigrams": 1, "bigrams": 2, "trigrams": 3, "quadrigrams": 4}
+
+def rates(which_corpus, path_to_input, file_format="parquet", by=["corpus", "setting", "participant_id", "interaction_id"], directions=DIRECTIONS, window=150, stopwords=[]):
+    """Function computes persistence rates from the unigram-based files (produced by persistence.combiner, in the given format) of one corpus
+    or a list of corpora, for each direction in directions (e.g. quasi-persistence, if its files exist) and ngram size. The rate is the number
+    of persistent ngrams (SPPs, counted at their first token) divided by the number of opportunities for persistence, i.e., ngrams of speaker B
+    within window tokens after an eligible ngram of speaker A in the same interaction (see persistence.tagger); ngrams are eligible if they fit
+    into their turn and do not contain non-identifiable lemmata (unigrams neither if they are in stopwords). As tokens excluded by the
+    instructions are not known here, rates are lower bounds if instructions were excluded when tagging.
+
+    Counts of all tokens are summed in one grouped pass per group of by (e.g. ["corpus", "participant_id"] for participants or ["corpus", "setting"]
+    for settings). Returns a tidy table with the columns by, direction, n, fpps, spps, opportunities and rate, such that it can be used for modelling."""
+
+    corpora = [which_corpus] if isinstance(which_corpus, str) else list(which_corpus)
+    counts = []
+
+    for corpus_name in corpora:
+        for direction, (speaker_A, speaker_B) in directions.items():
+
+            path = storage.corpus_path(path_to_input, f"{direction}_{corpus_name}_all", file_format)
+            if not os.path.exists(path):
+                continue
+
+            corpus = storage.read_corpus(path)
+
+            #in case of RBC, instructions are also part of the corpus, but these are disregarded as they were not tagged for persistence
+            if corpus_name == "RBC":
+                corpus = corpus[~corpus["interaction_id"].astype(str).str.startswith("Instructions")].reset_index(drop=True)
+
+            counts.append(rate_counts(corpus, corpus_name, direction, speaker_A, speaker_B, window, stopwords))
+
+    columns = by + ["direction", "n", "fpps", "spps", "opportunities", "rate"]
+    if not counts:
+        return pd.DataFrame(columns=columns)
+
+    #summing the counts of all tokens per group (in one pass for all ngram sizes) and reshaping into one row per group, direction and ngram size
+    counts = pd.concat(counts, ignore_index=True)
+    sums = counts.groupby(by + ["direction"], sort=False)[[column for column in counts.columns if column[-1].isdigit()]].sum().reset_index()
+
+    table = pd.concat([sums[by + ["direction"]].assign(n=n, fpps=sums[f"fpps_{n}"], spps=sums[f"spps_{n}"], opportunities=sums[f"opportunities_{n}"])
+                       for n in NGRAM_SIZES.values()], ignore_index=True)
+    table["rate"] = table["spps"] / table["opportunities"].where(table["opportunities"] > 0)
+
+    #ordering rows by group (in the order of the corpus) and ngram size
+    order = np.lexsort((table["n"].to_numpy(), np.tile(np.arange(len(sums)), len(NGRAM_SIZES))))
+
+    return table.iloc[order].reset_index(drop=True)[columns]
+
+def rate_counts(corpus, corpus_name, direction, speaker_A, speaker_B, window, stopwords):
+    """Function counts FPPs, SPPs and opportunities for persistence (see rates) at each token of a unigram-based file, returning a table with
+    one row per token, the columns corpus, setting, participant_id, interaction_id and direction as well as the counts for each ngram size
+    (e.g. spps_2). Opportunities are determined for all tokens at once: the position of the last eligible ngram of speaker A is carried
+    forward over the corpus and shifted by one, an ngram of speaker B being an opportunity if it is within window tokens after it
+    and in the same interaction."""
+
+    #positions of tokens, the first position of their interaction and their position within their turn (turn ids restart in each interaction)
+    positions = np.arange(len(corpus))
+    interaction_ids = corpus["interaction_id"].astype(str).to_numpy()
+    first = pd.Series(positions).groupby(interaction_ids, sort=False).transform("min").to_numpy()
+    turns = corpus.groupby([interaction_ids, corpus["turn_id"].astype(str).to_numpy()], sort=False)
+    position_in_turn, turn_lengths = turns.cumcount().to_numpy(), turns["turn_id"].transform("size").to_numpy()
+
+    speakers = corpus["speaker"].astype(str).to_numpy()
+    #marking stopwords and non-identifiable lemmata once per code rather than per token (as in persistence.tagger)
+    lemma_codes, strings = vocabulary.codes(corpus["lemma"])
+    stopword = np.array([string in stopwords for string in strings], dtype=bool)[lemma_codes]
+    non_identifiable = np.concatenate([[0], np.cumsum(np.array(["non_identifiable_lemma" in string for string in strings], dtype=bool)[lemma_codes])])
+
+    counts = pd.DataFrame({"corpus": corpus_name,
+                           "setting": corpus["setting"].astype(str).to_numpy() if "setting" in corpus.columns else corpus_name,
+                           "participant_id": corpus["participant_id"].astype(str).to_numpy() if "participant_id" in corpus.columns else interaction_ids,
+                           "interaction_id": interaction_ids,
+                           "direction": direction})
+
+    for ngram, n in NGRAM_SIZES.items():
+
+        #ngrams starting at each token which fit into the turn and are not excluded from tagging
+        excluded = non_identifiable[np.minimum(positions + n, len(corpus))] - non_identifiable[positions] > 0
+        eligible = (position_in_turn + n <= turn_lengths) & ~excluded & (~stopword if n == 1 else True)
+
+        #position of the last eligible ngram of speaker A before each token (-1 if there is none)
+        eligible_A = np.where(eligible & (speakers == speaker_A), positions, -1)
+        last_A = np.concatenate([[-1], np.maximum.accumulate(eligible_A)[:-1]])
+
+        counts[f"opportunities_{n}"] = (eligible & (speakers == speaker_B) & (last_A >= first) & (positions - last_A <= window)).astype(int)
+
+        #counting FPPs and SPPs at each token (only tagged tokens are considered, as the tags of most tokens are empty)
+        tags = corpus[f"persistence_{ngram}_lemma"].fillna("").astype(str).to_numpy(dtype=object)
+        tagged = np.flatnonzero(tags != "")
+        for pair_part in ["FPP", "SPP"]:
+            values = np.zeros(len(corpus), dtype=int)
+            if n == 1:
+                values[tagged] = pd.Series(tags[tagged]).str.startswith(pair_part).to_numpy()
+            else:
+                values[tagged] = pd.Series(tags[tagged]).str.count(f"{pair_part}_start_").to_numpy()
+            counts[f"{pair_part.lower()}s_{n}"] = values
+
+    return counts
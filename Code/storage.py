@@ -0,0 +1,210 @@
+import pandas as pd, pyarrow as pa, json
+from pathlib import Path
+
+#explicit schema for the columns shared by all pipeline stages: speaker, setting, interaction and participant are repeated
+#for every token and are therefore stored as categoricals, words, lemmata and turns are always kept as strings
+#(preventing e.g. "wahr" from being interpreted as Boolean), time stamps are stored as floats unless they contain 
+#non-numeric values (e.g. "Instruction" in RBC or dates in VACW); columns not listed here are stored as they are
+SCHEMA = {"participant_id": "category",
+          "setting": "category",
+          "interaction_id": "category",
+          "speaker": "category",
+          "turn": str,
+          "word": str,
+          "lemma": str,
+          "start": float,
+          "end": float}
+
+#file suffixes and the format they are mapped to, csv is only kept as an export option
+#("partitioned" corpora are directories storing each interaction separately, see write_partitioned)
+FORMATS = {".parquet": "parquet", ".feather": "feather", ".arrow": "feather", ".partitioned": "partitioned", ".csv": "csv"}
+
+def file_format(path):
+    """Function returns the storage format of a corpus file based on its suffix."""
+
+    suffix = Path(path).suffix.lower()
+
+    if suffix not in FORMATS:
+        raise ValueError(f"Unknown corpus format '{suffix}', use one of {', '.join(FORMATS)}")
+
+    return FORMATS[suffix]
+
+def corpus_path(directory, name, file_format="parquet"):
+    """Function builds the path of a corpus file from a directory, a file name without suffix and a storage format."""
+
+    return f"{directory}/{name}.{file_format}"
+
+def _homogenise(column):
+    """Function casts object columns holding values of different types (e.g. turn ids and "Instruction" in RBC) to strings,
+    as columnar formats require one type per column; missing values are kept."""
+
+    types = set(type(value) for value in column.dropna())
+
+    if len(types) < 2:
+        return column
+
+    return column.where(column.isna(), column.astype(str))
+
+def apply_schema(corpus):
+    """Function casts the columns of a corpus to the types defined in SCHEMA (for all columns present) and
+    homogenises the remaining object columns such that the corpus can be stored in a columnar format."""
+
+    corpus = corpus.copy()
+
+    for column in corpus.columns:
+
+        if corpus[column].dtype == object:
+            corpus[column] = _homogenise(corpus[column])
+
+        if column not in SCHEMA:
+            continue
+
+        if SCHEMA[column] == str:
+            #empty values are stored as empty strings, mirroring reading csv files with na_filter=False
+            corpus[column] = corpus[column].fillna("").astype(str)
+
+        elif SCHEMA[column] == "category" and not isinstance(corpus[column].dtype, pd.CategoricalDtype):
+            #ids consisting of whole numbers only are stored as integer categories (as csv readers would interpret them)
+            numeric = pd.to_numeric(corpus[column], errors="coerce")
+            if numeric.notna().all() and (numeric % 1 == 0).all():
+                corpus[column] = numeric.astype("int64")
+            corpus[column] = corpus[column].astype("category")
+
+        elif SCHEMA[column] == float and corpus[column].dtype == object:
+            numeric = pd.to_numeric(corpus[column], errors="coerce")
+            if numeric.notna().all():
+                corpus[column] = numeric
+
+    return corpus
+
+def read_corpus(path, index_col=None, columns=None):
+    """Function reads a corpus file written by any stage of the pipeline, the format being determined by its suffix.
+    index_col mirrors pandas.read_csv, i.e., the given column (name or position) is used as index."""
+
+    format_ = file_format(path)
+
+    if format_ == "parquet":
+        corpus = pd.read_parquet(path, columns=columns)
+
+    elif format_ == "feather":
+        corpus = pd.read_feather(path, columns=columns)
+
+    elif format_ == "partitioned":
+        with pa.memory_map(f"{path}/corpus.arrow") as source:
+            table = pa.ipc.open_file(source).read_all()
+        corpus = (table.select(columns) if columns else table).to_pandas()
+
+    else:
+        #csv files are read the way all stages used to read them, i.e., without interpreting empty values as NaN
+        corpus = pd.read_csv(path, sep=",", na_filter=False, low_memory=False, usecols=columns)
+
+    return _finalise(corpus, index_col)
+
+def _finalise(corpus, index_col):
+    """Function sets the index of a corpus read from any format and applies the schema."""
+
+    #setting the index; as columnar files store the index as a regular (first) column, this works the same for all formats
+    if index_col is not None:
+        corpus = corpus.set_index(corpus.columns[index_col] if isinstance(index_col, int) else index_col)
+
+        #unnamed indices are stored as column "index" and restored as unnamed
+        if corpus.index.name == "index":
+            corpus.index.name = None
+
+    #applying the schema, which for csv files replaces the former astype(str) workarounds
+    return apply_schema(corpus)
+
+def write_corpus(corpus, path, index=True):
+    """Function writes a corpus to the given path, the format being determined by its suffix (parquet, feather/arrow or csv)."""
+
+    format_ = file_format(path)
+
+    #creating the directory if necessary
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    if format_ == "csv":
+        corpus.to_csv(path, index=index)
+        return
+
+    #like in csv files, the index is stored as the first regular column, to be restored using index_col when reading
+    corpus = apply_schema(corpus.reset_index(drop=not index))
+
+    if format_ == "parquet":
+        corpus.to_parquet(path, index=False)
+    elif format_ == "feather":
+        corpus.to_feather(path)
+    else:
+        write_partitioned(corpus, path)
+
+def partition(corpus, column="interaction_id"):
+    """Function returns a dictionary mapping each interaction id (or each value of another column) to the positions
+    of its rows in corpus. It is computed in a single pass, such that stages can slice single interactions
+    with corpus.iloc in O(size of interaction) rather than filtering the whole corpus once per interaction."""
+
+    return corpus.groupby(column, sort=False, observed=True).indices
+
+def write_partitioned(corpus, path):
+    """Function writes a corpus partitioned by interaction: all rows are stored in one Arrow IPC file (corpus.arrow)
+    in which each interaction is a separate record batch, accompanied by an offset index (index.json) mapping
+    interaction ids to their batch. Single interactions can thus be memory-mapped without loading the whole corpus.
+    Rows are grouped by interaction in order of first appearance (which keeps the order of regular corpora)."""
+
+    if "interaction_id" not in corpus.columns:
+        raise ValueError("Only corpora with a column 'interaction_id' can be partitioned")
+
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+    #grouping rows by interaction
+    positions = partition(corpus)
+    corpus = corpus.iloc[[position for interaction_positions in positions.values() for position in interaction_positions]]
+
+    #converting the corpus once, such that all batches share the same dictionaries for categorical columns
+    table = pa.Table.from_pandas(corpus, preserve_index=False).combine_chunks()
+    batches = table.to_batches()
+    batch = batches[0] if batches else pa.RecordBatch.from_pandas(corpus, preserve_index=False)
+
+    #writing one record batch per interaction and recording its offset in the index
+    index, offset = [], 0
+    with pa.OSFile(f"{path}/corpus.arrow", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        for interaction_id, interaction_positions in positions.items():
+            writer.write_batch(batch.slice(offset, len(interaction_positions)))
+            index.append({"interaction_id": interaction_id.item() if hasattr(interaction_id, "item") else interaction_id,
+                          "offset": offset,
+                          "rows": len(interaction_positions)})
+            offset += len(interaction_positions)
+
+    with open(f"{path}/index.json", "w", encoding="utf-8") as f:
+        json.dump({"rows": offset, "partitions": index}, f, ensure_ascii=False)
+
+def partitions(path):
+    """Function returns the offset index of a partitioned corpus, i.e., a DataFrame with interaction ids, their offsets and numbers of rows,
+    e.g. for distributing interactions over parallel workers without loading the corpus."""
+
+    with open(f"{path}/index.json", encoding="utf-8") as f:
+        return pd.DataFrame(json.load(f)["partitions"], columns=["interaction_id", "offset", "rows"])
+
+def read_partition(path, interaction_ids, index_col=None):
+    """Function reads one or more interactions (a single id or a list of ids) from a partitioned corpus by memory-mapping
+    only the corresponding record batches, i.e., in O(size of the interactions) rather than O(size of the corpus)."""
+
+    if not isinstance(interaction_ids, (list, tuple, set)):
+        interaction_ids = [interaction_ids]
+
+    #looking up the batch number of each interaction in the offset index
+    batch_numbers = {interaction_id: number for number, interaction_id in enumerate(partitions(path)["interaction_id"])}
+
+    missing = [interaction_id for interaction_id in interaction_ids if interaction_id not in batch_numbers]
+    if missing:
+        raise KeyError(f"Interactions not found in partitioned corpus: {missing}")
+
+    with pa.memory_map(f"{path}/corpus.arrow") as source:
+        reader = pa.ipc.open_file(source)
+        table = pa.Table.from_batches([reader.get_batch(batch_numbers[interaction_id]) for interaction_id in interaction_ids], schema=reader.schema)
+        corpus = table.to_pandas()
+
+    return _finalise(corpus, index_col)
+
+def export_csv(path_to_input, destination):
+    """Function exports a columnar corpus file as csv file (e.g. for annotating it or opening it in a spreadsheet)."""
+
+    read_corpus(path_to_input).to_csv(destination, index=False)
@@ -0,0 +1,162 @@
+"""Suggestion engine for annotating alternation sets (see annotation.alternation_check): a multinomial logistic regression over
+hashed context features of candidates (the variant, lemma n-grams before and after it, speaker and setting) is trained on the
+decisions made so far (e.g. those recorded in the annotation journal) and updated after each new one. For every remaining candidate,
+it suggests a label together with a confidence (the probability of the label), such that the annotator can accept suggestions,
+candidates can be ordered by uncertainty and, optionally, confident suggestions can be accepted automatically.
+
+Pure Python/NumPy, i.e., it runs offline without further dependencies. How many manual decisions it saves for an already annotated
+alternation set can be estimated with evaluate."""
+
+import zlib, numpy as np, pandas as pd
+
+#number of dimensions features are hashed to
+DIMENSIONS = 2 ** 18
+
+def hash_feature(feature):
+    """Function maps a feature (string) to one of DIMENSIONS dimensions. Unlike hash, crc32 does not depend on the process,
+    such that models are reproducible."""
+
+    return zlib.crc32(feature.encode("utf-8")) % DIMENSIONS
+
+def features(df, indices, window=3, ngrams=[1, 2], columns=["speaker", "setting"]):
+    """Function returns the hashed context features of the given indices: a constant (bias), the lemma of the variant, n-grams (of the sizes in ngrams)
+    of the lemmata within window tokens before and after it (within the same interaction), the lemmata immediately before and after it
+    (by position), and the values of columns (if in df). Features are returned in compressed form, i.e., as arrays indptr and ids,
+    where the features of the k-th index are ids[indptr[k]:indptr[k+1]]."""
+
+    lemmata = df["lemma"].astype(str).str.lower().to_numpy(dtype=object)
+    interactions = df["interaction_id"].to_numpy()
+    columns = [column for column in columns if column in df.columns]
+    values = {column: df[column].astype(str).to_numpy(dtype=object) for column in columns}
+
+    positions = df.index.get_indexer(indices)
+    indptr, ids = [0], []
+
+    for position in positions:
+
+        #restricting the window to the interaction of the variant
+        start, end = max(position - window, 0), min(position + window + 1, len(df))
+        same = interactions[start:end] == interactions[position]
+        before = [lemma for lemma, keep in zip(lemmata[start:position], same[:position - start]) if keep]
+        after = [lemma for lemma, keep in zip(lemmata[position + 1:end], same[position + 1 - start:]) if keep]
+
+        variant = lemmata[position]
+        row = ["bias", f"variant={variant}", f"previous={before[-1] if before else '<s>'}|{variant}", f"next={variant}|{after[0] if after else '</s>'}"]
+
+        for n in ngrams:
+            row += [f"before{n}=" + " ".join(before[k:k + n]) for k in range(len(before) - n + 1)]
+            row += [f"after{n}=" + " ".join(after[k:k + n]) for k in range(len(after) - n + 1)]
+
+        row += [f"{column}={values[column][position]}" for column in columns]
+
+        ids += [hash_feature(feature) for feature in row]
+        indptr.append(len(ids))
+
+    return np.asarray(indptr), np.asarray(ids, dtype=np.int64)
+
+def subset(rows, selected):
+    """Function returns the features (see features) of the selected rows (boolean mask or positions)."""
+
+    indptr, ids = rows
+    lengths = np.diff(indptr)
+
+    #selecting the features of a boolean mask at once, those of positions (which may be in any order) one by one
+    if np.asarray(selected).dtype == bool:
+        return np.concatenate([[0], np.cumsum(lengths[selected])]), ids[np.repeat(selected, lengths)]
+
+    selected = np.asarray(selected, dtype=int)
+    ids = [ids[indptr[k]:indptr[k + 1]] for k in selected]
+
+    return np.concatenate([[0], np.cumsum(lengths[selected])]), np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+
+def model(labels=["yes", "no", "unclear"], learning_rate=0.2):
+    """Function returns an untrained model for the given labels, i.e., the weights of each label for each feature dimension,
+    the sums of their squared gradients (for adapting the learning rate per dimension, AdaGrad) and the number of decisions per label."""
+
+    return {"labels": list(labels), "learning_rate": learning_rate, "decisions": np.zeros(len(labels)),
+            "weights": np.zeros((len(labels), DIMENSIONS)), "gradients": np.full((len(labels), DIMENSIONS), 1e-6)}
+
+def update(model, rows, decisions):
+    """Function trains the model (in place) with the features of annotated candidates (see features) and their decisions,
+    one after another (online multinomial logistic regression), adding labels not known yet. Returns the model."""
+
+    indptr, ids = rows
+    decisions = [str(decision) for decision in decisions]
+
+    for label in dict.fromkeys(decisions):
+        if label not in model["labels"]:
+            model["labels"].append(label)
+            model["decisions"] = np.append(model["decisions"], 0)
+            model["weights"] = np.vstack([model["weights"], np.zeros(DIMENSIONS)])
+            model["gradients"] = np.vstack([model["gradients"], np.full(DIMENSIONS, 1e-6)])
+
+    for k, decision in enumerate(decisions):
+        row = ids[indptr[k]:indptr[k + 1]]
+        label = model["labels"].index(decision)
+
+        #gradient of the cross entropy of the predicted probabilities, which is the same for all features of the row
+        gradient = predict(model, (np.array([0, len(row)]), row))[0]
+        gradient[label] -= 1
+
+        #adapting the weights of the features of the row, with a learning rate decreasing with the gradients seen so far
+        np.add.at(model["gradients"], (slice(None), row), gradient[:, None] ** 2)
+        np.add.at(model["weights"], (slice(None), row), -model["learning_rate"] * gradient[:, None] / np.sqrt(model["gradients"][:, row]))
+        model["decisions"][label] += 1
+
+    return model
+
+def fit(rows, decisions, labels=["yes", "no", "unclear"], learning_rate=0.2):
+    """Function returns a model (see model) trained with the features of annotated candidates and their decisions."""
+
+    return update(model(labels, learning_rate), rows, decisions)
+
+def predict(model, rows):
+    """Function returns the probability of each label (columns, in the order of model["labels"]) for each row of features."""
+
+    indptr, ids = rows
+
+    if len(indptr) == 1:
+        return np.zeros((0, len(model["labels"])))
+
+    #summing the weights of the features of each row
+    scores = np.add.reduceat(model["weights"][:, ids], indptr[:-1], axis=1)
+
+    #normalising the scores to probabilities (softmax)
+    scores = np.exp(scores - scores.max(axis=0))
+
+    return (scores / scores.sum(axis=0)).T
+
+def suggest(model, rows):
+    """Function returns the suggested label and its confidence (probability) for each row of features."""
+
+    probabilities = predict(model, rows)
+
+    return np.array(model["labels"], dtype=object)[probabilities.argmax(axis=1)], probabilities.max(axis=1)
+
+def evaluate(df, alternation_set, alternation, threshold=0.9, window=3):
+    """Function estimates how many manual decisions suggestions save for an annotated alternation set: the candidates
+    (instances of alternation_set annotated in column alternation) are decided in corpus order, suggestions being made by a model
+    trained with the previous decisions only. Suggestions with a confidence of at least threshold count as accepted automatically.
+    Returns a one-row DataFrame with the number of candidates, manual decisions, automatic decisions and wrong automatic decisions."""
+
+    annotated = df[df["lemma"].isin(alternation_set) & df[alternation].notna()]
+    rows = features(df, annotated.index, window)
+    decisions = annotated[alternation].astype(str).to_numpy()
+    classifier = model(sorted(set(decisions)))
+
+    automatic = wrong = 0
+
+    for k, decision in enumerate(decisions):
+        row = subset(rows, [k])
+
+        #suggestions are only made once the model has been trained with at least one decision
+        if k > 0:
+            label, confidence = suggest(classifier, row)
+            if confidence[0] >= threshold:
+                automatic += 1
+                wrong += label[0] != decision
+
+        update(classifier, row, [decision])
+
+    return pd.DataFrame({"alternation": [alternation], "candidates": [len(decisions)], "manual": [len(decisions) - automatic],
+                         "automatic": [automatic], "wrong": [wrong], "threshold": [threshold]})
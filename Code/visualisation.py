@@ -1,27 +1,16 @@
-import pandas as pd
-import re
+import os, json, hashlib, pandas as pd, numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
-
-def lemma(which_corpus, path_to_input, destination):
-    """Function reads unigram-based file (produced by persistence.combiner) and outputs one HTML
-    file per interaction with all cases of persistence highlighted depending on type (uni-, bi-, tri-, or quadrigram)."""
-
-    #opening and reading unigram-based file with persistence information for all ngram levels
-    corpus = pd.read_csv(f"{path_to_input}/Persistence_{which_corpus}_all.csv", sep=",", index_col=0, na_filter=False)
-
-    #assigning type string to the column words (preventing e.g. "wahr" from being interpreted as Boolean and written as "WAHR" in the HTML output)
-    corpus["word"] = corpus["word"].astype(str)
-    
-    #initialising new column with empty string, to which words including relevant HTML start and end tags will be concatenated
-    corpus["html_code"] = ""
-
-    #defining start_doc which will commence each HTML file
-    #start_doc defines styles for all possible combinations of cases of persistence on the four ngram levels,
-    #e.g., "TFTF" (True False True False) means that the relevant token is a persistent unigram and
-    #part of a persistent trigram. This token will be wrapped with start and end tags specifying the
-    #style TFTF which is blueviolet font color, font in bold, with a pink bottomline
-    #additionally it defines styles for, e.g., subscript
-    start_doc = """<html>
+import storage, vocabulary, instrumentation
+
+#defining START_DOC which will commence each HTML file
+#it defines styles for all possible combinations of cases of persistence on the four ngram levels,
+#e.g., "TFTF" (True False True False) means that the relevant token is a persistent unigram and
+#part of a persistent trigram. This token will be wrapped with start and end tags specifying the
+#style TFTF which is blueviolet font color, font in bold, with a pink bottomline
+#additionally it defines styles for, e.g., subscript
+START_DOC = """<html>
         <head>
         <meta charset="utf-8">
         <style>
@@ -60,233 +49,383 @@ def lemma(which_corpus, path_to_input, destination):
         </head>
         <body>"""
 
+#templates for the header with the legend and for turns (the turn id is formatted with three digits)
+HEADER = "<header>{title}</header>"
+LEGEND = """<lh_big><b>Legend: </b> <TFFF>Unigram</TFFF>, <FTFF><pp><sub>(</sub></pp>Bigram<pp><sub>)</sub></pp></FTFF>, <FFTF><pp><sub>[</sub></pp>Trigram<pp><sub>]</sub></pp></FFTF>, <FFFT><pp><sub>{</sub></pp>Quadrigram<pp><sub>}</sub></pp></FFFT></lh_big></br>"""
+TURN = "<div class='turn'>{turn_id:>03} {label}{tokens}</div><lh_small> </lh_small></br>"
+CONFEDERATE_TURN = "<div class='turn'>{turn_id:>03} <span class='speaker-label'>Confederate:</span>{words}</conf_turn></div><lh_small> </lh_small></br>"
+END_DOC = "</body></br></html>"
+
+#comment in the first line of each page, holding the content hash it was rendered from (see lemma)
+HASH_COMMENT = "<!-- content hash: {hash_} -->"
+
+#labels of speakers preceding their turns (turns of other speakers are not labelled)
+SPEAKER_LABELS = {"S": "<span class='speaker-label'>Human:</span>", "A": "<span class='speaker-label'>Voice assistant:</span>"}
+
+#brackets marking the boundaries of persistent bi-, tri- and quadrigrams
+BRACKETS = {"bigrams": ("(", ")"), "trigrams": ("[", "]"), "quadrigrams": ("{", "}")}
+
+def _marker(condition, content):
+    """Function returns an array holding content (in subscript) where condition is True and an empty string elsewhere."""
+
+    return np.where(condition, f"<pp><sub>{content}</sub></pp>", "").astype(object)
+
+def render_tokens(corpus):
+    """Function returns the HTML code of all tokens of a unigram-based corpus (produced by persistence.combiner) as an array
+    (in the order of the corpus), each token followed by the (styled) whitespace separating it from the next token of its turn.
+
+    The style of a token is a four-letter tag like "TFTF" (True False True False), meaning that the token is a persistent unigram and
+    part of a persistent trigram. Boundaries of persistent ngrams are marked with brackets, i.e., (bigram), [trigram] and {quadrigram},
+    and divergent lemmata of persistent tokens are added in subscript. Tags, brackets and subscripts are computed for all tokens at once."""
+
+    words = corpus["word"].astype(str).to_numpy(dtype=object)
+    lemmata = corpus["lemma"].astype(str).to_numpy(dtype=object)
+    tags = {ngram: corpus[f"persistence_{ngram}_lemma"].astype(str) for ngram in ["unigrams", "bigrams", "trigrams", "quadrigrams"]}
+
+    #creating the four-letter tag of each token, "T" if there is a persistence tag on the respective ngram level, else "F"
+    tagged = {ngram: (tags[ngram] != "").to_numpy() for ngram in tags}
+    tag = np.full(len(corpus), "", dtype=object)
+    for ngram in tags:
+        tag = tag + np.where(tagged[ngram], "T", "F").astype(object)
+    untagged = tag == "FFFF"
+
+    #determining which tokens start and end persistent bi-, tri- and quadrigrams (a token can do both in case of overlapping ngrams)
+    starts = {ngram: tags[ngram].str.contains("start", regex=False).to_numpy() for ngram in BRACKETS}
+    ends = {ngram: tags[ngram].str.contains("end", regex=False).to_numpy() for ngram in BRACKETS}
+    insides = {ngram: tags[ngram].str.contains("inside", regex=False).to_numpy() for ngram in BRACKETS}
+
+    #wrapping each word in brackets (quadrigrams outermost), adding divergent lemmata in subscript and enwrapping it with its tag
+    embedded = words
+    for ngram, (opening, closing) in BRACKETS.items():
+        embedded = _marker(starts[ngram], opening) + embedded + _marker(ends[ngram], closing)
+    #(lowercased words and lemmata are compared as codes, see vocabulary.joint_codes)
+    (word_codes, lemma_codes), _ = vocabulary.joint_codes(pd.Series(words).str.lower(), lemmata)
+    embedded = embedded + np.where(~untagged & (word_codes != lemma_codes), "<pp><sub>" + lemmata + "</sub></pp>", "").astype(object)
+    html = np.where(untagged, words, "<" + tag + ">" + embedded + "</" + tag + ">")
+
+    #bridging the gap between a token and the next token of its turn, if the latter is tagged, with whitespace styled as tagged ngrams 
+    #continuing after the current token ("F" for unigrams, which never span more than one token), else with plain whitespace
+    gap_tag = "F" + np.where(starts["bigrams"], "T", "F").astype(object) \
+                  + np.where(starts["trigrams"] | insides["trigrams"], "T", "F").astype(object) \
+                  + np.where(starts["quadrigrams"] | insides["quadrigrams"], "T", "F").astype(object)
+
+    #determining whether the next token belongs to the same turn and is tagged, based on the order in which turns are rendered
+    turns = corpus.groupby(["interaction_id", "turn_id"], sort=False, observed=True).ngroup().to_numpy()
+    order = np.lexsort((np.arange(len(corpus)), turns))
+    next_tagged = np.zeros(len(corpus), dtype=bool)
+    next_tagged[order[:-1]] = (turns[order[1:]] == turns[order[:-1]]) & ~untagged[order[1:]]
+
+    return html + np.where(next_tagged, "<" + gap_tag + "> </" + gap_tag + ">", " ").astype(object)
+
+def render_interaction(which_corpus, interaction_id, interaction_df, tokens_html):
+    """Function returns the HTML document of an interaction, given its DataFrame and the HTML code of its tokens (see render_tokens).
+    Each turn is rendered with a single join of the HTML code of its tokens."""
+
+    #the document begins with START_DOC, a header with the name of the corpus and the interaction id (and for VACC, the participant id)
+    if which_corpus == "VACC":
+        parts = [START_DOC, HEADER.format(title=f"{which_corpus}, {interaction_id}, {interaction_df['participant_id'].iloc[0]}")]
+    else:
+        parts = [START_DOC, HEADER.format(title=f"{which_corpus}, {interaction_id}")]
+
+    #noting if there are no cases of persistence on any of the ngram levels in the given interaction
+    if all(len(interaction_df[f"persistence_{ngram}_lemma"].unique()) < 2 for ngram in ["unigrams", "bigrams", "trigrams", "quadrigrams"]):
+        parts.append("NO CASES OF PERSISTENCE TAGGED!</br>")
+
+    #followed by a legend detailing how cases of persistence are highlighted
+    parts.append(LEGEND)
+
+    words = interaction_df["word"].to_numpy(dtype=object)
+    speakers = interaction_df["speaker"].to_numpy(dtype=object)
+
+    #iterating over turns (in order of appearance)
+    for turn_id, turn_positions in storage.partition(interaction_df, "turn_id").items():
+
+        speaker = speakers[turn_positions[0]]
+
+        #in VACC, turns of the confederate are grayed out, as no cases of persistence were tagged for them
+        if which_corpus == "VACC" and speaker == "J":
+            parts.append(CONFEDERATE_TURN.format(turn_id=turn_id, words=" ".join([str(word) for word in words[turn_positions]])))
+        else:
+            parts.append(TURN.format(turn_id=turn_id, label=SPEAKER_LABELS.get(speaker, ""), tokens="".join(tokens_html[turn_positions])))
+
+    #and at the end of the interaction, the HTML body is closed
+    parts.append(END_DOC)
+
+    return "".join(parts)
+
+#columns determining the HTML page of an interaction, hashed to decide whether a page has to be rendered again
+PAGE_COLUMNS = ["word", "lemma", "speaker", "turn_id", "participant_id",
+                "persistence_unigrams_lemma", "persistence_bigrams_lemma", "persistence_trigrams_lemma", "persistence_quadrigrams_lemma"]
+
+#hash of this module, such that changes of the renderer or its templates invalidate all pages
+RENDERER_HASH = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+
+def page_hashes(which_corpus, corpus, interaction_positions):
+    """Function returns the content hash of the page of each interaction, i.e., of its rows and tags (the columns in PAGE_COLUMNS),
+    the corpus and the renderer. Rows are hashed at once, interactions by combining the hashes of their rows."""
+
+    row_hashes = pd.util.hash_pandas_object(corpus[[column for column in PAGE_COLUMNS if column in corpus.columns]].astype(str), index=False).to_numpy()
+
+    return {interaction_id: hashlib.sha256(f"{RENDERER_HASH}{which_corpus}{interaction_id}".encode() + row_hashes[positions].tobytes()).hexdigest()
+            for interaction_id, positions in interaction_positions.items()}
+
+def page_hash(path):
+    """Function returns the content hash a page was rendered from (stored in its first line), None if the page does not exist."""
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, encoding="utf-8") as f:
+        first_line = f.readline().rstrip("\n")
+
+    #pages written before content hashes were introduced do not start with the comment
+    prefix, suffix = HASH_COMMENT.split("{hash_}")
+    if not (first_line.startswith(prefix) and first_line.endswith(suffix)):
+        return None
+
+    return first_line[len(prefix):-len(suffix)]
+
+def write_page(path, page):
+    """Function writes a page atomically, i.e., to a temporary file in the same directory which then replaces the page,
+    such that a page is never read while partially written."""
+
+    temporary_path = f"{Path(path).parent}/.{Path(path).name}.tmp"
+
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        f.write(page)
+
+    os.replace(temporary_path, path)
+
+def _write_pages(which_corpus, destination, pages, instrument=False):
+    """Function renders and writes the pages of several interactions (in a worker process), pages being a list of
+    interaction ids, interaction DataFrames, HTML code of their tokens and content hashes. If instrument is True,
+    the records of the interactions are returned (see instrumentation)."""
+
+    if instrument:
+        instrumentation.enable()
+        instrumentation.reset()
+
+    for interaction_id, interaction_df, tokens_html, hash_ in pages:
+
+        interaction_measurement = instrumentation.start("visualisation", interaction_id, len(interaction_df))
+
+        #each page starts with the content hash it was rendered from, followed by the HTML document
+        write_page(f"{destination}/{interaction_id}.html", HASH_COMMENT.format(hash_=hash_) + "\n" + render_interaction(which_corpus, interaction_id, interaction_df, tokens_html))
+
+        instrumentation.stop(interaction_measurement)
+
+    return list(instrumentation.RECORDS) if instrument else []
+
+def lemma(which_corpus, path_to_input, destination, file_format="parquet", processes=None, force=False):
+    """Function reads unigram-based file (produced by persistence.combiner, in the given format) and outputs one HTML
+    file per interaction with all cases of persistence highlighted depending on type (uni-, bi-, tri-, or quadrigram),
+    see render_tokens and render_interaction.
+
+    Each page starts with a content hash of the rows and tags of its interaction (see page_hashes), such that only pages of interactions
+    which changed since the last run are rendered again (unless force is True). Pages are rendered in up to processes worker processes
+    (processes=1 renders them in the current process) and written atomically."""
+
+    #measuring the stage, if instrumentation is enabled (see instrumentation)
+    measurement = instrumentation.start("visualisation")
+
+    #opening and reading unigram-based file with persistence information for all ngram levels
+    #(the storage schema keeps the column words as strings, preventing e.g. "wahr" from being interpreted as Boolean and written as "WAHR" in the HTML output)
+    corpus = storage.read_corpus(storage.corpus_path(path_to_input, f"Persistence_{which_corpus}_all", file_format), index_col=0)
+
     #creating a set of interaction ids...
     interaction_ids = list(corpus["interaction_id"].unique())
 
+    #...and the positions of each interaction's rows in the corpus (computed once, see storage.partition)
+    interaction_positions = storage.partition(corpus)
+
     #in case of RBC, instructions are also part of the corpus, but these are disregarded as they were not tagged for persistence
     if which_corpus == "RBC":
         interaction_ids = [id_ for id_ in interaction_ids if not id_.startswith("Instructions")]
 
-    #...to iterate over
-    for interaction_id in tqdm(interaction_ids):
+    #determining the interactions whose pages do not exist or were rendered from different rows or tags
+    hashes = page_hashes(which_corpus, corpus, {interaction_id: interaction_positions[interaction_id] for interaction_id in interaction_ids})
+    stale = [interaction_id for interaction_id in interaction_ids if force or page_hash(f"{destination}/{interaction_id}.html") != hashes[interaction_id]]
 
-        #creating a DataFrame for each interaction
-        interaction_df = corpus[corpus["interaction_id"] == interaction_id]
+    #rendering all tokens of the corpus at once
+    tokens_html = render_tokens(corpus)
 
-        #creating a set of turn_ids...
-        turn_ids = list(interaction_df["turn_id"].unique())
+    #collecting what is needed for rendering the pages of the stale interactions
+    page_corpus = corpus[[column for column in PAGE_COLUMNS if column in corpus.columns]]
+    pages = [(interaction_id, page_corpus.iloc[interaction_positions[interaction_id]], tokens_html[interaction_positions[interaction_id]], hashes[interaction_id])
+             for interaction_id in stale]
 
-        #only for VACC, extracting participant ids which will be written at the beginning of each HTML file
-        if which_corpus == "VACC":
-            participant_id = corpus[corpus["interaction_id"] == interaction_id]["participant_id"].unique()[0]
+    processes = processes or os.cpu_count()
 
-        #each interaction will gradually be concatenated into a string which will eventually be saved as HTML
-        #the string begins with the start_doc, a header with the name of the corpus and the interaction id and a legend 
-        #detailing how cases of persistence are highlighted
-        interaction_str = start_doc
+    if processes == 1 or len(pages) < 2:
+        _write_pages(which_corpus, destination, pages)
 
-        #depending on the corpus, the beginning of the (visible) HTML content is concatenated to interaction_str
-        if which_corpus == "VACC":
-            interaction_str += f"<header>{which_corpus}, {interaction_id}, {participant_id}</header>"
-        else:
-            interaction_str += f"<header>{which_corpus}, {interaction_id}</header>"
-
-        #skipping if there are no cases of persistence on any of the ngram levels in the given interaction
-        if len(interaction_df["persistence_unigrams_lemma"].unique()) < 2 and len(interaction_df["persistence_bigrams_lemma"].unique()) < 2 and len(interaction_df["persistence_trigrams_lemma"].unique()) < 2 and len(interaction_df["persistence_quadrigrams_lemma"].unique()) < 2:
-            interaction_str += "NO CASES OF PERSISTENCE TAGGED!</br>"
-
-        #adding the legend to interaction_str
-        interaction_str += """<lh_big><b>Legend: </b> <TFFF>Unigram</TFFF>, <FTFF><pp><sub>(</sub></pp>Bigram<pp><sub>)</sub></pp></FTFF>, <FFTF><pp><sub>[</sub></pp>Trigram<pp><sub>]</sub></pp></FFTF>, <FFFT><pp><sub>{</sub></pp>Quadrigram<pp><sub>}</sub></pp></FFFT></lh_big></br>"""
-
-        #...to iterate over
-        for turn_id in turn_ids:
-
-            #creating a DataFrame for each turn
-            turn_df = interaction_df[interaction_df["turn_id"] == turn_id]
-
-            #concatenating the turn id (formatted) to the interaction_str
-            interaction_str += f"<div class='turn'>{turn_id:>03} "
-
-            #if the corpus is VACC and the turn's speaker is the confederate, then
-            #the whole turn is concatenated to interaction_str, wrapped in the designated style (grayed out)
-            if which_corpus == "VACC":
-                if turn_df.iloc[0]["speaker"] == "J":
-                    interaction_str += "<span class='speaker-label'>Confederate:</span>"
-                    interaction_str += " ".join([str(elem) for elem in turn_df["word"]]) + "</conf_turn></div><lh_small> </lh_small></br>"
-                    continue #continuing to next turn as no cases of persistence were tagged for confederate turns, hence there is nothing to highlight
-
-            #if the turn is uttered by the human speaker, then "Human:", wrapped in the designated style, is concatenated to interaction_str
-            if turn_df.iloc[0]["speaker"] == "S":
-                interaction_str += "<span class='speaker-label'>Human:</span>"
-            #else if the turn is uttered by the voice assistant, then "Voice assistant:", wrapped in the designated style, is concatenated to interaction_str
-            elif turn_df.iloc[0]["speaker"] == "A":
-                interaction_str += "<span class='speaker-label'>Voice assistant:</span>"
-
-            #iterating over the turn, token by token
-            for i in range(len(turn_df)):
-
-                #saving (potential) cases of persistence on each ngram level at the given token to four separate variables
-                uni = turn_df.iloc[i]["persistence_unigrams_lemma"]
-                bi = turn_df.iloc[i]["persistence_bigrams_lemma"]
-                tri = turn_df.iloc[i]["persistence_trigrams_lemma"]
-                quadri = turn_df.iloc[i]["persistence_quadrigrams_lemma"]
-
-                #creating a list of Boolean values, True if there is a persistence tag (saved as a string), False if there is no persistence tag (empty string)
-                ngrams = [uni != "", bi != "", tri != "", quadri != ""] #note that these aren't assignments but conditional statements yielding Boolean values!
-                #converting the list of Booleans into a tag string, e.g. TTTF for True, True, True, False
-                tag = "".join(str(elem)[0] for elem in ngrams)
-            
-                #extracting the current word and lemma as well as the index
-                word = turn_df.iloc[i]["word"]
-                lemma = str(turn_df.iloc[i]["lemma"])
-                index = turn_df.iloc[i].name
-
-                """From here on, the HTML code is not directly added to interaction_str, but first on a token basis
-                to the column 'html_code', which makes it easer to add further tags to a token (e.g. in case of overlapping tags)."""
-
-                #if the tag is "FFFF", there are no cases of persistence at the given word
-                #hence, the word is saved as-is to the column "html_code"
-                if tag == "FFFF":
-                    corpus.loc[index, "html_code"] = word
-                #else it is saved enwrapped with the corresponding tag (which will trigger the corresponding HTML style)
-                else:
-                   corpus.loc[index, "html_code"] = f"<{tag}>" + word + f"</{tag}>"
-                
-                #furthermore, boundaries for bi-, tri- and quadrigrams are marked, making it easier to see
-                #what belongs to what when tags are overlapping
-
-                #if the current token is tagged as a (part of a) persistent bigram (or even of multiple as they may overlap)
-                if bi != "": 
-                    #as the column "html_code" is already filled and new tags now have to be inserted in the right place,
-                    #the value is split into start_tag, embedded and end_tag
-                    start_tag, embedded, end_tag = re.split(r"(\<[TF]{4}\>)(\S+)(\</[TF]{4}\>)", corpus.loc[index, "html_code"])[1:4]
-                    #the value is then modified, depending on whether the current word is tagged both as the start and end of a persistent bigram (overlapping case of persistence),
-                    #or whether it is just the start or just the end; depending on that the relevant new tags are inserted and combined with "start_tag", "embedded" and "end_tag"
-                    if "start" in bi and "end" in bi:
-                        corpus.loc[index, "html_code"] = start_tag + f"<pp><sub>(</sub></pp>" + embedded + f"<pp><sub>)</sub></pp>" + end_tag
-                    elif "start" in bi:
-                        corpus.loc[index, "html_code"] = start_tag + f"<pp><sub>(</sub></pp>" + embedded + end_tag
-                    elif "end" in bi:
-                        corpus.loc[index, "html_code"] = start_tag + embedded + f"<pp><sub>)</sub></pp>" + end_tag
-
-                #if the current token is tagged as a (part of a) persistent trigram (or even of multiple as they may overlap)
-                if tri != "": 
-                    #as the column "html_code" is already filled and new tags now have to be inserted in the right place,
-                    #the value is split into start_tag, embedded and end_tag
-                    start_tag, embedded, end_tag = re.split(r"(\<[TF]{4}\>)(\S+)(\</[TF]{4}\>)", corpus.loc[index, "html_code"])[1:4]
-                    #the value is then modified, depending on whether the current word is tagged both as the start and end of a persistent trigram (overlapping case of persistence),
-                    #or whether it is just the start or just the end; depending on that the relevant new tags are inserted and combined with "start_tag", "embedded" and "end_tag"
-                    if "start" in tri and "end" in tri:
-                        corpus.loc[index, "html_code"] = start_tag + f"<pp><sub>[</sub></pp>" + embedded + f"<pp><sub>]</sub></pp>" + end_tag
-                    elif "start" in tri:
-                        corpus.loc[index, "html_code"] = start_tag + f"<pp><sub>[</sub></pp>" + embedded + end_tag
-                    elif "end" in tri:
-                        corpus.loc[index, "html_code"] = start_tag + embedded + f"<pp><sub>]</sub></pp>" + end_tag
-
-                #if the current token is tagged as a (part of a) persistent quadrigram (or even of multiple as they may overlap)
-                if quadri != "": 
-                    #as the column "html_code" is already filled and new tags now have to be inserted in the right place,
-                    #the value is split into start_tag, embedded and end_tag
-                    start_tag, embedded, end_tag = re.split(r"(\<[TF]{4}\>)(\S+)(\</[TF]{4}\>)", corpus.loc[index, "html_code"])[1:4]                    
-                    #the value is then modified, depending on whether the current word is tagged both as the start and end of a persistent quadrigram (overlapping case of persistence),
-                    #or whether it is just the start or just the end; depending on that the relevant new tags are inserted and combined with "start_tag", "embedded" and "end_tag"
-                    if "start" in quadri and "end" in quadri:
-                        corpus.loc[index, "html_code"] = start_tag + "<pp><sub>{</sub></pp>" + embedded + "<pp><sub>}</sub></pp>" + end_tag
-                    elif "start" in quadri:
-                        corpus.loc[index, "html_code"] = start_tag + "<pp><sub>{</sub></pp>" + embedded + end_tag
-                    elif "end" in quadri:
-                        corpus.loc[index, "html_code"] = start_tag + embedded + "<pp><sub>}</sub></pp>" + end_tag
-
-                #if the current word is not the same as the current lemma, the divergent lemma is added in subscript to the column value
-                if tag != "FFFF" and word.lower() != lemma:
-                    start_tag, embedded, end_tag = re.split(r"(\<[TF]{4}\>)(\S+)(\</[TF]{4}\>)", corpus.loc[index, "html_code"])[1:4]                    
-                    corpus.loc[index, "html_code"] = start_tag + embedded + f"<pp><sub>{lemma}</sub></pp>" + end_tag
-
-                #now the interaction_str is concatenated with the final html_code column value
-                interaction_str += corpus.loc[index, "html_code"]
-
-                #the last step consists in bridging the gap between separate words using the correct style
-                #such that whitespace is also enwrapped with the style of the subsequent token
-
-                #the "null hyppothesis" is that the subsequent token is not tagged as persistent on any
-                #ngram level, hence its tag is "FFFF"
-                tag_after = "FFFF"
-                #however, unless it is the very word of a turn, creating a new "tag_after"
-                #by checking whether there are persistence tags on each of the ngram levels, again resulting in a four-letter tag
-                if i < len(turn_df)-1:
-                    tag_after = ""
-                    tag_after += str(turn_df.iloc[i+1]["persistence_unigrams_lemma"] != "")[0]
-                    tag_after += str(turn_df.iloc[i+1]["persistence_bigrams_lemma"] != "")[0]
-                    tag_after += str(turn_df.iloc[i+1]["persistence_trigrams_lemma"] != "")[0]
-                    tag_after += str(turn_df.iloc[i+1]["persistence_quadrigrams_lemma"] != "")[0]   
-
-                #if the tag_after is "FFFF", then style-less whitespace is concatenated to interaction_str 
-                if tag_after == "FFFF":
-                    interaction_str += " "
-                #else...
-                else:
-                    #a new_tag is initialised with "F" at the beginning for no unigram persistence as unigrams can never span more than one token
-                    new_tag = "F"
-                    #if there are persistent bigrams both starting and ending or even just starting at the current token, "new_tag" receives a "T", else an "F"
-                    if "start" in str(bi) and "end" in str(bi):
-                        new_tag += "T"
-                    elif "start" in str(bi):
-                        new_tag += "T"
-                    else: 
-                        new_tag += "F"
-                    
-                    #if there are persistent trigrams both starting and ending or starting and being inside the current token, "new_tag" receives a "T", else an "F"
-                    if "start" in str(tri) and "end" in str(tri):
-                        new_tag += "T"
-                    elif "start" in str(tri) or "inside" in str(tri):
-                        new_tag += "T"
-                    else: 
-                        new_tag += "F"
-
-                    #if there are persistent quadrigrams both starting and ending or starting and being inside the current token, "new_tag" receives a "T", else an "F"
-                    if "start" in str(quadri) and "end" in str(quadri):
-                        new_tag += "T"
-                    elif "start" in str(quadri) or "inside" in str(quadri):
-                        new_tag += "T"
-                    else: 
-                        new_tag += "F" 
-
-                    #the interaction_str is then concatenated with whitespace enwrapped with the style of "new_tag",
-                    #thus bridging the gap in the relevant style
-                    interaction_str += f"<{new_tag}>" + " " + f"</{new_tag}>"
-
-            #after each turn, two line breaks are concatenated to interaction_str
-            interaction_str += "</div><lh_small> </lh_small></br>"
-
-        #and at the end of the interaction, the HTML body is closed
-        interaction_str += "</body></br></html>"
-
-        #each interaction is saved as a separate HTML file to the desired location
-        with open(f"{destination}/{interaction_id}.html", 'w', encoding='utf-8') as f:
-            f.write(interaction_str)
-
-def inspect(levels, ngrams, threshold, which_corpus, path):
-    """Function outputs most frequent cases of persistence (above defined threshold) for all supplied levels in the given corpus"""
+    else:
+        #distributing the pages over the worker processes in chunks (several per process, such that processes finishing early receive more)
+        chunks = [pages[k::processes * 4] for k in range(min(len(pages), processes * 4))]
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_write_pages, which_corpus, destination, chunk, instrumentation.ENABLED) for chunk in chunks]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                instrumentation.RECORDS.extend(future.result())
+
+    print(f"Rendered {len(stale)} pages, skipped {len(interaction_ids) - len(stale)} unchanged")
+
+    instrumentation.stop(measurement, rows=len(corpus))
+
+def _persistent_lemmata(corpus):
+    """Function returns a Series of the lemmata (or ngrams of lemmata) tagged as persistent at each token, one row per lemma
+    (indexed like corpus), counting ngrams only at their first token."""
+
+    #only tagged tokens are considered (tags of most tokens are empty)
+    tags = {ngram: corpus[f"persistence_{ngram}_lemma"].astype(str) for ngram in ["unigrams", "bigrams", "trigrams", "quadrigrams"]}
+    tags = {ngram: column[column != ""] for ngram, column in tags.items()}
+
+    unigrams = tags["unigrams"].str.extract(r"^(?:FPP|SPP)_(.+)$")[0].dropna()
+    ngrams = [tags[ngram].str.findall(r"(?:FPP|SPP)_start_(.+?)(?=; |$)").explode().dropna() for ngram in BRACKETS]
+
+    return pd.concat([unigrams] + ngrams)
+
+def browser(which_corpus, path_to_input, destination, file_format="parquet"):
+    """Function reads unigram-based file (produced by persistence.combiner, in the given format) and outputs a single-page browser
+    for all interactions instead of one HTML file per interaction: a data bundle ({which_corpus}_bundle.js) and a static viewer (index.html)
+    which can be opened from the local filesystem. The viewer renders interactions on demand (turns in batches while scrolling), lists
+    interactions with virtualised scrolling and allows searching persistent lemmata.
+
+    The bundle is json (assigned to a variable, such that it can be loaded without a web server) holding the distinct HTML code of
+    all tokens (see render_tokens) once, each turn as list of codes of its tokens, and an index of persistent lemmata and ngrams
+    mapping them to the interactions they occur in."""
+
+    #measuring the stage, if instrumentation is enabled (see instrumentation)
+    measurement = instrumentation.start("browser")
+
+    corpus = storage.read_corpus(storage.corpus_path(path_to_input, f"Persistence_{which_corpus}_all", file_format), index_col=0)
+
+    #creating a list of interaction ids (disregarding instructions in RBC) and the positions of the rows of each turn
+    interaction_ids = list(corpus["interaction_id"].unique())
+    if which_corpus == "RBC":
+        interaction_ids = [id_ for id_ in interaction_ids if not id_.startswith("Instructions")]
+    turn_positions = corpus.groupby(["interaction_id", "turn_id"], sort=False, observed=True).indices
+
+    #rendering all tokens at once; in VACC, turns of the confederate are not highlighted, hence consisting of the words only
+    tokens_html = render_tokens(corpus)
+    if which_corpus == "VACC":
+        confederate = (corpus["speaker"] == "J").to_numpy()
+        tokens_html[confederate] = corpus["word"].astype(str).to_numpy(dtype=object)[confederate]
+
+    #storing each distinct HTML code of a token (a "fragment") only once
+    codes, fragments = pd.factorize(tokens_html)
+
+    interactions = {interaction_id: {"id": str(interaction_id), "turns": []} for interaction_id in interaction_ids}
+    speakers = corpus["speaker"].to_numpy(dtype=object)
+
+    for (interaction_id, turn_id), positions in turn_positions.items():
+        if interaction_id in interactions:
+            interactions[interaction_id]["turns"].append([format(turn_id, ">03"), str(speakers[positions[0]]), codes[positions].tolist()])
+
+    #adding the title of each interaction and whether any cases of persistence were tagged in it (see render_interaction)
+    interaction_positions = storage.partition(corpus)
+    distinct_tags = corpus.groupby("interaction_id", sort=False, observed=True)[[f"persistence_{ngram}_lemma" for ngram in ["unigrams", "bigrams", "trigrams", "quadrigrams"]]].nunique(dropna=False)
+    for interaction_id, interaction in interactions.items():
+        participant_id = corpus["participant_id"].iloc[interaction_positions[interaction_id][0]] if which_corpus == "VACC" else None
+        interaction["title"] = f"{which_corpus}, {interaction_id}, {participant_id}" if which_corpus == "VACC" else f"{which_corpus}, {interaction_id}"
+        interaction["tagged"] = bool((distinct_tags.loc[interaction_id] >= 2).any())
+
+    #indexing persistent lemmata and ngrams by the (numbers of the) interactions they occur in, the most frequent first
+    numbers = pd.Series(range(len(interaction_ids)), index=pd.Index(interaction_ids, dtype=object))
+    lemmata = _persistent_lemmata(corpus)
+    occurrences = pd.DataFrame({"lemma": lemmata.to_numpy(), "interaction": corpus["interaction_id"].astype(object).to_numpy()[lemmata.index]})
+    occurrences["interaction"] = occurrences["interaction"].map(numbers)
+    occurrences = occurrences.dropna().drop_duplicates().astype({"interaction": int}).sort_values("interaction")
+    index = occurrences.groupby("lemma")["interaction"].agg(list)
+    index = index.loc[index.str.len().sort_values(ascending=False, kind="stable").index]
+
+    bundle = {"corpus": which_corpus,
+              "templates": {"header": HEADER, "legend": LEGEND, "turn": TURN.replace("{turn_id:>03}", "{turn_id}"), "confederate_turn": CONFEDERATE_TURN.replace("{turn_id:>03}", "{turn_id}")},
+              "speaker_labels": SPEAKER_LABELS,
+              "fragments": list(fragments),
+              "interactions": list(interactions.values()),
+              "index": index.to_dict()}
+
+    #writing the bundle and the viewer (with the styles of the HTML pages), both atomically
+    Path(destination).mkdir(parents=True, exist_ok=True)
+    write_page(f"{destination}/{which_corpus}_bundle.js", "window.PERSISTENCE_BUNDLE = " + json.dumps(bundle, ensure_ascii=False, separators=(",", ":")) + ";\n")
+
+    styles = START_DOC[START_DOC.index("<style>"):START_DOC.index("</style>") + len("</style>")]
+    viewer = Path(__file__).with_name("browser.html").read_text(encoding="utf-8")
+    write_page(f"{destination}/index.html", viewer.replace("{styles}", styles).replace("{bundle}", f"{which_corpus}_bundle.js"))
+
+    instrumentation.stop(measurement, rows=len(corpus))
+
+#sizes of the ngrams of the separately tagged corpora (see persistence.combiner)
+NGRAM_SIZES = {"unigrams": 1, "bigrams": 2, "trigrams": 3, "quadrigrams": 4}
+
+def frequencies(which_corpus, path, file_format="parquet", destination=None, cache=True):
+    """Function aggregates all cases of persistence in the separately tagged corpora (of all ngram sizes, in the given format) into one table
+    with the columns level (lemma, pos etc.), n, item (the persistent lemma/POS-tag ngram), realisation (the words it was realised as),
+    pair_part (FPP or SPP) and count, sorted by descending count.
+
+    The table is cached as Frequencies_{which_corpus} (in the given format) in path and only recomputed if any of the tagged corpora is
+    newer than the cache (or cache is False). If destination is passed, the table is also exported to it (e.g. as csv for reporting)."""
+
+    inputs = [storage.corpus_path(path, f"Persistence_{which_corpus}_{ngram}", file_format) for ngram in NGRAM_SIZES]
+    cache_file = storage.corpus_path(path, f"Frequencies_{which_corpus}", file_format)
+
+    if cache and os.path.exists(cache_file) and all(os.path.getmtime(cache_file) >= os.path.getmtime(file) for file in inputs if os.path.exists(file)):
+        table = storage.read_corpus(cache_file)
+
+    else:
+        tags = []
+
+        #reading each tagged corpus once and collecting its tags of all levels with the tagged words
+        for ngram, file in zip(NGRAM_SIZES, inputs):
+
+            if not os.path.exists(file):
+                continue
+
+            corpus = storage.read_corpus(file)
+
+            for column in [column for column in corpus.columns if column.startswith("persistence_")]:
+                tagged = corpus.loc[corpus[column].notna() & (corpus[column].astype(str) != ""), [column, "word"]]
+                tags.append(pd.DataFrame({"level": column[len("persistence_"):], "n": NGRAM_SIZES[ngram],
+                                          "tag": tagged[column].astype(str).to_numpy(), "realisation": tagged["word"].astype(str).to_numpy()}))
+
+        tags = pd.concat(tags, ignore_index=True) if tags else pd.DataFrame(columns=["level", "n", "tag", "realisation"])
+
+        #splitting tags like "PER_SPP: ich bin" into pair part and item and counting all combinations at once
+        tags["pair_part"] = tags["tag"].str[4:7]
+        tags["item"] = tags["tag"].str.split(":", n=1).str[1].str.strip()
+
+        table = (tags.groupby(["level", "n", "item", "realisation", "pair_part"]).size().rename("count").reset_index()
+                 .sort_values(["count", "level", "n", "item", "realisation"], ascending=[False, True, True, True, True], kind="stable").reset_index(drop=True))
+
+        if cache:
+            storage.write_corpus(table, cache_file, index=False)
+
+    if destination:
+        storage.write_corpus(table, destination, index=False)
+
+    return table
+
+def inspect(levels, ngrams, threshold, which_corpus, path, file_format="parquet", top=None):
+    """Function outputs most frequent cases of persistence (above defined threshold) for all supplied levels in the given corpus,
+    at most top cases per level and ngram size (and top realisations per POS-tag ngram) if top is passed. Cases are queried from
+    the table of frequencies (see frequencies), which is computed once."""
     
     print("Most Frequent Persistent N-Grams in Speaker Turns\n")
 
+    #counting persistent SPPs only (to avoid duplicates) per level, ngram size and item as well as per realisation
+    table = frequencies(which_corpus, path, file_format)
+    spps = table[table["pair_part"] == "SPP"]
+    items = spps.groupby(["level", "n", "item"], sort=False)["count"].sum().reset_index().sort_values("count", ascending=False, kind="stable")
+
     #iterating over ngram levels
     for ngram in ngrams:
         
-        #reading in corpus
-        corpus = pd.read_csv(f"{path}/Persistence_{which_corpus}_{ngram}.csv", sep=",", index_col=0, na_filter=False)
-        
         #iterating over levels (lemmata, POS-tags etc.)
         for level in levels:
 
-            #filtering corpus for all lemmata tagged as persistent (only SPPs to avoid duplicates)
-            persistent_ngrams = corpus[corpus[f"persistence_{level}"].str.contains("SPP")]
-
-            #counting how often each persistent ngram is found in the corpus
-            most_frequent_ngrams = persistent_ngrams[f"persistence_{level}"].value_counts()
-
             #filtering according to threshold (minimum occurrences of persistent ngrams)
-            most_frequent_ngrams_top = dict(most_frequent_ngrams[most_frequent_ngrams >= threshold])
+            most_frequent_ngrams_top = items[(items["level"] == level) & (items["n"] == NGRAM_SIZES[ngram]) & (items["count"] >= threshold)].head(top)
             
             #informing if no cases of persistence were found above threshold
             if len(most_frequent_ngrams_top) == 0:
@@ -298,35 +437,111 @@ def inspect(levels, ngrams, threshold, which_corpus, path):
 
             #if the level is lemma, the lemmata are outputted as is in descending order and nicely formatted                
             if level == "lemma":
-                for k, v in most_frequent_ngrams_top.items():
-                    print(f"{k.split(':')[1].strip():45}{v:>3}")
+                for k, v in zip(most_frequent_ngrams_top["item"], most_frequent_ngrams_top["count"]):
+                    print(f"{k:45}{v:>3}")
             #if the level is the more abstract category of pos... 
             elif level == "pos":
                 #...all realisations of each persistent pos ngram are identified and counted (e.g. , "Ich bin" and "Du bist" for "PPER VVFIN")
-                for pos_ngram in most_frequent_ngrams_top:
+                realisations = spps[(spps["level"] == level) & (spps["n"] == NGRAM_SIZES[ngram])]
+
+                for pos_ngram in most_frequent_ngrams_top["item"]:
 
-                    #filtering corpus for given persistent pos ngram
-                    realisations = persistent_ngrams[persistent_ngrams[f"persistence_{level}"] == pos_ngram]
-                    
-                    #counting its realisations in the "word" column
-                    realisations_count = realisations["word"].value_counts() 
-                    
                     #filtering according to threshold
-                    realisations_count_top = dict(realisations_count[realisations_count > threshold])
+                    realisations_count_top = realisations[(realisations["item"] == pos_ngram) & (realisations["count"] > threshold)].head(top)
                     
                     #skipping if none make the threshold
                     if len(realisations_count_top) == 0:
                         continue
                     
                     #informing about the pos ngram for which all relevant realisations are to be outputted
-                    print(pos_ngram.split(':')[1].strip(), "\n")
+                    print(pos_ngram, "\n")
                     
                     #outputting all realisations for each persistent pos ngram
-                    for k, v in realisations_count_top.items():
+                    for k, v in zip(realisations_count_top["realisation"], realisations_count_top["count"]):
                         print(f"{k:45}{v:>3}")
                     
                     #structuring output
                     print("\n")
 
             #structuring output
-            print("-------------------------------------------------\n")
\ No newline at end of file
+            print("-------------------------------------------------\n")
+
+def density(which_corpus, path_to_input, file_format="parquet", bins=10):
+    """Function reads unigram-based file (produced by persistence.combiner, in the given format) and counts FPPs and SPPs per interaction,
+    ngram size and bin of relative position within the interaction (e.g. with 10 bins, the first bin holds the first 10% of the tokens).
+    Ngrams are counted once, at their first token. Returns a table with the columns corpus, setting, interaction_id, bin, n, pair_part, count
+    and tokens (the number of tokens in the bin), such that tables of several corpora can be concatenated (see density_heatmap)."""
+
+    corpus = storage.read_corpus(storage.corpus_path(path_to_input, f"Persistence_{which_corpus}_all", file_format))
+
+    #in case of RBC, instructions are also part of the corpus, but these are disregarded as they were not tagged for persistence
+    if which_corpus == "RBC":
+        corpus = corpus[~corpus["interaction_id"].astype(str).str.startswith("Instructions")]
+
+    #determining the bin of each token from its position relative to the length of its interaction
+    interactions = corpus.groupby("interaction_id", sort=False, observed=True)
+    positions = interactions.cumcount().to_numpy()
+    lengths = interactions["interaction_id"].transform("size").to_numpy()
+
+    counts = pd.DataFrame({"setting": corpus["setting"].astype(str).to_numpy() if "setting" in corpus.columns else which_corpus,
+                           "interaction_id": corpus["interaction_id"].astype(str).to_numpy(),
+                           "bin": positions * bins // lengths,
+                           "tokens": 1})
+
+    #counting FPPs and SPPs at each token (only tagged tokens are considered, as the tags of most tokens are empty)
+    for ngram, n in NGRAM_SIZES.items():
+        tags = corpus[f"persistence_{ngram}_lemma"].astype(str).to_numpy(dtype=object)
+        tagged = np.flatnonzero(tags != "")
+        for pair_part in ["FPP", "SPP"]:
+            counts[f"{pair_part}_{n}"] = 0
+            if n == 1:
+                counts.iloc[tagged, counts.columns.get_loc(f"{pair_part}_{n}")] = pd.Series(tags[tagged]).str.startswith(pair_part).astype(int).to_numpy()
+            else:
+                counts.iloc[tagged, counts.columns.get_loc(f"{pair_part}_{n}")] = pd.Series(tags[tagged]).str.count(f"{pair_part}_start_").to_numpy()
+
+    #summing per interaction and bin and reshaping into one row per interaction, bin, ngram size and pair part
+    table = counts.groupby(["setting", "interaction_id", "bin"], sort=False).sum().reset_index()
+    table = table.melt(id_vars=["setting", "interaction_id", "bin", "tokens"], var_name="pair_part", value_name="count")
+    table[["pair_part", "n"]] = table["pair_part"].str.split("_", expand=True)
+    table.insert(0, "corpus", which_corpus)
+
+    return table.astype({"n": int})[["corpus", "setting", "interaction_id", "bin", "n", "pair_part", "count", "tokens"]]
+
+def density_heatmap(table, by=None, pair_part="SPP", rows="n", save_to=None):
+    """Function plots the density of FPPs or SPPs (per 1,000 tokens) computed by density as heatmap of ngram sizes (rows="n")
+    or of single interactions (rows="interaction_id") over bins of relative position. If by is passed (e.g. "setting" or "corpus",
+    for concatenated tables of several corpora), one heatmap is plotted per group, else a single one for the whole table.
+    Returns the figure, which is saved to save_to, if passed."""
+
+    #matplotlib is only needed for plotting, not for computing densities (e.g. in headless runs)
+    import matplotlib.pyplot as plt
+
+    table = table[table["pair_part"] == pair_part]
+    groups = list(table.groupby(by, sort=True)) if by else [(None, table)]
+
+    figure, axes = plt.subplots(len(groups), 1, figsize=(8, (2.5 if rows == "n" else 6) * len(groups)), squeeze=False)
+
+    for ax, (group, group_table) in zip(axes[:, 0], groups):
+
+        #summing counts and tokens over interactions (or ngram sizes, if rows are interactions) and normalising per 1,000 tokens
+        tokens = group_table.groupby([rows, "bin"])["tokens"].sum() if rows == "n" else group_table[group_table["n"] == 1].groupby([rows, "bin"])["tokens"].sum()
+        values = (group_table.groupby([rows, "bin"])["count"].sum() / tokens * 1000).unstack("bin").fillna(0)
+        bins = values.columns.max() + 1
+
+        image = ax.imshow(values.to_numpy(), aspect="auto", cmap="viridis", interpolation="nearest")
+        ax.set_xticks(range(len(values.columns)), [f"{100 * bin_ // bins}–{100 * (bin_ + 1) // bins}%" for bin_ in values.columns], fontsize=7)
+        if rows == "n":
+            ax.set_yticks(range(len(values.index)), [list(NGRAM_SIZES)[n - 1] for n in values.index])
+        else:
+            ax.set_ylabel(f"{len(values.index)} interactions")
+            ax.set_yticks([])
+        ax.set_xlabel("Relative position in interaction")
+        ax.set_title(f"{pair_part}s per 1,000 tokens" + (f" ({group[0] if isinstance(group, tuple) else group})" if by else ""))
+        figure.colorbar(image, ax=ax)
+
+    figure.tight_layout()
+
+    if save_to:
+        figure.savefig(save_to)
+
+    return figure
@@ -0,0 +1,102 @@
+"""Shared vocabulary of a corpus: words, lemmata and POS-tags are mapped onto int32 ids once per corpus (saved alongside the unigram corpus),
+such that tokens are compared as integers rather than strings. The tagger (persistence.tagger) and the alignment check of the combiner
+(persistence.combiner) use the ids of the shared vocabulary; the stopword, instruction and non-identifiability masks of the tagger and of
+quantification.rates, the divergent lemmata of visualisation.render_tokens and the comparisons of variants in quantification operate on
+codes (see codes and joint_codes). Strings are only kept where they are displayed or exported: the persistence tags written by the combiner
+(e.g. "FPP_start_ich gehen"), the HTML and tables of visualisation and the variants of variation samples, which are modelled in R."""
+
+import json, numpy as np, pandas as pd
+from pathlib import Path
+
+def build(corpus, columns=["word", "lemma", "pos"]):
+    """Function builds a shared vocabulary from the given columns (if present) of a unigram-based corpus, i.e., a sorted list of
+    all distinct words, lemmata and POS-tags where the position of each string is its integer id. N-grams are encoded
+    as sequences of these ids, hence one vocabulary serves all n-gram-based corpora derived from the same corpus."""
+
+    #collecting all strings of the relevant columns
+    strings = pd.concat([corpus[column].astype(str) for column in columns if column in corpus.columns], ignore_index=True)
+
+    #sorting distinct strings, such that ids are reproducible for the same corpus
+    return sorted(strings.unique())
+
+def path_for(corpus_file):
+    """Function returns the path of the vocabulary file stored alongside the given corpus file."""
+
+    corpus_file = Path(corpus_file)
+
+    return str(corpus_file.with_name(f"{corpus_file.stem}_vocabulary.json"))
+
+def write(vocabulary, path):
+    """Function saves a vocabulary as json file."""
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(vocabulary, f, ensure_ascii=False)
+
+def read(path):
+    """Function reads a vocabulary saved as json file."""
+
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def encode(values, vocabulary, n=1):
+    """Function encodes strings as int32 ids of the vocabulary. For n > 1, values are n-grams (strings of n whitespace-separated
+    tokens, as created by preprocessing.ngrammer) and an array with one column per position within the n-gram is returned."""
+
+    index = pd.Index(vocabulary)
+    values = pd.Series(values, dtype=object).astype(str).reset_index(drop=True)
+
+    if n == 1:
+        ids = index.get_indexer(values)
+    else:
+        parts = values.str.split(" ", n=n-1, expand=True).reindex(columns=range(n))
+        ids = np.column_stack([index.get_indexer(parts[position].fillna("")) for position in range(n)])
+
+    #strings missing from the vocabulary would all be encoded as -1, and thus be considered identical
+    if (ids == -1).any():
+        raise ValueError("Some strings are not part of the vocabulary, rebuild it from the current corpus.")
+
+    return ids.astype(np.int32)
+
+def decode(ids, vocabulary):
+    """Function decodes int32 ids (of unigrams or, as an array with one column per position, of n-grams) into strings."""
+
+    strings = np.asarray(vocabulary, dtype=object)[np.asarray(ids)]
+
+    #n-grams are joined to whitespace-separated strings again
+    if strings.ndim == 2:
+        return np.array([" ".join(ngram) for ngram in strings], dtype=object)
+
+    return strings
+
+def codes(values, vocabulary=None):
+    """Function returns one int32 code per value (unigram or n-gram) such that identical values receive identical codes,
+    as well as the string of each code (for display and for matching against stopwords or instructions). If a vocabulary
+    is passed, codes are derived from its ids, otherwise the values are factorised directly."""
+
+    values = pd.Series(values, dtype=object).astype(str)
+
+    if vocabulary is None:
+        value_codes, strings = pd.factorize(values)
+        return value_codes.astype(np.int32), list(strings)
+
+    #determining n from the (whitespace-separated) values and encoding them position by position
+    n = int(values.str.count(" ").max()) + 1 if len(values) else 1
+    ids = encode(values, vocabulary, n)
+
+    #mapping each distinct sequence of ids onto one code
+    if n > 1:
+        distinct, value_codes = np.unique(ids, axis=0, return_inverse=True)
+        return value_codes.reshape(-1).astype(np.int32), list(decode(distinct, vocabulary))
+
+    distinct, value_codes = np.unique(ids, return_inverse=True)
+    return value_codes.astype(np.int32), list(decode(distinct, vocabulary))
+
+def joint_codes(*values, vocabulary=None):
+    """Function returns codes of several sequences of values (e.g. the words and lemmata of a corpus, or PREVIOUS and CURRENT of a
+    variation sample) sharing one code space, such that values are compared across sequences as integers (see codes), as well as
+    the string of each code."""
+
+    lengths = np.cumsum([len(value) for value in values])[:-1]
+    value_codes, strings = codes(pd.concat([pd.Series(value, dtype=object) for value in values], ignore_index=True), vocabulary)
+
+    return np.split(value_codes, lengths), strings